@@ -0,0 +1,107 @@
+import threading
+import time
+
+# error codes of missing permissions and invalid credentials, most services answer them with a 400
+authErrorCodes = {"AccessDenied", "AccessDeniedException", "UnauthorizedOperation", "UnauthorizedException",
+                  "AuthFailure", "UnrecognizedClientException", "InvalidClientTokenId", "ExpiredToken",
+                  "ExpiredTokenException", "SignatureDoesNotMatch", "OptInRequired"}
+
+class CircuitOpenError(Exception):
+    pass
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failed calls. While open every call fails right away,
+    after `cooldown` seconds one call is let through again and its outcome closes or reopens it."""
+
+    def __init__(self, threshold=5, cooldown=300):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.openedAt = None
+        self.lastError = None
+        self.probing = False
+
+    # once the cooldown passed, only the trial call is let through until its outcome is known
+    def allow(self):
+        if self.openedAt is None:
+            return True
+        if self.probing or time.time() - self.openedAt < self.cooldown:
+            return False
+        self.probing = True
+        return True
+
+    def is_open(self):
+        return self.openedAt is not None
+
+    def success(self):
+        self.failures = 0
+        self.openedAt = None
+        self.probing = False
+
+    def failure(self, error):
+        self.probing = False
+        self.failures += 1
+        self.lastError = str(error)
+        if self.failures >= self.threshold:
+            self.openedAt = time.time()
+
+class Breakers:
+    """One circuit breaker per (session, service, region), i.e. per account, service and region,
+    hooked into the botocore events of the clients of that scope"""
+
+    def __init__(self, threshold=5, cooldown=300):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.breakers = {}
+        self.cancelled = set()
+        self.lock = threading.Lock()
+
+    def get(self, session, service, region):
+        with self.lock:
+            key = (session, service, region)
+            if key not in self.breakers:
+                self.breakers[key] = CircuitBreaker(self.threshold, self.cooldown)
+            return self.breakers[key]
+
+    def attach(self, client, session, service, region):
+        breaker = self.get(session, service, region)
+
+        def before_call(**kwargs):
+            thread = threading.current_thread()
+            # pipeline workers of a check stop together with the check's thread
+            if thread in self.cancelled or getattr(thread, "parent", None) in self.cancelled:
+                raise CircuitOpenError("check stopped after its time limit")
+            with self.lock:
+                allowed = breaker.allow()
+            if not allowed:
+                raise CircuitOpenError(f"circuit open for {service} in {region} after: {breaker.lastError}")
+
+        # server errors and missing permissions count as failures, any other answer means the endpoint works
+        def after_call(http_response, parsed, **kwargs):
+            code = parsed.get("Error", {}).get("Code")
+            with self.lock:
+                if http_response.status_code >= 500 or http_response.status_code in (401, 403) or code in authErrorCodes:
+                    breaker.failure(code or http_response.status_code)
+                else:
+                    breaker.success()
+
+        # connection errors and timeouts, after botocore's own retries
+        def after_call_error(exception, **kwargs):
+            with self.lock:
+                breaker.failure(exception)
+
+        client.meta.events.register("before-call", before_call)
+        client.meta.events.register("after-call", after_call)
+        client.meta.events.register("after-call-error", after_call_error)
+
+    # Services of a session and region whose circuit is open, with the error that opened it
+    def open_services(self, session, region):
+        with self.lock:
+            return {service: breaker.lastError for (s, service, r), breaker in self.breakers.items()
+                    if s is session and r == region and breaker.is_open()}
+
+    # Make every further API call of a thread fail, e.g. a check that ran past its time limit
+    # and is left behind; it ends at its next call
+    def cancel(self, thread):
+        with self.lock:
+            self.cancelled.add(thread)
@@ -0,0 +1,85 @@
+import threading
+import boto3
+from botocore.config import Config
+from circuitBreaker import Breakers
+from metricStreams import MetricStreamClient, MetricStreamIndex
+from monitoring import MetricBatcher, MonitoringClient
+from progress import progress
+
+# clients are created once per (session, service, region) and reused by every check and rescan
+_clients = {}
+_lock = threading.Lock()
+
+# a degraded endpoint fails within seconds instead of hanging a check, see configure()
+client_config = Config(connect_timeout=10, read_timeout=60, retries={"max_attempts": 3, "mode": "standard"})
+breakers = Breakers()
+# with cross-account observability the CloudWatch calls of every member account are made by the
+# monitoring account, see set_monitoring()
+_monitoring = None
+_monitoringLinger = 0.05
+_batchers = {}
+_accounts = {}
+# with metric streams the metrics are read from the stream files, no CloudWatch API is called, see set_metric_streams()
+_streams = None
+
+def configure(connect_timeout=10, read_timeout=60, breaker_threshold=5, breaker_cooldown=300):
+    global client_config, breakers
+    client_config = Config(connect_timeout=connect_timeout, read_timeout=read_timeout,
+                           retries={"max_attempts": 3, "mode": "standard"})
+    breakers = Breakers(breaker_threshold, breaker_cooldown)
+
+def set_monitoring(session, linger=0.05):
+    global _monitoring, _monitoringLinger
+    _monitoring = session
+    _monitoringLinger = linger
+
+def set_metric_streams(directory):
+    global _streams
+    _streams = MetricStreamIndex(directory)
+    _streams.refresh(force=True)
+
+# Tell which account a session belongs to, so its CloudWatch client can query through the monitoring account
+def register_account(session, account):
+    _accounts[session] = account
+
+def get_client(service, region=None, session=None):
+    if service == "cloudwatch" and _streams is not None:
+        return MetricStreamClient(_streams, _accounts.get(session), region)
+    if service == "cloudwatch" and _monitoring is not None and session in _accounts:
+        return monitoring_client(region, session)
+    return create_client(service, region, session)
+
+def create_client(service, region, session):
+    key = (session, service, region)
+    client = _clients.get(key)
+    if client is None:
+        # creating clients from a shared session is not thread safe
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                factory = session.client if session is not None else boto3.client
+                client = factory(service, region_name=region, config=client_config)
+                breakers.attach(client, session, service, region)
+                # every API call, also failed ones, counts towards the calls per second of the progress line
+                client.meta.events.register("after-call", progress.count_call)
+                client.meta.events.register("after-call-error", progress.count_call)
+                _clients[key] = client
+    return client
+
+# Drop the clients of a session, e.g. when its assumed role credentials are renewed
+def forget_session(session):
+    with _lock:
+        for key in [k for k in _clients if k[0] is session]:
+            del _clients[key]
+        _accounts.pop(session, None)
+
+def monitoring_client(region, session):
+    key = (session, "monitoring", region)
+    client = _clients.get(key)
+    if client is None:
+        cw = create_client("cloudwatch", region, _monitoring)
+        with _lock:
+            if region not in _batchers:
+                _batchers[region] = MetricBatcher(cw, _monitoringLinger)
+            client = _clients.setdefault(key, MonitoringClient(_batchers[region], _accounts[session]))
+    return client
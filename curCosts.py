@@ -0,0 +1,188 @@
+import array
+import csv
+import datetime
+import gzip
+import os
+import numpy as np
+from findings import read_findings
+from findingsDiff import key_hash
+from logs import log
+
+cur_files = ["cur_costs.csv"]
+# line items hashed into flat arrays before they are reduced to one cost per resource
+chunk_rows = 1000000
+
+# columns of a CUR 2.0 export and their names in the legacy CUR format
+curColumns = {
+    "resource": ("line_item_resource_id", "lineItem/ResourceId"),
+    "account": ("line_item_usage_account_id", "lineItem/UsageAccountId"),
+    "region": ("product_region_code", "product/regionCode", "product/region"),
+    "cost": ("line_item_unblended_cost", "lineItem/UnblendedCost"),
+    "period": ("bill_billing_period_start_date", "bill/BillingPeriodStartDate"),
+}
+
+# Resource IDs in the CUR are often ARNs, the findings carry the short ID: the part after
+# "loadbalancer/" for load balancers, otherwise the last part of the ARN (db:name, table/name, snapshot/snap-...)
+def resource_key(resourceId):
+    if not resourceId.startswith("arn:"):
+        return resourceId
+    if ":loadbalancer/" in resourceId:
+        return resourceId.split(":loadbalancer/", 1)[1]
+    resource = resourceId.split(":", 5)[-1]
+    if "/" in resource:
+        return resource.split("/", 1)[1]
+    return resource.split(":")[-1]
+
+def cost_key(account, region, resourceId):
+    return key_hash(f"{account}|{region}|{resource_key(resourceId)}")
+
+def pick_columns(names):
+    picked = {}
+    for column, candidates in curColumns.items():
+        for candidate in candidates:
+            if candidate in names:
+                picked[column] = candidate
+                break
+    if "resource" not in picked or "cost" not in picked:
+        raise ValueError("not a Cost and Usage Report: no resource ID or unblended cost column")
+    return picked
+
+# Stream (resource, account, region, cost, period) of a CSV export row by row, gzipped or not
+def read_csv_cur(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        picked = pick_columns(header)
+        index = {column: header.index(name) for column, name in picked.items()}
+        for row in reader:
+            yield tuple(row[index[column]] if column in index else "" for column in curColumns)
+
+# Stream a Parquet export one row group batch at a time, reading only the needed columns
+def read_parquet_cur(path, batch_size=65536, only=None):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ValueError(f"reading {path} needs pyarrow, install it or export the CUR as CSV")
+    parquet = pq.ParquetFile(path)
+    picked = pick_columns(parquet.schema_arrow.names)
+    if only:
+        picked = {column: name for column, name in picked.items() if column in only}
+    for batch in parquet.iter_batches(batch_size=batch_size, columns=list(picked.values())):
+        data = {column: batch.column(batch.schema.get_field_index(name)).to_pylist() for column, name in picked.items()}
+        for n in range(batch.num_rows):
+            yield tuple(data[column][n] if column in data else "" for column in curColumns)
+
+def cur_files_in(path):
+    if os.path.isdir(path):
+        return sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names
+                      if name.endswith((".csv", ".csv.gz", ".parquet")))
+    return [path]
+
+def read_cur(file, only=None):
+    if file.endswith(".parquet"):
+        return read_parquet_cur(file, only=only)
+    return read_csv_cur(file)
+
+# Billing months of the line items of each export file, read from the period column only
+def file_periods(files):
+    periods = {}
+    for file in files:
+        periods[file] = {str(period)[:7] for resource, account, region, cost, period in read_cur(file, {"period"})}
+    return periods
+
+# Sum the costs of equal hashes: sorted unique hashes and their total cost
+def reduce_costs(hashes, costs):
+    if len(hashes) == 0:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.float64)
+    order = np.argsort(hashes, kind="stable")
+    hashes, costs = hashes[order], costs[order]
+    unique, starts = np.unique(hashes, return_index=True)
+    return unique, np.add.reduceat(costs, starts)
+
+class CurIndex:
+    """Unblended cost per resource of one billing period, as sorted arrays of 64-bit hashes of
+    (account, region, resource ID) and costs. Resource IDs themselves are never kept."""
+
+    def __init__(self, hashes, costs, period):
+        order = np.argsort(hashes)
+        self.hashes = hashes[order]
+        self.costs = costs[order]
+        self.period = period
+
+    # Aggregate the exports in path (a file or a directory) for the last complete month, or the current
+    # one when the exports hold nothing else. The month is picked from the period column first, then only
+    # its line items are hashed into flat arrays, reduced per chunk and merged, so memory grows with
+    # the resources of one month only.
+    @classmethod
+    def from_files(cls, path):
+        periods = file_periods(cur_files_in(path))
+        months = set().union(*periods.values()) if periods else set()
+        thisMonth = datetime.date.today().isoformat()[:7]
+        complete = [month for month in months if month < thisMonth]
+        period = max(complete or months or [""])
+        reduced = []
+        for file, fileMonths in periods.items():
+            if period not in fileMonths:
+                continue
+            hashes, costs = array.array("Q"), array.array("d")
+            for resource, account, region, cost, linePeriod in read_cur(file):
+                if not resource or str(linePeriod)[:7] != period:
+                    continue
+                hashes.append(cost_key(account or "", region or "", resource))
+                costs.append(float(cost or 0))
+                if len(hashes) >= chunk_rows:
+                    reduced.append(reduce_costs(np.frombuffer(hashes, dtype=np.uint64), np.frombuffer(costs, dtype=np.float64)))
+                    hashes, costs = array.array("Q"), array.array("d")
+            reduced.append(reduce_costs(np.frombuffer(hashes, dtype=np.uint64), np.frombuffer(costs, dtype=np.float64)))
+        hashes, costs = reduce_costs(np.concatenate([h for h, _ in reduced] or [np.empty(0, dtype=np.uint64)]),
+                                     np.concatenate([c for _, c in reduced] or [np.empty(0, dtype=np.float64)]))
+        return cls(hashes, costs, period)
+
+    def lookup(self, account, region, resourceId):
+        key = np.uint64(cost_key(account, region, resourceId))
+        n = np.searchsorted(self.hashes, key)
+        if n < len(self.hashes) and self.hashes[n] == key:
+            return float(self.costs[n])
+        return None
+
+    # Cost of a resource, also matched when the CUR line carries no region
+    def cost(self, account, region, resourceId):
+        if len(self.hashes) == 0:
+            return None
+        cost = self.lookup(account, region, resourceId)
+        return self.lookup(account, "", resourceId) if cost is None else cost
+
+    def __len__(self):
+        return len(self.hashes)
+
+# Join the actual cost of every finding of the report in path onto it. Savings are scaled from list
+# prices to the actual cost: removing a resource saves all of it, a cheaper type saves the same share.
+def join_findings(path, index, output="cur_costs.csv"):
+    matched = 0
+    with open(output, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['Account', 'Region', 'ResourceType', 'ResourceId', 'currentType', 'listCost',
+                         'actualCost', 'newType', 'newCost', 'actualSavings', 'billingPeriod'])
+        for finding in read_findings(path):
+            actualCost = index.cost(finding.account, finding.region, finding.resourceId)
+            # RDS snapshots are reported as <instance>-<snapshot>, the CUR only knows the snapshot
+            if actualCost is None and finding.resourceType == "RDSSnapshot":
+                parts = finding.resourceId.split("-")
+                for n in range(1, len(parts)):
+                    actualCost = index.cost(finding.account, finding.region, "-".join(parts[n:]))
+                    if actualCost is not None:
+                        break
+            if actualCost is None:
+                actualSavings = ""
+            elif finding.currentCost > 0:
+                matched += 1
+                actualSavings = actualCost * (1 - finding.newCost / finding.currentCost)
+            else:
+                matched += 1
+                actualSavings = actualCost if finding.newCost == 0 else 0.0
+            writer.writerow([finding.account, finding.region, finding.resourceType, finding.resourceId,
+                             finding.currentType, finding.currentCost, "" if actualCost is None else actualCost,
+                             finding.newType, finding.newCost, actualSavings, index.period])
+    log.info("Matched the actual cost of %s finding(s) in the %s billing period", matched, index.period)
+    return matched
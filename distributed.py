@@ -0,0 +1,231 @@
+import json
+import os
+import threading
+import time
+import uuid
+import clients
+import writeToCSV
+from clients import forget_session
+from eventRescan import open_queue
+from localQueue import LocalQueue
+from logs import log, log_context
+from progress import progress
+from redisQueue import RedisQueue
+from scanPlan import WorkUnit, checkServices, run_with_limit, write_unscanned
+from serve import session_ttl
+from writeToCSV import collecting, write_to_csv
+
+# a worker holds a unit for this long and extends the lease while it scans, a unit of a worker
+# that died is received by another worker once the lease runs out
+lease_seconds = 300
+# findings per result message, an SQS message is at most 256 KiB
+rows_per_message = 500
+# a unit whose worker was lost this many times is reported as incomplete instead of scanned again
+max_attempts = 3
+
+# Open a queue of work units or results: redis://host:port/db/name, a local directory, or an SQS queue URL
+def open_work_queue(url):
+    if url.startswith(("redis://", "rediss://")):
+        return RedisQueue(url)
+    if "://" not in url:
+        return LocalQueue(url)
+    return open_queue(url)
+
+# The results go next to the units: results/ of a local queue, <name>:results of a Redis queue.
+# An SQS queue has no such place, its results queue is always given.
+def results_queue_url(work_url, results_url=None):
+    if results_url:
+        return results_url
+    if work_url.startswith(("redis://", "rediss://")):
+        return work_url + ":results"
+    if "://" not in work_url:
+        return os.path.join(work_url, "results")
+    raise ValueError("an SQS work queue needs --results-queue")
+
+class Coordinator:
+    """Sends the work units of a run to the work queue and writes the findings the workers send
+    back. A unit counts once all result chunks of one attempt arrived; the chunks of other attempts,
+    e.g. of a worker that was thought dead, are dropped so no finding is written twice."""
+
+    def __init__(self, units, queue, queue_url, results, results_url, deadline):
+        self.units = {self.key(unit): unit for unit in units}
+        self.queue = queue
+        self.queue_url = queue_url
+        self.results = results
+        self.results_url = results_url
+        self.deadline = deadline
+        self.run = uuid.uuid4().hex
+        self.chunks = {}
+        self.summary = []
+
+    @staticmethod
+    def key(unit):
+        return unit.account, unit.region, unit.check
+
+    def send(self):
+        for unit in self.units.values():
+            body = {"run": self.run, "expires": self.deadline.end, "unit": unit._asdict()}
+            self.queue.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(body))
+        log.info("Sent %s work units to %s", len(self.units), self.queue_url)
+
+    def receive(self, result):
+        key = tuple(result["unit"][field] for field in ("account", "region", "check"))
+        if result.get("run") != self.run or key not in self.units:
+            return
+        attempt = self.chunks.setdefault(key, {}).setdefault(result["attempt"], {})
+        attempt[result["chunk"]] = result
+        if len(attempt) < result["chunks"]:
+            return
+        unit = self.units.pop(key)
+        del self.chunks[key]
+        for n in sorted(attempt):
+            for file_path, row, header in attempt[n]["rows"]:
+                write_to_csv(file_path, *row, header=header)
+        status, seconds, reason = result["status"], result["seconds"], result["reason"]
+        if reason:
+            log.warning("%s check in region %s of account %s is incomplete: %s", unit.check, unit.region, unit.account, reason)
+        if status == "skipped":
+            write_unscanned([unit], reason)
+        self.summary.append((unit, status, seconds, reason))
+        progress.unit_finished(unit, status, seconds, reason)
+
+    # Consume results until every unit is done or the deadline passed, then report the rest as unscanned
+    def collect(self):
+        while self.units and not self.deadline.expired():
+            remaining = self.deadline.remaining()
+            response = self.results.receive_message(QueueUrl=self.results_url, MaxNumberOfMessages=10,
+                                                    WaitTimeSeconds=int(min(20, remaining if remaining is not None else 20)),
+                                                    VisibilityTimeout=60)
+            for message in response.get("Messages", []):
+                try:
+                    self.receive(json.loads(message["Body"]))
+                except (ValueError, KeyError) as error:
+                    log.warning("Skipping result message %s: %s", message.get("MessageId"), error)
+                self.results.delete_message(QueueUrl=self.results_url, ReceiptHandle=message["ReceiptHandle"])
+        left = list(self.units.values())
+        if left:
+            write_unscanned(left, "deadline")
+            for unit in left:
+                self.summary.append((unit, "unscanned", 0, "deadline"))
+                progress.unit_finished(unit, "unscanned", 0, "deadline")
+        return self.summary
+
+# Send the units to the workers and wait for their findings, returns the run summary rows
+def coordinate(units, queue, queue_url, results, results_url, deadline):
+    coordinator = Coordinator(units, queue, queue_url, results, results_url, deadline)
+    coordinator.send()
+    return coordinator.collect()
+
+class Worker:
+    """Scans the units of the work queue, one per thread, and sends their findings to the results
+    queue. The lease of a unit is extended while its check runs, the unit is only deleted from the
+    queue once its findings were sent."""
+
+    def __init__(self, queue, queue_url, results, results_url, checks, get_session, check_timeout=None, idle=None):
+        self.queue = queue
+        self.queue_url = queue_url
+        self.results = results
+        self.results_url = results_url
+        self.checks = checks
+        self.get_session = get_session
+        self.check_timeout = check_timeout
+        self.idle = idle
+        self.sessions = {}
+        self.sessionLock = threading.Lock()
+        self.lastWork = time.time()
+
+    # Keep one session per account, renewed before its credentials expire
+    def session_for(self, account):
+        with self.sessionLock:
+            session, created = self.sessions.get(account, (None, 0))
+            if session is None or time.time() - created > session_ttl:
+                if session is not None:
+                    forget_session(session)
+                session = self.get_session(account)
+                self.sessions[account] = (session, time.time())
+            return session
+
+    def open_services(self, session, unit):
+        opened = clients.breakers.open_services(session, unit.region)
+        return {service: error for service, error in opened.items() if service in checkServices[unit.check]}
+
+    # Scan a unit, returns the rows it wrote with its status, duration and why it is incomplete
+    def scan(self, unit, receives):
+        if receives > max_attempts:
+            return [], "incomplete", 0, f"worker lost {receives - 1} times"
+        session = self.session_for(unit.account)
+        opened = self.open_services(session, unit)
+        if opened:
+            return [], "skipped", 0, "circuit open: " + ", ".join(f"{service} ({error})" for service, error in opened.items())
+        log.info("Running %s check in region: %s in account: %s", unit.check, unit.region, unit.account)
+        started = time.time()
+        with collecting() as rows:
+            reason = run_with_limit(self.checks[unit.check], (unit.region, unit.account, session),
+                                    self.check_timeout, clients.breakers)
+        if reason == "timeout":
+            reason = "time limit"
+        opened = self.open_services(session, unit)
+        if reason is None and opened:
+            reason = "circuit opened: " + ", ".join(f"{service} ({error})" for service, error in opened.items())
+        # a check left behind after its time limit may still add rows until its next API call
+        return list(rows), "incomplete" if reason else "complete", time.time() - started, reason
+
+    def send_results(self, run, unit, rows, status, seconds, reason):
+        attempt = uuid.uuid4().hex
+        chunks = [rows[n:n + rows_per_message] for n in range(0, len(rows), rows_per_message)] or [[]]
+        for n, chunk in enumerate(chunks):
+            body = {"run": run, "unit": unit._asdict(), "attempt": attempt, "chunk": n, "chunks": len(chunks),
+                    "rows": chunk, "status": status, "seconds": seconds, "reason": reason}
+            self.results.send_message(QueueUrl=self.results_url, MessageBody=json.dumps(body, default=str))
+
+    def heartbeat(self, message, stop):
+        while not stop.wait(lease_seconds / 3):
+            try:
+                self.queue.change_message_visibility(QueueUrl=self.queue_url, ReceiptHandle=message["ReceiptHandle"],
+                                                     VisibilityTimeout=lease_seconds)
+            except Exception as error:
+                log.warning("Error extending the lease of %s: %s", message.get("MessageId"), error)
+
+    def process(self, message):
+        work = json.loads(message["Body"])
+        unit = WorkUnit(**work["unit"])
+        # units of a run whose deadline passed are dropped, the coordinator already listed them as unscanned
+        if work.get("expires") is None or time.time() < work["expires"]:
+            stop = threading.Event()
+            beat = threading.Thread(target=self.heartbeat, args=(message, stop), daemon=True)
+            beat.start()
+            try:
+                with log_context(account=unit.account, region=unit.region, check=unit.check):
+                    result = self.scan(unit, int(message.get("Attributes", {}).get("ApproximateReceiveCount", 1)))
+                self.send_results(work["run"], unit, *result)
+            finally:
+                stop.set()
+                beat.join()
+        self.queue.delete_message(QueueUrl=self.queue_url, ReceiptHandle=message["ReceiptHandle"])
+
+    def run(self):
+        while self.idle is None or time.time() - self.lastWork < self.idle:
+            response = self.queue.receive_message(QueueUrl=self.queue_url, MaxNumberOfMessages=1,
+                                                  WaitTimeSeconds=int(min(20, self.idle or 20)),
+                                                  VisibilityTimeout=lease_seconds,
+                                                  AttributeNames=["ApproximateReceiveCount"])
+            for message in response.get("Messages", []):
+                try:
+                    self.process(message)
+                except Exception as error:
+                    # the unit is left in the queue and retried once its lease runs out
+                    log.error("Error processing work unit %s: %s", message.get("MessageId"), error)
+                self.lastWork = time.time()
+
+# Scan units from the work queue on `threads` threads until it was empty for `idle` seconds (None runs forever).
+# Findings are only sent to the coordinator, no reports are written on a worker.
+def work(queue, queue_url, results, results_url, checks, get_session, check_timeout=None, idle=None, threads=1):
+    writeToCSV.write_files = False
+    worker = Worker(queue, queue_url, results, results_url, checks, get_session, check_timeout, idle)
+    log.info("Waiting for work units on %s", queue_url)
+    pool = [threading.Thread(target=worker.run) for _ in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    log.info("Work queue %s stayed empty for %ss, stopping", queue_url, idle)
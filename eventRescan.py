@@ -0,0 +1,151 @@
+import json
+import re
+import threading
+import boto3
+from localQueue import LocalQueue
+from logs import log, log_context
+
+# CloudTrail events that change whether a resource is used, per check. Resource IDs are taken
+# from the request parameters and response elements; when an event carries none (e.g.
+# DisassociateAddress only has an association ID) the whole check is rerun for the region.
+def idPattern(pattern):
+    return lambda key, value: isinstance(value, str) and re.match(pattern, value) is not None
+
+def idKey(*names):
+    return lambda key, value: isinstance(value, str) and key.lower() in {name.lower() for name in names}
+
+eventChecks = {
+    "ebs": (["CreateVolume", "DeleteVolume", "AttachVolume", "DetachVolume", "ModifyVolume"],
+            idPattern(r"^vol-[0-9a-f]+$")),
+    "snapshots": (["CreateSnapshot", "CreateSnapshots", "CopySnapshot", "DeleteSnapshot", "ModifySnapshotTier",
+                   "RegisterImage", "DeregisterImage"],
+                  idPattern(r"^snap-[0-9a-f]+$")),
+    "ec2": (["RunInstances", "StartInstances", "StopInstances", "TerminateInstances", "ModifyInstanceAttribute"],
+            idPattern(r"^i-[0-9a-f]+$")),
+    "eip": (["AllocateAddress", "ReleaseAddress", "AssociateAddress", "DisassociateAddress"],
+            idPattern(r"^eipalloc-[0-9a-f]+$")),
+    "elb": (["CreateLoadBalancer", "DeleteLoadBalancer", "RegisterTargets", "DeregisterTargets"],
+            idPattern(r"^arn:aws[\w-]*:elasticloadbalancing:.*:loadbalancer/")),
+    "natgw": (["CreateNatGateway", "DeleteNatGateway"],
+              idPattern(r"^nat-[0-9a-f]+$")),
+    "efs": (["CreateFileSystem", "DeleteFileSystem", "CreateMountTarget", "DeleteMountTarget"],
+            idPattern(r"^fs-[0-9a-f]+$")),
+    "rds": (["CreateDBInstance", "DeleteDBInstance", "StartDBInstance", "StopDBInstance", "ModifyDBInstance",
+             "CreateDBSnapshot", "DeleteDBSnapshot"],
+            idKey("dBInstanceIdentifier", "dBSnapshotIdentifier")),
+    "dynamodb": (["CreateTable", "DeleteTable", "UpdateTable"],
+                 idKey("tableName")),
+}
+checkForEvent = {name: check for check, (names, _) in eventChecks.items() for name in names}
+
+# resource types a check reports and how a resource ID maps to the ID in its findings
+checkFindings = {
+    "ebs": (["EBSVolume"], lambda id: id),
+    "snapshots": (["EBSSnapshot"], lambda id: id),
+    "ec2": (["EC2Instance"], lambda id: id),
+    "eip": (["EIP"], lambda id: id),
+    "elb": (["ELB"], lambda arn: arn.split('/', 1)[1]),
+    "natgw": (["NATGW"], lambda id: id),
+    "efs": (["EFSFileSystem"], lambda id: id),
+    "rds": (["RDSInstance", "RDSStorageVolume", "RDSSnapshot"], lambda id: id),
+    "dynamodb": (["DynamoDBTable"], lambda id: id),
+}
+
+def collect_ids(value, match, key="", ids=None):
+    ids = set() if ids is None else ids
+    if isinstance(value, dict):
+        for k, v in value.items():
+            collect_ids(v, match, k, ids)
+    elif isinstance(value, list):
+        for v in value:
+            collect_ids(v, match, key, ids)
+    elif match(key, value):
+        ids.add(value)
+    return ids
+
+# Yield CloudTrail records from a message body: an EventBridge event, a CloudTrail log file,
+# a single record, an SNS notification wrapping one of those, or newline-delimited JSON
+def parse_events(body):
+    try:
+        documents = [json.loads(body)]
+    except ValueError:
+        documents = [json.loads(line) for line in body.splitlines() if line.strip()]
+    for document in documents:
+        if isinstance(document, dict) and isinstance(document.get("Message"), str):
+            yield from parse_events(document["Message"])
+        elif isinstance(document, dict) and "Records" in document:
+            yield from document["Records"]
+        elif isinstance(document, dict) and "detail" in document:
+            record = dict(document["detail"])
+            record.setdefault("recipientAccountId", document.get("account"))
+            record.setdefault("awsRegion", document.get("region"))
+            yield record
+        elif isinstance(document, dict):
+            yield document
+
+# Map a CloudTrail record to the (account, region, check) it invalidates and the affected resource IDs,
+# None means every resource of that check in the region
+def target_for(record):
+    check = checkForEvent.get(record.get("eventName"))
+    account = record.get("recipientAccountId") or record.get("userIdentity", {}).get("accountId")
+    region = record.get("awsRegion")
+    if check is None or account is None or region is None or record.get("errorCode"):
+        return None
+    match = eventChecks[check][1]
+    ids = collect_ids(record.get("requestParameters"), match) | collect_ids(record.get("responseElements"), match)
+    return (account, region, check), (ids or None)
+
+def open_queue(queue_url=None, events_dir=None):
+    if events_dir:
+        return LocalQueue(events_dir)
+    return boto3.client("sqs", region_name=queue_url.split(".")[1] if "sqs." in queue_url else None)
+
+class EventConsumer:
+    def __init__(self, queue, queue_url, rescan, accounts, wait=20):
+        self.queue = queue
+        self.queue_url = queue_url
+        self.rescan = rescan
+        self.accounts = set(accounts)
+        self.wait = wait
+
+    # Receive a batch of messages, coalesce their events per (account, region, check)
+    # and rescan only the affected resources
+    def poll(self):
+        response = self.queue.receive_message(QueueUrl=self.queue_url, MaxNumberOfMessages=10,
+                                              WaitTimeSeconds=self.wait, VisibilityTimeout=300)
+        messages = response.get("Messages", [])
+        targets = {}
+        for message in messages:
+            try:
+                for record in parse_events(message["Body"]):
+                    target = target_for(record)
+                    if target is None or target[0][0] not in self.accounts:
+                        continue
+                    scope, ids = target
+                    if ids is None or (scope in targets and targets[scope] is None):
+                        targets[scope] = None
+                    else:
+                        targets[scope] = targets.get(scope, set()) | ids
+            except ValueError as error:
+                log.warning("Skipping message %s that is not a CloudTrail event: %s", message.get('MessageId'), error)
+        for (account, region, check), ids in targets.items():
+            log.info("Rescanning %s in %s of account %s: %s", check, region, account, ', '.join(sorted(ids)) if ids else 'all resources')
+            with log_context(account=account, region=region, check=check):
+                self.rescan(account, region, check, sorted(ids) if ids else None)
+        for message in messages:
+            self.queue.delete_message(QueueUrl=self.queue_url, ReceiptHandle=message["ReceiptHandle"])
+        return len(messages)
+
+    def run(self, stop):
+        while not stop.is_set():
+            try:
+                self.poll()
+            except Exception as error:
+                log.error("Error consuming events: %s", error)
+                stop.wait(self.wait)
+
+def start_consumer(daemon, queue_url=None, events_dir=None, stop=None):
+    consumer = EventConsumer(open_queue(queue_url, events_dir), queue_url, daemon.rescan, daemon.accounts)
+    stop = stop or threading.Event()
+    threading.Thread(target=consumer.run, args=(stop,), daemon=True).start()
+    return consumer
@@ -0,0 +1,67 @@
+import threading
+from findings import finding_key, savings
+
+class FindingStore:
+    """Current findings held in memory, indexed by account, region and resource type,
+    so API queries never have to scan the full set."""
+
+    indexed_fields = ("account", "region", "resourceType")
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.findings = {}
+        self.scopes = {}
+        self.index = {field: {} for field in self.indexed_fields}
+
+    def add(self, finding):
+        key = finding_key(finding)
+        with self.lock:
+            if key in self.findings:
+                self.remove(key)
+            self.findings[key] = finding
+            self.scopes.setdefault((finding.account, finding.region), set()).add(key)
+            for field in self.indexed_fields:
+                self.index[field].setdefault(getattr(finding, field), set()).add(key)
+
+    def remove(self, key):
+        with self.lock:
+            finding = self.findings.pop(key, None)
+            if finding is None:
+                return
+            self.scopes.get((finding.account, finding.region), set()).discard(key)
+            for field in self.indexed_fields:
+                keys = self.index[field].get(getattr(finding, field))
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self.index[field][getattr(finding, field)]
+
+    # Drop the findings for which affected returns True and add the result of a fresh or targeted
+    # scan; with scope, only the findings of that (account, region) are looked at
+    def replace_matching(self, affected, findings, scope=None):
+        with self.lock:
+            keys = self.findings if scope is None else self.scopes.get(scope, ())
+            for key in [k for k in keys if affected(self.findings[k])]:
+                self.remove(key)
+            for finding in findings:
+                self.add(finding)
+
+    def query(self, account=None, region=None, resourceType=None, min_cost=None, limit=None):
+        filters = {"account": account, "region": region, "resourceType": resourceType}
+        with self.lock:
+            candidates = None
+            # intersect the smallest index sets first
+            sets = sorted((self.index[field].get(value, set()) for field, value in filters.items() if value),
+                          key=len)
+            for keys in sets:
+                candidates = set(keys) if candidates is None else candidates & keys
+            if candidates is None:
+                candidates = self.findings.keys()
+            results = [self.findings[key] for key in candidates]
+        if min_cost is not None:
+            results = [f for f in results if savings(f) >= min_cost]
+        results.sort(key=savings, reverse=True)
+        return results[:limit] if limit else results
+
+    def __len__(self):
+        return len(self.findings)
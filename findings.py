@@ -0,0 +1,54 @@
+import csv
+import os
+from collections import namedtuple
+
+# every CSV report a scan can produce
+report_files = [
+    "eip.csv", "ebs.csv", "ebs_snapshots.csv", "elb.csv", "natgw.csv", "efs.csv",
+    "rds.csv", "rds_snapshots.csv", "ec2.csv", "dynamodb.csv", "vpc.csv"
+]
+
+Finding = namedtuple("Finding", [
+    "account", "region", "resourceType", "resourceId",
+    "currentType", "currentCost", "newType", "newCost"
+])
+
+def to_cost(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+# Turn a row of one of the report files into a Finding, the reports don't share one layout:
+# eip.csv rows carry no resource type column and vpc.csv has a schema of its own
+def normalize(file_name, row):
+    if file_name == "vpc.csv":
+        account, region, vpcId = row[0], row[1], row[2]
+        return Finding(account, region, "VPC", vpcId, "VPC", 0.0, "None", 0.0)
+    if len(row) == 7:
+        account, region, resourceId, currentType, currentCost, newType, newCost = row
+        return Finding(account, region, currentType, resourceId, currentType, to_cost(currentCost), newType, to_cost(newCost))
+    account, region, resourceType, resourceId, currentType, currentCost, newType, newCost = row[:8]
+    return Finding(account, region, resourceType, resourceId, currentType, to_cost(currentCost), newType, to_cost(newCost))
+
+def finding_key(finding):
+    return "|".join((finding.account, finding.region, finding.resourceType, finding.resourceId))
+
+def savings(finding):
+    return finding.currentCost - finding.newCost
+
+# Stream the findings of a report: a directory holding the report files, optionally only the report
+# files in names, or a single report file
+def read_findings(path, names=None):
+    if os.path.isdir(path):
+        files = [os.path.join(path, name) for name in report_files
+                 if (names is None or name in names) and os.path.exists(os.path.join(path, name))]
+    else:
+        files = [path]
+    for file_path in files:
+        with open(file_path, newline='') as csvfile:
+            reader = csv.reader(csvfile)
+            next(reader, None)  # header
+            for row in reader:
+                if row:
+                    yield normalize(os.path.basename(file_path), row)
@@ -0,0 +1,65 @@
+import os
+import sqlite3
+import threading
+import time
+from findings import normalize, report_files, savings
+
+# findings are inserted in transactions of this many rows
+batch_size = 1000
+
+class FindingsDatabase:
+    """Normalized findings of every run in one SQLite database, indexed for queries across runs, e.g.
+    SELECT * FROM findings WHERE run_id > (SELECT MAX(run_id) - 30 FROM runs) ORDER BY savings DESC LIMIT 100"""
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.pending = []
+        self.runId = None
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # WAL lets queries read the database while a run writes to it
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS runs (
+                run_id INTEGER PRIMARY KEY AUTOINCREMENT, started REAL, finished REAL, findings INTEGER)""")
+            self.db.execute("""CREATE TABLE IF NOT EXISTS findings (
+                run_id INTEGER, account TEXT, region TEXT, resource_type TEXT, resource_id TEXT,
+                current_type TEXT, current_cost REAL, new_type TEXT, new_cost REAL, savings REAL)""")
+            self.db.execute("CREATE INDEX IF NOT EXISTS findings_account ON findings (account)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS findings_region ON findings (region)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS findings_type ON findings (resource_type)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS findings_run ON findings (run_id, savings)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS findings_savings ON findings (savings)")
+
+    def start_run(self):
+        with self.lock, self.db:
+            self.runId = self.db.execute("INSERT INTO runs (started, findings) VALUES (?, 0)", (time.time(),)).lastrowid
+        return self.runId
+
+    # writeToCSV sink
+    def add(self, file_path, row):
+        if os.path.basename(file_path) not in report_files:
+            return
+        finding = normalize(os.path.basename(file_path), [str(v) for v in row])
+        with self.lock:
+            self.pending.append((self.runId,) + tuple(finding) + (savings(finding),))
+            if len(self.pending) >= batch_size:
+                self.flush()
+
+    # Insert the pending findings in one transaction, called with the lock held
+    def flush(self):
+        if not self.pending:
+            return
+        with self.db:
+            self.db.executemany("INSERT INTO findings VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", self.pending)
+            self.db.execute("UPDATE runs SET findings = findings + ? WHERE run_id = ?", (len(self.pending), self.runId))
+        self.pending = []
+
+    def finish_run(self):
+        with self.lock:
+            self.flush()
+            with self.db:
+                self.db.execute("UPDATE runs SET finished = ? WHERE run_id = ?", (time.time(), self.runId))
+
+    def close(self):
+        self.db.close()
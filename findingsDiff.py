@@ -0,0 +1,108 @@
+import csv
+import hashlib
+import itertools
+import os
+from array import array
+import numpy as np
+from findings import read_findings, finding_key, report_files, savings
+from logs import log
+
+diff_files = ["diff.csv", "diff_totals.csv"]
+
+# findings are matched in chunks, so the current report is never held in memory
+chunk_size = 65536
+# savings that differ by less than a cent are considered unchanged
+cost_tolerance = 0.01
+
+def key_hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little")
+
+class PriorFindings:
+    """Index of a previous report as sorted arrays of 64-bit key hashes, savings and positions
+    in the report. Keys themselves are not kept, resolved findings are re-read from the report."""
+
+    def __init__(self, path):
+        self.path = path
+        hashes, costs = array('Q'), array('d')
+        for finding in read_findings(path):
+            hashes.append(key_hash(finding_key(finding)))
+            costs.append(savings(finding))
+        hashes = np.frombuffer(hashes, dtype=np.uint64) if len(hashes) else np.zeros(0, dtype=np.uint64)
+        costs = np.frombuffer(costs, dtype=np.float64) if len(costs) else np.zeros(0, dtype=np.float64)
+        # duplicated keys keep their first occurrence
+        self.hashes, positions = np.unique(hashes, return_index=True)
+        self.costs = costs[positions]
+        self.positions = positions
+        self.seen = np.zeros(len(self.hashes), dtype=bool)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    # Look up a chunk of key hashes, returns the index of each hash or -1 when it is new
+    def match(self, hashes):
+        index = np.searchsorted(self.hashes, hashes)
+        index = np.minimum(index, max(len(self.hashes) - 1, 0))
+        found = (self.hashes[index] == hashes) if len(self.hashes) else np.zeros(len(hashes), dtype=bool)
+        self.seen[index[found]] = True
+        return np.where(found, index, -1)
+
+    # Stream the findings of the previous report that were not matched by the current one
+    def resolved(self):
+        unseen = np.zeros(len(self.seen), dtype=bool)
+        unseen[self.positions[~self.seen]] = True
+        for position, finding in enumerate(read_findings(self.path)):
+            if unseen[position]:
+                yield finding
+
+# Prior findings for which skip(finding) is true are not reported as resolved, e.g. the
+# findings of checks that were not run this time. A single prior report file is compared with
+# the report file of the same name in current_path only.
+def diff_findings(prior_path, current_path, output="diff.csv", totals_output="diff_totals.csv", skip=None):
+    prior = PriorFindings(prior_path)
+    totals = {"new": [0, 0.0], "resolved": [0, 0.0], "changed": [0, 0.0]}
+
+    with open(output, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['Status', 'Account', 'Region', 'ResourceType', 'ResourceId',
+                         'previousSavings', 'currentSavings', 'delta'])
+
+        name = os.path.basename(prior_path)
+        only = [name] if os.path.isfile(prior_path) and name in report_files else None
+        current = read_findings(current_path, only)
+        while True:
+            chunk = list(itertools.islice(current, chunk_size))
+            if not chunk:
+                break
+            hashes = np.array([key_hash(finding_key(f)) for f in chunk], dtype=np.uint64)
+            matches = prior.match(hashes)
+            for finding, index in zip(chunk, matches):
+                currentSavings = savings(finding)
+                if index < 0:
+                    status, previousSavings = "new", 0.0
+                else:
+                    previousSavings = float(prior.costs[index])
+                    if abs(currentSavings - previousSavings) < cost_tolerance:
+                        continue
+                    status = "changed"
+                delta = currentSavings - previousSavings
+                totals[status][0] += 1
+                totals[status][1] += delta
+                writer.writerow([status, finding.account, finding.region, finding.resourceType,
+                                 finding.resourceId, previousSavings, currentSavings, delta])
+
+        for finding in prior.resolved():
+            if skip is not None and skip(finding):
+                continue
+            previousSavings = savings(finding)
+            totals["resolved"][0] += 1
+            totals["resolved"][1] -= previousSavings
+            writer.writerow(["resolved", finding.account, finding.region, finding.resourceType,
+                             finding.resourceId, previousSavings, 0.0, -previousSavings])
+
+    with open(totals_output, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['Status', 'Count', 'delta'])
+        for status, (count, delta) in totals.items():
+            writer.writerow([status, count, delta])
+            log.info("%s: %s finding(s), %+.2f monthly savings", status, count, delta)
+    return totals
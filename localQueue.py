@@ -0,0 +1,81 @@
+import os
+import time
+import uuid
+
+class LocalQueue:
+    """SQS-compatible stand-in backed by a directory: every file is a message, received
+    messages are leased by moving them to inflight/ until they are deleted or their
+    visibility timeout runs out. A message that comes back carries its receive count in its
+    name (<id>.json~<count>). The QueueUrl arguments are accepted and ignored."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.inflight = os.path.join(directory, "inflight")
+        os.makedirs(self.inflight, exist_ok=True)
+        # receipt handle -> current path of a message whose lease was extended
+        self.handles = {}
+
+    def send_message(self, QueueUrl=None, MessageBody=""):
+        messageId = f"{time.time():017.6f}-{uuid.uuid4().hex}"
+        path = os.path.join(self.directory, messageId + ".json")
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(MessageBody)
+        os.replace(tmp, path)
+        return {"MessageId": messageId}
+
+    # Put messages whose lease expired back in the queue
+    def requeue_expired(self):
+        now = time.time()
+        for name in os.listdir(self.inflight):
+            expiry, _, original = name.partition("~")
+            try:
+                expired = float(expiry) < now
+            except ValueError:
+                continue
+            if expired:
+                try:
+                    os.replace(os.path.join(self.inflight, name), os.path.join(self.directory, original))
+                except FileNotFoundError:
+                    pass
+
+    def receive_message(self, QueueUrl=None, MaxNumberOfMessages=1, WaitTimeSeconds=0, VisibilityTimeout=30,
+                        AttributeNames=None):
+        deadline = time.time() + WaitTimeSeconds
+        while True:
+            self.requeue_expired()
+            messages = []
+            names = sorted(n for n in os.listdir(self.directory)
+                           if os.path.isfile(os.path.join(self.directory, n)) and not n.endswith(".tmp"))
+            for name in names:
+                if len(messages) >= MaxNumberOfMessages:
+                    break
+                messageId, _, count = name.partition("~")
+                receives = int(count or 0) + 1
+                leased = os.path.join(self.inflight, f"{time.time() + VisibilityTimeout:.6f}~{messageId}~{receives}")
+                try:
+                    # the rename is atomic, so only one consumer gets the message
+                    os.replace(os.path.join(self.directory, name), leased)
+                except FileNotFoundError:
+                    continue
+                with open(leased) as f:
+                    body = f.read()
+                messages.append({"MessageId": messageId, "ReceiptHandle": leased, "Body": body,
+                                 "Attributes": {"ApproximateReceiveCount": str(receives)}})
+            if messages or time.time() >= deadline:
+                return {"Messages": messages} if messages else {}
+            time.sleep(min(1, max(deadline - time.time(), 0)))
+
+    # Extend the lease of a received message, e.g. while a long work unit is processed
+    def change_message_visibility(self, QueueUrl=None, ReceiptHandle=None, VisibilityTimeout=30):
+        current = self.handles.get(ReceiptHandle, ReceiptHandle)
+        message = os.path.basename(current).partition("~")[2]
+        extended = os.path.join(self.inflight, f"{time.time() + VisibilityTimeout:.6f}~{message}")
+        os.replace(current, extended)
+        self.handles[ReceiptHandle] = extended
+
+    def delete_message(self, QueueUrl=None, ReceiptHandle=None):
+        try:
+            os.remove(self.handles.pop(ReceiptHandle, ReceiptHandle))
+        except FileNotFoundError:
+            pass
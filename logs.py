@@ -0,0 +1,89 @@
+import atexit
+import contextlib
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+
+# context fields added to every log record, set with log_context() or passed as extra={...}
+contextFields = ("account", "region", "check", "resource")
+
+log = logging.getLogger("aws-unused-resources")
+_context = contextvars.ContextVar("log_context", default={})
+_errors = contextvars.ContextVar("logged_errors", default=None)
+_listener = None
+
+# Add fields to the records logged inside the block, also by threads started with copy_context()
+@contextlib.contextmanager
+def log_context(**fields):
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+# Collect the errors logged inside the block, also by threads started with copy_context(): the checks
+# log the errors they recover from, this tells the caller that their result is incomplete
+@contextlib.contextmanager
+def recording_errors():
+    errors = []
+    token = _errors.set(errors)
+    try:
+        yield errors
+    finally:
+        _errors.reset(token)
+
+class ContextFilter(logging.Filter):
+    # runs in the thread that logs, before the record is queued, so the context of the caller is visible
+    def filter(self, record):
+        for field, value in _context.get().items():
+            if not hasattr(record, field):
+                setattr(record, field, value)
+        errors = _errors.get()
+        if errors is not None and record.levelno >= logging.ERROR:
+            errors.append(record.getMessage())
+        return True
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        line = super().format(record)
+        fields = " ".join(f"{field}={getattr(record, field)}" for field in contextFields if getattr(record, field, None))
+        return f"{line} [{fields}]" if fields else line
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        document = {"time": self.formatTime(record), "level": record.levelname, "message": record.getMessage()}
+        for field in contextFields:
+            if getattr(record, field, None):
+                document[field] = getattr(record, field)
+        if record.exc_info:
+            document["exception"] = self.formatException(record.exc_info)
+        return json.dumps(document, default=str)
+
+# Records are put on a queue by the scan threads and written by one listener thread, so a slow
+# terminal or pipe never blocks a check
+def setup_logging(level="INFO", json_output=False, path=None):
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+    output = logging.FileHandler(path) if path else logging.StreamHandler(sys.stdout)
+    output.setLevel(level.upper())
+    output.setFormatter(JsonFormatter() if json_output else TextFormatter("%(asctime)s %(levelname)s %(message)s"))
+    records = queue.SimpleQueue()
+    handler = logging.handlers.QueueHandler(records)
+    handler.addFilter(ContextFilter())
+    log.handlers[:] = [handler]
+    # errors always reach the filter, for recording_errors(), the output drops what is below level
+    log.setLevel(min(logging.getLevelName(level.upper()), logging.ERROR))
+    log.propagate = False
+    _listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+def stop_logging():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
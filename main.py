@@ -1,71 +1,91 @@
 # identify the following unused AWS resources:
 # - EBS volumes
+# - EBS snapshots
 # - EIPs
 # - Load Balancers
 # - EFS volumes
 # - NAT Gateways
 # - RDS instances
 # - RDS snapshots
+# - EC2 instances
 # - DynamoDB tables
 # - VPCs
 
 import os
+import shutil
+import time
+import threading
 import boto3
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from resourceTypes.ebs_volume import EBSVolume
+from resourceTypes.ebs_snapshot import EBSSnapshot, get_snapshot_rates, image_snapshot_ids, iter_snapshots, volume_ids
 from resourceTypes.efs import EFSFileSystem
 from resourceTypes.elastic_ip import ElasticIP
-from resourceTypes.load_balancer import ElasticLoadBalancer
+from resourceTypes.load_balancer import ElasticLoadBalancer, add_registered_targets
 from resourceTypes.nat_gateway import NATGateway
-from resourceTypes.rds import DatabaseInstance, RDSSnapshot
+from resourceTypes.rds import DatabaseInstance, SnapshotIndex
+from resourceTypes.rds_rightsizing import rightsize_classes
 from resourceTypes.dynamodb import DynamoDBTable
 from resourceTypes.vpc import VPC
 from resourceTypes.ec2_instance import EC2Instance
+from resourceTypes.storage_volume import fleetWhatIf
+from resourceTypes.triage import IDLE, triage
+from resourceTypes.usage_windows import set_windows, windowsFile, windowsHeader
+from resourceTypes.quantile_sketch import disable_sketch_store, save_sketches, sketchFile
 from uploadFile import upload_file
-from writeToCSV import write_to_csv
-
-def clean_old_files():
-    csv_files = [
-        "eip.csv", "ebs.csv", "elb.csv", "natgw.csv", "efs.csv", 
-        "rds.csv", "rds_snapshots.csv", "ec2.csv", "dynamodb.csv", "vpc.csv"
-    ]
-    for file in csv_files:
-        if os.path.exists(file):
-            os.remove(file)
+from writeToCSV import add_sink, write_to_csv
+import clients
+from clients import get_client
+from serve import parse_duration, parse_schedules, serve
+from findings import report_files
+from organization import assume_role, get_account_ids, get_sessions, session_from
+from findingsDiff import diff_files, diff_findings
+from findingsDb import FindingsDatabase
+from curCosts import CurIndex, cur_files, join_findings
+from policy import apply_policy
+from progress import progress
+from logs import log, log_context, setup_logging
+import resourceFilter
+from recording import RawSnapshot, Recorder, RecordingSession, ReplaySession
+import pipeline
+from pipeline import run_pipeline
+from distributed import coordinate, open_work_queue, results_queue_url, work
+from scanPlan import (Deadline, checkForType, checkServices, estimates_from_report, inventory_all, inventory_share, plan,
+                      run_with_limit, summary_files, write_run_summary, write_unscanned)
 
-def get_account_ids():
-    accounts = []
-    org = boto3.client('organizations')
-    next_token = None
-    
-    while True:
-        if next_token is None:
-            resp = org.list_accounts()
-        else:
-            resp = org.list_accounts(NextToken=next_token)
-        
-        for acc in resp['Accounts']:
-            accounts.append(acc['Id'])
+# When archive_dir is set, the reports of the previous run are moved there instead of removed.
+# The archive is emptied first, a report the previous run did not write must not stay from an older run.
+def clean_old_files(archive_dir=None):
+    if archive_dir:
+        os.makedirs(archive_dir, exist_ok=True)
+        if any(os.path.exists(file) for file in report_files):
+            for file in report_files:
+                if os.path.exists(os.path.join(archive_dir, file)):
+                    os.remove(os.path.join(archive_dir, file))
+    for file in report_files + diff_files + summary_files + cur_files + [windowsFile]:
+        if os.path.exists(file):
+            if archive_dir and file in report_files:
+                shutil.move(file, os.path.join(archive_dir, file))
+            else:
+                os.remove(file)
 
-        if 'NextToken' not in resp:
-            break
-        next_token = resp['NextToken']
+# Usage and idleness of a resource in every window of --windows
+def write_windows(account, region, resourceType, resourceId, rows):
+    for metric, days, value, idle in rows:
+        write_to_csv(windowsFile, account, region, resourceType, resourceId, metric, days, value, idle, header=windowsHeader)
 
-    return accounts
+def get_session_for_account(account, sts_client, own_account):
+    if account == own_account:
+        # keep the session set up by --profile
+        return boto3.DEFAULT_SESSION or boto3.Session()
+    return session_from(assume_role(account, sts_client))
 
-def get_session_for_account(account, sts_client):
-    if account == sts_client.get_caller_identity()['Account']:
-        return boto3.Session()
-    
-    creds = sts_client.assume_role(
-        RoleArn=f'arn:aws:iam::{account}:role/OrganizationAccountAccessRole',
-        RoleSessionName='unusedResources'
-    )
-    return boto3.Session(
-        aws_access_key_id=creds['Credentials']['AccessKeyId'],
-        aws_secret_access_key=creds['Credentials']['SecretAccessKey'],
-        aws_session_token=creds['Credentials']['SessionToken']
-    )
+# Session of a member account, its CloudWatch calls go through the monitoring account when one is set
+def member_session(account, sts_client, own_account):
+    session = get_session_for_account(account, sts_client, own_account)
+    clients.register_account(session, account)
+    return session
 
 def get_regions(region_var=None):
     if region_var:
@@ -74,247 +94,650 @@ def get_regions(region_var=None):
     ac = boto3.client('account')
     return ac.list_regions(RegionOptStatusContains=['ENABLED','ENABLED_BY_DEFAULT'])
 
-def check_ebs_volumes(region, account):
+def check_ebs_volumes(region, account, session=None, ids=None):
     try:
-        ec2client = boto3.client('ec2', region_name=region)
-        cwclient = boto3.client('cloudwatch', region_name=region)
+        ec2client = get_client('ec2', region, session)
+        cwclient = get_client('cloudwatch', region, session)
         
-        volumes = ec2client.describe_volumes()
-        for volume in volumes["Volumes"]:
-            try:
-                id = volume['VolumeId']
-                print("Volume found: " + id)
-                v = EBSVolume(id, ec2client, cwclient)
-                if v.inUse() == False:
-                    volumeSavings = v.getSavings()
-                    write_to_csv("ebs.csv", account, region, "EBSVolume", id, 
-                               volumeSavings['currentType'], volumeSavings['currentPrice'], 
-                               volumeSavings['newType'], volumeSavings['newPrice'])
-            except Exception as error:
-                print(f"Error processing volume {id}: {error}")
+        # ids restricts the check to these resources, e.g. for event driven rescans
+        filters = ([{'Name': 'volume-id', 'Values': ids}] if ids else []) + resourceFilter.ec2_filters()
+        volumes = []
+        for page in ec2client.get_paginator('describe_volumes').paginate(Filters=filters):
+            volumes.extend(v for v in page["Volumes"] if resourceFilter.matches(v.get("Tags"), v["Size"]))
+
+        # price the whole region's volumes in one vectorized pass
+        whatIf = fleetWhatIf([v["VolumeType"] for v in volumes], [v["Size"] for v in volumes],
+                             [v.get("Iops") for v in volumes], [v.get("Throughput") for v in volumes], region)
+        # unattached volumes are reported from the describe data, only attached ones need metrics
+        verdicts = [triage(EBSVolume, volume) for volume in volumes]
+
+        def evaluate(n):
+            volume = volumes[n]
+            id = volume['VolumeId']
+            with log_context(resource=id):
+                try:
+                    progress.tick("ebs")
+                    log.debug("Volume found: %s", id)
+                    v = EBSVolume(volume, ec2client, cwclient, float(whatIf["currentPrice"][n]))
+                    if verdicts[n] == IDLE:
+                        volumeSavings = v.getSavings()
+                        write_to_csv("ebs.csv", account, region, "EBSVolume", id,
+                                   volumeSavings['currentType'], volumeSavings['currentPrice'],
+                                   volumeSavings['newType'], volumeSavings['newPrice'])
+                        return
+                    inUse = v.inUse()
+                    write_windows(account, region, "EBSVolume", id, v.windowUsage())
+                    if inUse == False:
+                        volumeSavings = v.getSavings()
+                        write_to_csv("ebs.csv", account, region, "EBSVolume", id, 
+                                   volumeSavings['currentType'], volumeSavings['currentPrice'], 
+                                   volumeSavings['newType'], volumeSavings['newPrice'])
+                except Exception as error:
+                    log.error("Error processing volume %s: %s", id, error)
+
+        # the volumes are evaluated on a worker pool, idle ones first
+        run_pipeline(sorted(range(len(volumes)), key=lambda n: verdicts[n] != IDLE), evaluate)
     except Exception as error:
-        print(f"Error checking EBS volumes in {region}: {error}")
+        log.error("Error checking EBS volumes in %s: %s", region, error)
 
-def check_elastic_ips(region, account):
+def check_ebs_snapshots(region, account, session=None, ids=None):
     try:
-        ec2client = boto3.client('ec2', region_name=region)
+        ec2client = get_client('ec2', region, session)
+
+        # the volumes and AMIs of the region are listed once, every snapshot is matched against these sets
+        volumeIds = volume_ids(ec2client)
+        imageSnapshotIds = image_snapshot_ids(ec2client)
+        rates = get_snapshot_rates(region)
+        for snapshot in iter_snapshots(ec2client, ids, resourceFilter.ec2_filters()):
+            if not resourceFilter.matches(snapshot.get('Tags'), snapshot['VolumeSize']):
+                continue
+            with log_context(resource=snapshot['SnapshotId']):
+                try:
+                    id = snapshot['SnapshotId']
+                    progress.tick("snapshots")
+                    s = EBSSnapshot(snapshot, volumeIds, imageSnapshotIds, rates)
+                    if s.isUnused():
+                        snapshotSavings = s.getSavings()
+                        write_to_csv("ebs_snapshots.csv", account, region, "EBSSnapshot", id,
+                                   snapshotSavings['currentType'], snapshotSavings['currentPrice'],
+                                   snapshotSavings['newType'], snapshotSavings['newPrice'])
+                except Exception as error:
+                    log.error("Error processing snapshot %s: %s", id, error)
+    except Exception as error:
+        log.error("Error checking EBS snapshots in %s: %s", region, error)
+
+def check_elastic_ips(region, account, session=None, ids=None):
+    try:
+        ec2client = get_client('ec2', region, session)
         
-        eips = ec2client.describe_addresses()
+        filters = ([{'Name': 'allocation-id', 'Values': ids}] if ids else []) + resourceFilter.ec2_filters()
+        eips = ec2client.describe_addresses(Filters=filters)
         for eip in eips["Addresses"]:
-            try:
-                eipId = eip['AllocationId']
-                print("EIP found: " + eipId)
-                eip = ElasticIP(eipId, ec2client)
-                if eip.inUse() == False:
-                    eipSavings = eip.getSavings()
-                    write_to_csv("eip.csv", account, region, eipId, 
-                               eipSavings['currentType'], eipSavings['currentPrice'], 
-                               eipSavings['newType'], eipSavings['newPrice'])
-            except Exception as error:
-                print(f"Error processing EIP {eipId}: {error}")
+            if not resourceFilter.matches(eip.get('Tags')):
+                continue
+            with log_context(resource=eip['AllocationId']):
+                try:
+                    eipId = eip['AllocationId']
+                    progress.tick("eip")
+                    log.debug("EIP found: %s", eipId)
+                    address = ElasticIP(eipId, ec2client, eip)
+                    if triage(ElasticIP, eip) == IDLE:
+                        eipSavings = address.getSavings()
+                        write_to_csv("eip.csv", account, region, eipId, 
+                                   eipSavings['currentType'], eipSavings['currentPrice'], 
+                                   eipSavings['newType'], eipSavings['newPrice'])
+                except Exception as error:
+                    log.error("Error processing EIP %s: %s", eipId, error)
     except Exception as error:
-        print(f"Error checking Elastic IPs in {region}: {error}")
+        log.error("Error checking Elastic IPs in %s: %s", region, error)
 
-def check_load_balancers(region, account):
+def check_load_balancers(region, account, session=None, ids=None):
     try:
-        elbv2client = boto3.client('elbv2', region_name=region)
-        cwclient = boto3.client('cloudwatch', region_name=region)
+        elbv2client = get_client('elbv2', region, session)
+        cwclient = get_client('cloudwatch', region, session)
         
-        elbs = elbv2client.describe_load_balancers()
-        for elb in elbs["LoadBalancers"]:
-            try:
-                if elb["State"]["Code"] == "active":
-                    lbId = elb["LoadBalancerArn"].split('/',1)[1]
-                    print("LB found: " + lbId)
-                    lb = ElasticLoadBalancer(elb["LoadBalancerArn"], elbv2client, cwclient)
-                    if lb.inUse() == False:
-                        lbSavings = lb.getSavings()
-                        write_to_csv("elb.csv", account, region, "ELB", lbId, 
-                                   lbSavings['currentType'], lbSavings['currentPrice'], 
-                                   lbSavings['newType'], lbSavings['newPrice'])
-            except Exception as error:
-                print(f"Error processing Load Balancer {lbId}: {error}")
+        # describe_load_balancers returns no tags, they come from one tagging API listing of the region
+        taggedArns = resourceFilter.tagged_arns("elb", region, session)
+        elbs = [elb for page in elbv2client.get_paginator('describe_load_balancers').paginate()
+                for elb in page["LoadBalancers"]]
+        add_registered_targets(elbv2client, elbs)
+
+        def evaluate(elb):
+            lbId = elb["LoadBalancerArn"].split('/',1)[1]
+            with log_context(resource=lbId):
+                try:
+                    if elb["State"]["Code"] == "active":
+                        progress.tick("elb")
+                        log.debug("LB found: %s", lbId)
+                        verdict = triage(ElasticLoadBalancer, elb)
+                        lb = ElasticLoadBalancer(elb["LoadBalancerArn"], elbv2client, cwclient, verdict)
+                        if verdict is None:
+                            write_windows(account, region, "ELB", lbId, lb.windowUsage())
+                        if lb.inUse() == False:
+                            lbSavings = lb.getSavings()
+                            write_to_csv("elb.csv", account, region, "ELB", lbId, 
+                                       lbSavings['currentType'], lbSavings['currentPrice'], 
+                                       lbSavings['newType'], lbSavings['newPrice'])
+                except Exception as error:
+                    log.error("Error processing Load Balancer %s: %s", lbId, error)
+
+        run_pipeline((elb for elb in elbs if not (ids and elb["LoadBalancerArn"] not in ids)
+                      and (taggedArns is None or elb["LoadBalancerArn"] in taggedArns)), evaluate)
     except Exception as error:
-        print(f"Error checking Load Balancers in {region}: {error}")
+        log.error("Error checking Load Balancers in %s: %s", region, error)
 
-def check_nat_gateways(region, account):
+def check_nat_gateways(region, account, session=None, ids=None):
     try:
-        ec2client = boto3.client('ec2', region_name=region)
-        cwclient = boto3.client('cloudwatch', region_name=region)
+        ec2client = get_client('ec2', region, session)
+        cwclient = get_client('cloudwatch', region, session)
         
-        natgws = ec2client.describe_nat_gateways()
-        for natgw in natgws['NatGateways']:
-            try:
-                if natgw['State'] == 'available':
-                    natgwId = natgw['NatGatewayId']
-                    print("NATGW found: " + natgwId)
-                    natgw = NATGateway(natgwId, ec2client, cwclient)
-                    if natgw.inUse() == False:
-                        natgwSavings = natgw.getSavings()
-                        write_to_csv("natgw.csv", account, region, "NATGW", natgwId, 
-                                   natgwSavings['currentType'], natgwSavings['currentPrice'], 
-                                   natgwSavings['newType'], natgwSavings['newPrice'])
-            except Exception as error:
-                print(f"Error processing NAT Gateway {natgwId}: {error}")
+        filters = ([{'Name': 'nat-gateway-id', 'Values': ids}] if ids else []) + resourceFilter.ec2_filters()
+
+        # the next page is listed while the gateways of the previous one are evaluated
+        def discover():
+            for page in ec2client.get_paginator('describe_nat_gateways').paginate(Filter=filters):
+                for natgw in page['NatGateways']:
+                    if resourceFilter.matches(natgw.get('Tags')):
+                        yield natgw
+
+        def evaluate(natgw):
+            natgwId = natgw['NatGatewayId']
+            with log_context(resource=natgwId):
+                try:
+                    if natgw['State'] == 'available':
+                        progress.tick("natgw")
+                        log.debug("NATGW found: %s", natgwId)
+                        natgw = NATGateway(natgwId, ec2client, cwclient)
+                        write_windows(account, region, "NATGW", natgwId, natgw.windowUsage())
+                        if natgw.inUse() == False:
+                            natgwSavings = natgw.getSavings()
+                            write_to_csv("natgw.csv", account, region, "NATGW", natgwId, 
+                                       natgwSavings['currentType'], natgwSavings['currentPrice'], 
+                                       natgwSavings['newType'], natgwSavings['newPrice'])
+                except Exception as error:
+                    log.error("Error processing NAT Gateway %s: %s", natgwId, error)
+
+        run_pipeline(discover(), evaluate)
     except Exception as error:
-        print(f"Error checking NAT Gateways in {region}: {error}")
+        log.error("Error checking NAT Gateways in %s: %s", region, error)
 
-def check_efs_filesystems(region, account):
+def check_efs_filesystems(region, account, session=None, ids=None):
     try:
-        efsclient = boto3.client('efs', region_name=region)
-        cwclient = boto3.client('cloudwatch', region_name=region)
+        efsclient = get_client('efs', region, session)
+        cwclient = get_client('cloudwatch', region, session)
         
-        filesystems = efsclient.describe_file_systems()['FileSystems']
-        for fs in filesystems:
-            try:
-                print("FileSystem found: " + fs['FileSystemId'])
-                i = EFSFileSystem(fs['FileSystemId'], efsclient, cwclient)
-                if i.isUsed() == False:
-                    efsSavings = i.getSavings()
-                    write_to_csv("efs.csv", account, region, "EFSFileSystem", fs['FileSystemId'], 
-                               efsSavings['currentType'], efsSavings['currentPrice'], 
-                               efsSavings['newType'], efsSavings['newPrice'])
-            except Exception as error:
-                print(f"Error processing EFS {fs['FileSystemId']}: {error}")
+
+        def discover():
+            for page in efsclient.get_paginator('describe_file_systems').paginate():
+                for fs in page['FileSystems']:
+                    if ids and fs['FileSystemId'] not in ids:
+                        continue
+                    if resourceFilter.matches(fs.get('Tags'), fs['SizeInBytes']['Value'] / 2**30):
+                        yield fs
+
+        def evaluate(fs):
+            with log_context(resource=fs['FileSystemId']):
+                try:
+                    log.debug("FileSystem found: %s", fs['FileSystemId'])
+                    progress.tick("efs")
+                    verdict = triage(EFSFileSystem, fs)
+                    i = EFSFileSystem(fs['FileSystemId'], efsclient, cwclient, verdict)
+                    if verdict is None:
+                        write_windows(account, region, "EFSFileSystem", fs['FileSystemId'], i.windowUsage())
+                    if i.isUsed() == False:
+                        efsSavings = i.getSavings()
+                        write_to_csv("efs.csv", account, region, "EFSFileSystem", fs['FileSystemId'], 
+                                   efsSavings['currentType'], efsSavings['currentPrice'], 
+                                   efsSavings['newType'], efsSavings['newPrice'])
+                except Exception as error:
+                    log.error("Error processing EFS %s: %s", fs['FileSystemId'], error)
+
+        run_pipeline(discover(), evaluate)
     except Exception as error:
-        print(f"Error checking EFS in {region}: {error}")
+        log.error("Error checking EFS in %s: %s", region, error)
 
-def check_rds_instances(region, account):
+def check_rds_instances(region, account, session=None, ids=None):
     try:
-        rdsclient = boto3.client('rds', region_name=region)
-        cwclient = boto3.client('cloudwatch', region_name=region)
+        rdsclient = get_client('rds', region, session)
+        cwclient = get_client('cloudwatch', region, session)
         
-        dbs = rdsclient.describe_db_instances()
-        for db in dbs['DBInstances']:
-            try:
-                if db['DBInstanceStatus'] == 'available':
-                    dbId = db['DBInstanceIdentifier']
-                    print("DB found: " + dbId)
-                    dbi = DatabaseInstance(dbId, region, cwclient, rdsclient)
-                    if dbi.isIdle():
-                        computeSavings = dbi.rightsizeCompute()
-                        storageSavings = dbi.rightsizeStorage()
-                        write_to_csv("rds.csv", account, region, "RDSInstance", dbId, 
-                                   computeSavings['currentInstanceType'], computeSavings['currentInstancePrice'], 
-                                   computeSavings['newInstanceType'], computeSavings['newInstancePrice'])
-                        write_to_csv("rds.csv", account, region, "RDSStorageVolume", dbId, 
-                                   storageSavings['currentType'], storageSavings['currentPrice'], 
-                                   storageSavings['newType'], storageSavings['newPrice'])
-                    
-                    # Handle unused snapshots
-                    for snapshot in dbi.unused_snapshots:
+        # instances and snapshots are listed once for the whole region
+        index = SnapshotIndex(rdsclient, region, ids)
+        busy = []
+
+        def evaluate(db):
+            dbId = db['DBInstanceIdentifier']
+            with log_context(resource=dbId):
+                try:
+                    # stopped instances are triaged as idle, only available ones need their connections
+                    verdict = triage(DatabaseInstance, db)
+                    if db['DBInstanceStatus'] == 'available' or verdict == IDLE:
+                        progress.tick("rds")
+                        log.debug("DB found: %s", dbId)
+                        dbi = DatabaseInstance(db, region, cwclient, rdsclient, verdict)
+                        if verdict is None:
+                            write_windows(account, region, "RDSInstance", dbId, dbi.windowUsage())
+                        if dbi.isIdle():
+                            computeSavings = dbi.rightsizeCompute()
+                            storageSavings = dbi.rightsizeStorage()
+                            if computeSavings is not None:
+                                write_to_csv("rds.csv", account, region, "RDSInstance", dbId, 
+                                           computeSavings['currentInstanceType'], computeSavings['currentInstancePrice'], 
+                                           computeSavings['newInstanceType'], computeSavings['newInstancePrice'])
+                            write_to_csv("rds.csv", account, region, "RDSStorageVolume", dbId, 
+                                       storageSavings['currentType'], storageSavings['currentPrice'], 
+                                       storageSavings['newType'], storageSavings['newPrice'])
+                        elif dbi.instanceType != "db.serverless":
+                            busy.append(dbi)
+                except Exception as error:
+                    log.error("Error processing RDS instance %s: %s", dbId, error)
+
+        run_pipeline((db for db in index.instances.values()
+                      if resourceFilter.matches(db.get('TagList'), db.get('AllocatedStorage'))), evaluate)
+
+        # Busy instances are rightsized together, in one vectorized pass over the classes of the region
+        recommendations = rightsize_classes(busy, [dbi.rightsizingUsage() for dbi in busy])
+        for dbi, computeSavings in zip(busy, recommendations):
+            if computeSavings and computeSavings['newInstanceType'] != computeSavings['currentInstanceType']:
+                write_to_csv("rds.csv", account, region, "RDSInstance", dbi.identifier,
+                           computeSavings['currentInstanceType'], computeSavings['currentInstancePrice'],
+                           computeSavings['newInstanceType'], computeSavings['newInstancePrice'])
+
+        # Handle unused snapshots, those of deleted instances and clusters are reported as deleted-<snapshot>
+        for snapshot in index:
+            if not resourceFilter.matches(snapshot.tags, snapshot.storage_size):
+                continue
+            with log_context(resource=snapshot.snapshot_id):
+                try:
+                    progress.tick("rds")
+                    if snapshot.is_unused(index):
+                        source = snapshot.source_id if index.source_exists(snapshot) else "deleted"
                         snapshotSavings = snapshot.get_savings()
                         write_to_csv("rds_snapshots.csv", account, region, "RDSSnapshot", 
-                                   f"{dbId}-{snapshot.snapshot_id}", snapshotSavings['currentType'], 
+                                   f"{source}-{snapshot.snapshot_id}", snapshotSavings['currentType'], 
                                    snapshotSavings['currentPrice'], snapshotSavings['newType'], 
                                    snapshotSavings['newPrice'])
-            except Exception as error:
-                print(f"Error processing RDS instance {dbId}: {error}")
-
-        # Also check for snapshots of deleted instances
-        try:
-            all_snapshots = rdsclient.describe_db_snapshots()['DBSnapshots']
-            checked_instances = set(db['DBInstanceIdentifier'] for db in dbs['DBInstances'])
-            
-            for snapshot in all_snapshots:
-                if snapshot['DBInstanceIdentifier'] not in checked_instances:
-                    try:
-                        snapshot_obj = RDSSnapshot(snapshot['DBSnapshotIdentifier'], rdsclient)
-                        if snapshot_obj.is_unused():
-                            snapshotSavings = snapshot_obj.get_savings()
-                            write_to_csv("rds_snapshots.csv", account, region, "RDSSnapshot", 
-                                       f"deleted-{snapshot_obj.snapshot_id}", snapshotSavings['currentType'], 
-                                       snapshotSavings['currentPrice'], snapshotSavings['newType'], 
-                                       snapshotSavings['newPrice'])
-                    except Exception as error:
-                        print(f"Error processing snapshot {snapshot['DBSnapshotIdentifier']}: {error}")
-        except Exception as error:
-            print(f"Error checking snapshots for deleted instances: {error}")
+                except Exception as error:
+                    log.error("Error processing snapshot %s: %s", snapshot.snapshot_id, error)
     except Exception as error:
-        print(f"Error checking RDS instances in {region}: {error}")
+        log.error("Error checking RDS instances in %s: %s", region, error)
 
-def check_dynamodb_tables(region, account_id):
-    dynamodb = boto3.client('dynamodb', region_name=region)
-    cloudwatch = boto3.client('cloudwatch', region_name=region)
+def check_dynamodb_tables(region, account_id, session=None, ids=None):
+    dynamodb = get_client('dynamodb', region, session)
+    cloudwatch = get_client('cloudwatch', region, session)
 
     try:
         paginator = dynamodb.get_paginator('list_tables')
-        for page in paginator.paginate():
-            for table_name in page['TableNames']:
-                table = DynamoDBTable(table_name, region, cloudwatch, dynamodb)
-                if table.is_unused():
-                    savings = table.get_savings()
-                    write_to_csv("dynamodb.csv", account_id, region, "DynamoDBTable", table_name,
-                               savings['currentType'], savings['currentPrice'],
-                               savings['newType'], savings['newPrice'])
+        pages = [{'TableNames': ids}] if ids else paginator.paginate()
+        taggedArns = resourceFilter.tagged_arns("dynamodb", region, session)
+        # aws, aws-cn or aws-us-gov, the tagging API returns the ARNs of the region's partition
+        partition = dynamodb.meta.partition
+
+        # tables are described and their usage fetched on the worker pool while the next page is listed
+        def discover():
+            for page in pages:
+                for table_name in page['TableNames']:
+                    if taggedArns is None or f"arn:{partition}:dynamodb:{region}:{account_id}:table/{table_name}" in taggedArns:
+                        yield table_name
+
+        def evaluate(table_name):
+            with log_context(resource=table_name):
+                try:
+                    progress.tick("dynamodb")
+                    table = DynamoDBTable(table_name, region, cloudwatch, dynamodb)
+                    write_windows(account_id, region, "DynamoDBTable", table_name, table.window_usage())
+                    if table.is_unused():
+                        savings = table.get_savings()
+                        write_to_csv("dynamodb.csv", account_id, region, "DynamoDBTable", table_name,
+                                   savings['currentType'], savings['currentPrice'],
+                                   savings['newType'], savings['newPrice'])
+                except Exception as e:
+                    log.error("Error processing DynamoDB table %s: %s", table_name, e)
+
+        run_pipeline(discover(), evaluate)
     except Exception as e:
-        print(f"Error checking DynamoDB tables in {region}: {str(e)}")
+        log.error("Error checking DynamoDB tables in %s: %s", region, e)
+
+def check_ec2_instances(region, account, session=None, ids=None):
+    try:
+        ec2client = get_client('ec2', region, session)
+        cwclient = get_client('cloudwatch', region, session)
+
+        instances = []
+        paginator = ec2client.get_paginator('describe_instances')
+        filters = [{'Name': 'instance-state-name', 'Values': ['running']}]
+        if ids:
+            filters.append({'Name': 'instance-id', 'Values': ids})
+        filters.extend(resourceFilter.ec2_filters())
+        for page in paginator.paginate(Filters=filters):
+            for reservation in page['Reservations']:
+                instances.extend(i for i in reservation['Instances'] if resourceFilter.matches(i.get('Tags')))
 
-def check_vpc(region, account_id):
+        # fetch the usage of the whole fleet in batched requests instead of once per instance
+        metrics = EC2Instance.fetch_fleet_metrics(cwclient, [i['InstanceId'] for i in instances])
+        for instance in instances:
+            with log_context(resource=instance['InstanceId']):
+                try:
+                    instanceId = instance['InstanceId']
+                    progress.tick("ec2")
+                    i = EC2Instance(instance, region, metrics[instanceId])
+                    write_windows(account, region, "EC2Instance", instanceId, i.windowUsage())
+                    ec2Savings = i.getSavings() if i.isIdle() else None
+                    if ec2Savings is not None:
+                        write_to_csv("ec2.csv", account, region, "EC2Instance", instanceId,
+                                   ec2Savings['currentType'], ec2Savings['currentPrice'],
+                                   ec2Savings['newType'], ec2Savings['newPrice'])
+                except Exception as error:
+                    log.error("Error processing EC2 instance %s: %s", instanceId, error)
+    except Exception as error:
+        log.error("Error checking EC2 instances in %s: %s", region, error)
+
+def check_vpc(region, account_id, session=None):
     vpc = VPC()
-    vpc.check_vpc_usage(region, account_id)
+    vpc.check_vpc_usage(region, account_id, get_client('ec2', region, session))
     vpc.write_to_csv()
 
+# every check that runs for a region, in scan order
+checks = {
+    "ebs": check_ebs_volumes,
+    "snapshots": check_ebs_snapshots,
+    "ec2": check_ec2_instances,
+    "eip": check_elastic_ips,
+    "elb": check_load_balancers,
+    "natgw": check_nat_gateways,
+    "efs": check_efs_filesystems,
+    "rds": check_rds_instances,
+    "dynamodb": check_dynamodb_tables,
+    "vpc": check_vpc,
+}
+
 def main():
     parser = argparse.ArgumentParser()
+    parser.add_argument("mode", nargs="?", default="scan", choices=["scan", "collect", "analyze", "serve", "events", "coordinator", "worker"],
+                        help="scan once and write the reports; collect: scan and also keep every API response in a raw snapshot; "
+                             "analyze: write the reports from a raw snapshot without calling AWS; "
+                             "serve: stay resident, rescan on a schedule and answer queries over HTTP; "
+                             "events: like serve, but after the first scan only rescan resources named in CloudTrail events; "
+                             "coordinator: send the checks to the workers of --work-queue and write the reports from their findings; "
+                             "worker: scan the checks of --work-queue")
     parser.add_argument("--org", help="if true, fetch resources from all accounts in the organization")
+    parser.add_argument("--ou", help="only scan the accounts below these organizational units, comma separated IDs or names")
+    parser.add_argument("--accounts", help="only scan these accounts, comma separated IDs")
+    parser.add_argument("--org-cache-ttl", type=parse_duration, default="24h", help="reuse the cached organization tree for this long, e.g. 1h; 0 refreshes it")
     parser.add_argument("--s3", help="store the reports in a bucket at this location")
     parser.add_argument("--region", help="only scan resources in this region")
     parser.add_argument("--profile", help="AWS profile name")
+    parser.add_argument("--snapshot", default="raw_snapshot", help="collect/analyze mode: directory of the raw snapshot")
+    parser.add_argument("--policy", help="JSON file overriding the thresholds of the checks, e.g. {\"ec2_instance\": {\"cpu_idle_threshold\": 10}}")
+    parser.add_argument("--include-tags", help="only scan resources with these tags, e.g. env=prod,env=staging,team; values of one key are alternatives")
+    parser.add_argument("--exclude-tags", help="skip resources with any of these tags, e.g. keep=true")
+    parser.add_argument("--min-size", type=float, help="skip volumes, snapshots, file systems and databases smaller than this many GiB")
+    parser.add_argument("--windows", help="also report usage and idleness over these lookback windows in days, e.g. 7,14,30,90")
+    parser.add_argument("--cur", help="Cost and Usage Report export (CSV, CSV.gz or Parquet file, or a directory of them) to join the actual cost of every finding from")
+    parser.add_argument("--db", help="also store the findings of this run in this SQLite database, e.g. findings.sqlite")
+    parser.add_argument("--diff-against", help="report only new, resolved and cost-changed findings compared to the reports in this directory or file")
+    parser.add_argument("--deadline", type=parse_duration, help="stop scanning after this long, e.g. 30m; the most expensive checks run first and the rest are listed in unscanned.csv")
+    parser.add_argument("--priority-from", help="order the scan by the savings of the reports in this directory or file, defaults to --diff-against")
+    parser.add_argument("--progress-log", help="append progress events as newline-delimited JSON to this file, e.g. progress.ndjson")
+    parser.add_argument("--monitoring-account", help="query the metrics of all accounts from this CloudWatch cross-account observability monitoring account")
+    parser.add_argument("--metric-streams", help="read the metrics from this directory of CloudWatch metric stream files (JSON or OpenTelemetry, optionally gzipped) instead of calling CloudWatch")
+    parser.add_argument("--parallel", type=int, default=1, help="number of checks scanned at the same time")
+    parser.add_argument("--pipeline-workers", type=int, default=8, help="resources of one check evaluated at the same time while the next page is listed")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"], help="DEBUG also logs every resource that is evaluated")
+    parser.add_argument("--log-json", action="store_true", help="log one JSON document per line, with the account, region, check and resource as fields")
+    parser.add_argument("--log-file", help="write the log to this file instead of stdout")
+    parser.add_argument("--check-timeout", type=parse_duration, help="stop a check of one region after this long, e.g. 10m; it is reported as incomplete")
+    parser.add_argument("--connect-timeout", type=float, default=10, help="seconds to wait for a connection to an AWS endpoint")
+    parser.add_argument("--read-timeout", type=float, default=60, help="seconds to wait for the response of an AWS API call")
+    parser.add_argument("--breaker-threshold", type=int, default=5, help="consecutive failed API calls after which a service is skipped for the rest of an account and region")
+    parser.add_argument("--interval", type=parse_duration, default="6h", help="serve mode: rescan every account and region at this interval, e.g. 30m or 6h")
+    parser.add_argument("--schedule", type=parse_schedules, help="serve mode: per-region rescan intervals, e.g. eu-west-1=1h,us-east-1=30m")
+    parser.add_argument("--host", default="127.0.0.1", help="serve mode: address of the HTTP API")
+    parser.add_argument("--port", type=int, default=8080, help="serve mode: port of the HTTP API")
+    parser.add_argument("--workers", type=int, default=4, help="serve mode: number of scopes scanned at the same time")
+    parser.add_argument("--events-queue", help="serve/events mode: URL of an SQS queue receiving CloudTrail events from EventBridge")
+    parser.add_argument("--events-dir", help="serve/events mode: directory of CloudTrail event files, consumed as a local queue")
+    parser.add_argument("--work-queue", help="coordinator/worker mode: SQS queue URL, redis://host:port/db/name or local directory the checks are sent through")
+    parser.add_argument("--results-queue", help="coordinator/worker mode: queue the findings are sent back through, defaults to results/ of a local or <name>:results of a Redis work queue")
+    parser.add_argument("--worker-idle", type=parse_duration, help="worker mode: stop once the work queue was empty for this long, e.g. 10m; by default the worker keeps waiting")
     
     args = parser.parse_args()
+    setup_logging(args.log_level, args.log_json, args.log_file)
     
     if args.profile:
         boto3.setup_default_session(profile_name=args.profile)
+    clients.configure(args.connect_timeout, args.read_timeout, args.breaker_threshold)
     
-    # Clean up old CSV files
-    clean_old_files()
-    
-    # Get accounts to scan
-    sts = boto3.client('sts')
-    accounts = get_account_ids() if args.org == "true" else [sts.get_caller_identity()['Account']]
-    
-    # Get regions to scan
-    regions = get_regions(args.region)
+    if args.policy:
+        apply_policy(args.policy)
+    pipeline.workers = args.pipeline_workers
+    resourceFilter.set_filters(args.include_tags, args.exclude_tags, args.min_size)
+    if args.windows:
+        set_windows(int(days) for days in args.windows.split(","))
+
+    if args.mode == "analyze":
+        # accounts, regions and every API response come from the raw snapshot, AWS is never called
+        snapshot = RawSnapshot(args.snapshot)
+        accounts = snapshot.accounts()
+        if args.accounts:
+            accounts = [account for account in accounts if account in args.accounts.split(",")]
+        regions = {'Regions': [{'RegionName': region} for region in snapshot.regions()
+                               if not args.region or region == args.region]}
+    else:
+        # Get accounts to scan
+        sts = boto3.client('sts')
+        identity = sts.get_caller_identity()
+        own_account = identity['Account']
+        account_filter = set(args.accounts.split(",")) if args.accounts else None
+        if args.mode == "worker":
+            # every work unit names its account, only the coordinator enumerates them
+            accounts = []
+        elif args.org == "true" or args.ou:
+            accounts = get_account_ids(set(args.ou.split(",")) if args.ou else None, account_filter, args.org_cache_ttl,
+                                       identity['Arn'])
+        else:
+            accounts = sorted(account_filter) if account_filter else [own_account]
+        
+        # Get regions to scan
+        regions = get_regions(args.region)
+
+        # Metrics are queried from the monitoring account, with the member account set on every query;
+        # concurrent checks of different accounts share its get_metric_data calls
+        if args.monitoring_account:
+            if args.mode == "collect":
+                parser.error("--monitoring-account cannot be used in collect mode, the metrics would not be recorded per account")
+            clients.set_monitoring(get_session_for_account(args.monitoring_account, sts, own_account),
+                                   0.05 if args.parallel > 1 or args.mode in ("serve", "events") else 0)
+
+        # Metrics are answered from the files of a metric stream, CloudWatch is not called at all
+        if args.metric_streams:
+            if args.mode == "collect":
+                parser.error("--metric-streams cannot be used in collect mode, the metrics would not be recorded")
+            clients.set_metric_streams(args.metric_streams)
+
+    if args.mode in ("serve", "events"):
+        if args.mode == "events" and not (args.events_queue or args.events_dir):
+            parser.error("events mode needs --events-queue or --events-dir")
+        # in events mode the regions are scanned once, after that only events trigger rescans
+        interval = float("inf") if args.mode == "events" else args.interval
+        serve(lambda account: member_session(account, sts, own_account), accounts,
+              [region['RegionName'] for region in regions['Regions']], interval,
+              args.schedule, args.workers, args.host, args.port,
+              checks, args.events_queue, args.events_dir)
+        return
+
+    if args.mode in ("coordinator", "worker"):
+        if not args.work_queue:
+            parser.error(f"{args.mode} mode needs --work-queue")
+        try:
+            work_queue, results_queue = open_work_queue(args.work_queue), results_queue_url(args.work_queue, args.results_queue)
+            results = open_work_queue(results_queue)
+        except ValueError as error:
+            parser.error(str(error))
+    if args.mode == "worker":
+        work(work_queue, args.work_queue, results, results_queue, checks,
+             lambda account: member_session(account, sts, own_account), args.check_timeout, args.worker_idle, args.parallel)
+        try:
+            save_sketches()
+        except Exception as error:
+            log.error("Error saving metric sketches: %s", error)
+        return
+
+    # Clean up old CSV files, when diffing against the reports in the working directory, or one of
+    # them, keep them aside
+    prior_report = args.diff_against
+    if prior_report and os.path.isdir(prior_report) and os.path.samefile(prior_report, "."):
+        prior_report = "previous"
+        clean_old_files(archive_dir=prior_report)
+    elif prior_report and os.path.isfile(prior_report) and os.path.basename(prior_report) in report_files \
+            and os.path.samefile(os.path.dirname(os.path.abspath(prior_report)), "."):
+        clean_old_files(archive_dir="previous")
+        prior_report = os.path.join("previous", os.path.basename(prior_report))
+    else:
+        clean_old_files()
     
-    # Scan resources in each account and region
-    for account in accounts:
+    # Store the findings of this run in the findings database next to the CSV reports
+    db = None
+    if args.db:
+        db = FindingsDatabase(args.db)
+        db.start_run()
+        add_sink(db.add)
+
+    region_names = [region['RegionName'] for region in regions['Regions']]
+    recorder = None
+    if args.mode == "analyze":
+        sessions, errors = {account: ReplaySession(snapshot, account) for account in accounts}, {}
+    else:
+        # assume the role of every account in parallel, reusing the credentials cached by earlier runs
+        sessions, errors = get_sessions(accounts, sts, own_account, caller=identity['Arn'])
+        for account, session in sessions.items():
+            clients.register_account(session, account)
+    if args.mode in ("collect", "analyze"):
+        # every metric series is fetched (or replayed) in full, stored sketches would hide it
+        disable_sketch_store()
+    if args.mode == "collect":
+        recorder = Recorder(args.snapshot)
+        sessions = {account: RecordingSession(session, recorder, account) for account, session in sessions.items()}
+    unscanned = set()
+    for account, error in errors.items():
+        log.error("Error processing account %s: %s", account, error)
+        skipped = plan([account], region_names, list(checks), {})
+        write_unscanned(skipped, f"account error: {error}")
+        unscanned |= {(u.account, u.region, u.check) for u in skipped}
+
+    # Estimate what each check of each region is worth: from the savings of a previous report,
+    # or, when only time is short, from a quick inventory of every region
+    deadline = Deadline(args.deadline)
+    estimates = {}
+    priority_report = args.priority_from or prior_report
+    try:
+        if priority_report:
+            estimates = estimates_from_report(priority_report)
+        elif args.deadline:
+            estimates = inventory_all(sessions, region_names, args.parallel, args.deadline * inventory_share)
+    except Exception as error:
+        log.error("Error estimating the cost of each check, scanning in the default order: %s", error)
+
+    # Scan the checks of every account and region, most expensive first, until the deadline.
+    # A check is skipped once a service it needs failed repeatedly in that account and region.
+    units = plan(list(sessions), region_names, list(checks), estimates, group_regions=bool(args.monitoring_account))
+    progress.start(len(units), args.progress_log)
+    summary = []
+    lock = threading.Lock()
+
+    def scan_unit(unit):
+        with log_context(account=unit.account, region=unit.region, check=unit.check):
+            run_unit(unit)
+
+    def run_unit(unit):
+        if deadline.expired():
+            with lock:
+                write_unscanned([unit], "deadline")
+                unscanned.add((unit.account, unit.region, unit.check))
+                summary.append((unit, "unscanned", 0, "deadline"))
+            progress.unit_finished(unit, "unscanned", 0, "deadline")
+            return
+        session = sessions[unit.account]
+        opened = {service: error for service, error in clients.breakers.open_services(session, unit.region).items()
+                  if service in checkServices[unit.check]}
+        if opened:
+            reason = "circuit open: " + ", ".join(f"{service} ({error})" for service, error in opened.items())
+            with lock:
+                write_unscanned([unit], reason)
+                unscanned.add((unit.account, unit.region, unit.check))
+                summary.append((unit, "skipped", 0, reason))
+            progress.unit_finished(unit, "skipped", 0, reason)
+            return
+
+        log.info("Running %s check in region: %s in account: %s", unit.check, unit.region, unit.account)
+        started = time.time()
+        progress.unit_started(unit)
+        limits = [limit for limit in (args.check_timeout, deadline.remaining()) if limit is not None]
+        reason = run_with_limit(checks[unit.check], (unit.region, unit.account, session),
+                                min(limits) if limits else None, clients.breakers)
+        if reason == "timeout":
+            reason = "deadline" if deadline.expired() else "time limit"
+        opened = {service: error for service, error in clients.breakers.open_services(session, unit.region).items()
+                  if service in checkServices[unit.check]}
+        if reason is None and opened:
+            reason = "circuit opened: " + ", ".join(f"{service} ({error})" for service, error in opened.items())
+        with lock:
+            if reason:
+                log.warning("%s check in region %s of account %s is incomplete: %s", unit.check, unit.region, unit.account, reason)
+                unscanned.add((unit.account, unit.region, unit.check))
+            summary.append((unit, "incomplete" if reason else "complete", time.time() - started, reason))
+        progress.unit_finished(unit, "incomplete" if reason else "complete", time.time() - started, reason)
+
+    # with --parallel, checks of several accounts run at the same time, in monitoring mode their
+    # metric queries are then merged into shared get_metric_data calls
+    if args.mode == "coordinator":
+        # the checks run on the workers, their findings are written here as they arrive
+        summary = coordinate(units, work_queue, args.work_queue, results, results_queue, deadline)
+        unscanned |= {(u.account, u.region, u.check) for u, status, _, _ in summary if status != "complete"}
+    else:
+        with ThreadPoolExecutor(max_workers=args.parallel) as pool:
+            list(pool.map(scan_unit, units))
+    left = sum(1 for _, status, _, _ in summary if status == "unscanned")
+    if left:
+        log.warning("Deadline reached, %s check(s) left unscanned, see unscanned.csv", left)
+    progress.stop()
+    write_run_summary(summary)
+    if recorder is not None:
+        recorder.close()
+    if db is not None:
         try:
-            session = get_session_for_account(account, sts)
-            
-            for region in regions['Regions']:
-                region_name = region['RegionName']
-                print(f"Scanning region: {region_name} in account: {account}")
-                
-                try:
-                    check_ebs_volumes(region_name, account)
-                    check_elastic_ips(region_name, account)
-                    check_load_balancers(region_name, account)
-                    check_nat_gateways(region_name, account)
-                    check_efs_filesystems(region_name, account)
-                    check_rds_instances(region_name, account)
-                    check_dynamodb_tables(region_name, account)
-                    check_vpc(region_name, account)
-                except Exception as error:
-                    print(f"Error processing region {region_name}: {error}")
-                    continue
-                
+            db.finish_run()
         except Exception as error:
-            print(f"Error processing account {account}: {error}")
-            continue
+            log.error("Error writing findings to %s: %s", args.db, error)
     
+    # Keep the metric sketches, so the next run only fetches the days since this one
+    try:
+        save_sketches()
+    except Exception as error:
+        log.error("Error saving metric sketches: %s", error)
+
+    # Compare the findings of this run with the previous report
+    if prior_report:
+        try:
+            diff_findings(prior_report, ".", skip=lambda f: (f.account, f.region, checkForType.get(f.resourceType)) in unscanned)
+        except Exception as error:
+            log.error("Error comparing findings with %s: %s", prior_report, error)
+
+    # Join the actual cost of the last billing period onto the findings
+    if args.cur:
+        try:
+            join_findings(".", CurIndex.from_files(args.cur))
+        except Exception as error:
+            log.error("Error joining the costs of %s: %s", args.cur, error)
+
     # Upload results to S3 if specified
     if args.s3:
         try:
-            file_list = [
-                "ebs.csv", "eip.csv", "elb.csv", "natgw.csv", "efs.csv", 
-                "rds.csv", "rds_snapshots.csv", "ec2.csv", "dynamodb.csv", "vpc.csv"
-            ]
-            for file in file_list:
+            for file in report_files + diff_files + summary_files + cur_files + [windowsFile, sketchFile]:
                 if os.path.exists(file):
                     upload_file(file, args.s3)
         except Exception as error:
-            print(f"Error uploading files to S3: {error}")
+            log.error("Error uploading files to S3: %s", error)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,287 @@
+import datetime
+import gzip
+import json
+import os
+import threading
+import time
+from logs import log
+from resourceTypes.quantile_sketch import KLLSketch, day_sketch_k
+
+# namespaces the checks query, the datapoints of every other namespace are skipped while indexing
+stream_namespaces = {"AWS/EBS", "AWS/EC2", "AWS/EFS", "AWS/ApplicationELB", "AWS/NetworkELB", "AWS/NATGateway",
+                     "AWS/RDS", "AWS/DynamoDB"}
+# metrics whose per-minute values are kept as a daily quantile sketch of this statistic, see window_sketches
+sketched_metrics = {("AWS/EBS", "VolumeReadBytes"): "Maximum", ("AWS/EBS", "VolumeWriteBytes"): "Maximum"}
+# days of aggregates kept per series, older days are dropped at every refresh
+retention_days = 92
+# seconds between two scans of the directory for new stream files
+refresh_interval = 60
+# seconds a stream may end before a queried window and still cover it, the delivery delay of Firehose:
+# the current day counts as covered before its first datapoints arrived
+coverage_tolerance = 3600
+
+statFields = {"Maximum": "max", "Minimum": "min", "Sum": "sum", "SampleCount": "count"}
+
+# Yield (account, region, namespace, metricName, dimensions, timestamp, value) of the records of one
+# stream file line, value being a dict of max, min, sum, count and the percentiles of the stream
+def json_datapoints(record):
+    if "resourceMetrics" in record:
+        yield from otlp_datapoints(record)
+        return
+    if record.get("namespace") not in stream_namespaces:
+        return
+    yield (record.get("account_id"), record.get("region"), record["namespace"], record["metric_name"],
+           record.get("dimensions", {}), record["timestamp"] / 1000, record["value"])
+
+def _attribute(value):
+    if "kvlistValue" in value:
+        return {item["key"]: _attribute(item["value"]) for item in value["kvlistValue"].get("values", [])}
+    return next(iter(value.values()), None)
+
+# OpenTelemetry summaries (0.7 and 1.0, JSON or decoded protobuf): the attributes name the metric,
+# quantile 0 and 1 are the minimum and maximum, the other quantiles are the percentiles of the stream
+def otlp_datapoints(request):
+    for resourceMetrics in request.get("resourceMetrics", []):
+        resource = {a["key"]: _attribute(a["value"]) for a in resourceMetrics.get("resource", {}).get("attributes", [])}
+        for scope in resourceMetrics.get("scopeMetrics", resourceMetrics.get("instrumentationLibraryMetrics", [])):
+            for metric in scope.get("metrics", []):
+                for point in metric.get("summary", {}).get("dataPoints", []):
+                    attributes = {a["key"]: _attribute(a["value"]) if isinstance(a["value"], dict) else a["value"]
+                                  for a in point.get("attributes", point.get("labels", []))}
+                    namespace = attributes.pop("Namespace", None)
+                    if namespace not in stream_namespaces:
+                        continue
+                    metricName = attributes.pop("MetricName", None)
+                    dimensions = attributes.pop("Dimensions", attributes)
+                    value = {"sum": float(point.get("sum", 0)), "count": float(point.get("count", 0))}
+                    for quantile in point.get("quantileValues", []):
+                        q = float(quantile.get("quantile", 0))
+                        name = "min" if q == 0 else "max" if q == 1 else f"p{q * 100:g}"
+                        value[name] = float(quantile.get("value", 0))
+                    yield (resource.get("cloud.account.id"), resource.get("cloud.region"), namespace, metricName,
+                           dimensions, int(point["timeUnixNano"]) / 1e9, value)
+
+# Size-delimited ExportMetricsServiceRequest messages, as Firehose delivers the OpenTelemetry formats
+def otlp_requests(data):
+    try:
+        from google.protobuf.internal.decoder import _DecodeVarint32
+        from google.protobuf.json_format import MessageToDict
+        from opentelemetry.proto.collector.metrics.v1.metrics_service_pb2 import ExportMetricsServiceRequest
+    except ImportError:
+        raise ValueError("OpenTelemetry stream files need the opentelemetry-proto package: pip install opentelemetry-proto")
+    position = 0
+    while position < len(data):
+        size, position = _DecodeVarint32(data, position)
+        request = ExportMetricsServiceRequest()
+        request.ParseFromString(data[position:position + size])
+        position += size
+        yield MessageToDict(request)
+
+# JSON stream files are newline-delimited, a size-delimited protobuf message may also start with "{"
+def is_json(data):
+    line = data.lstrip().split(b"\n", 1)[0]
+    try:
+        return isinstance(json.loads(line), dict)
+    except ValueError:
+        return False
+
+class DayStats:
+    """Aggregates of one series over one UTC day: the statistics of the minute datapoints combined,
+    percentiles as the highest percentile of any minute"""
+
+    __slots__ = ("max", "min", "sum", "count", "percentiles", "sketch")
+
+    def __init__(self):
+        self.max = float("-inf")
+        self.min = float("inf")
+        self.sum = 0.0
+        self.count = 0.0
+        self.percentiles = {}
+        self.sketch = None
+
+    def add(self, value, sketchStat=None):
+        self.max = max(self.max, value.get("max", float("-inf")))
+        self.min = min(self.min, value.get("min", float("inf")))
+        self.sum += value.get("sum", 0.0)
+        self.count += value.get("count", 0.0)
+        for name, v in value.items():
+            if name.startswith("p"):
+                self.percentiles[name] = max(self.percentiles.get(name, float("-inf")), v)
+        if sketchStat is not None:
+            if self.sketch is None:
+                self.sketch = KLLSketch(day_sketch_k)
+            self.sketch.update(value[statFields[sketchStat]])
+
+    # A percentile the stream does not export is answered with the maximum, an upper bound of it
+    def stat(self, stat):
+        if stat in statFields:
+            return getattr(self, statFields[stat])
+        if stat == "Average":
+            return self.sum / self.count if self.count else None
+        if stat.startswith("p"):
+            return self.percentiles.get(stat, self.max)
+        raise ValueError(f"statistic {stat} is not available from metric streams")
+
+class MetricStreamIndex:
+    """Daily aggregates per metric series of a directory of CloudWatch metric stream files, as Firehose
+    writes them: JSON or OpenTelemetry records, optionally gzipped. New files are indexed at most every
+    refresh_interval seconds and a file that grows is read from where it was left; memory is bounded
+    by one DayStats per series and day of the retention. The UTC days with datapoints of every
+    (account, region, namespace) tell which windows the stream covers, see covers()."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.series = {}
+        self.coverage = {}
+        self.offsets = {}
+        self.refreshed = 0
+
+    def refresh(self, force=False):
+        with self.lock:
+            if not force and time.time() - self.refreshed < refresh_interval:
+                return
+            started = time.time()
+            count = 0
+            for root, _, names in os.walk(self.directory):
+                for name in sorted(names):
+                    path = os.path.join(root, name)
+                    try:
+                        count += self.index_file(path)
+                    except (OSError, ValueError, KeyError, TypeError) as error:
+                        log.warning("Skipping metric stream file %s: %s", path, error)
+                        self.offsets[path] = float("inf")
+            self.expire()
+            self.refreshed = time.time()
+            if count:
+                log.info("Indexed %s metric stream datapoints from %s in %.1fs", count, self.directory, time.time() - started)
+
+    # Index the part of a file not read yet. Gzipped and OpenTelemetry files are written once by Firehose,
+    # a plain JSON file can be appended to and only its complete lines are read.
+    def index_file(self, path):
+        offset = self.offsets.get(path, 0)
+        size = os.path.getsize(path)
+        if size <= offset:
+            return 0
+        with open(path, "rb") as f:
+            magic = f.read(2)
+            if offset and magic == b"\x1f\x8b":
+                return 0
+            f.seek(0 if magic == b"\x1f\x8b" else offset)
+            data = f.read()
+        consumed = size
+        if magic == b"\x1f\x8b":
+            data = gzip.decompress(data)
+        elif is_json(data):
+            # an incomplete last line is read again once it is complete
+            end = data.rfind(b"\n") + 1
+            data, consumed = data[:end], offset + end
+        count = 0
+        if is_json(data):
+            for line in data.splitlines():
+                if line.strip():
+                    count += self.add(json_datapoints(json.loads(line)))
+        elif data:
+            for request in otlp_requests(data):
+                count += self.add(otlp_datapoints(request))
+        self.offsets[path] = consumed
+        return count
+
+    def add(self, datapoints):
+        count = 0
+        oldest = time.time() - retention_days * 86400
+        for account, region, namespace, metricName, dimensions, timestamp, value in datapoints:
+            if timestamp < oldest:
+                continue
+            key = (account, region, namespace, metricName, frozenset(dimensions.items()))
+            day = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).date()
+            self.coverage.setdefault((account, region, namespace), set()).add(day)
+            self.series.setdefault(key, {}).setdefault(day, DayStats()).add(
+                value, sketched_metrics.get((namespace, metricName)))
+            count += 1
+        return count
+
+    def expire(self):
+        oldest = (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=retention_days)).date()
+        for key in list(self.series):
+            days = self.series[key]
+            for day in [d for d in days if d < oldest]:
+                del days[day]
+            if not days:
+                del self.series[key]
+        for key in list(self.coverage):
+            self.coverage[key] = {day for day in self.coverage[key] if day >= oldest}
+
+    # Whether the stream files hold the namespace of the account and region on every day of [start, end),
+    # a gap such as a paused stream or a delivery outage leaves a window uncovered. A series without
+    # datapoints in a covered window had no activity, otherwise it is unknown.
+    def covers(self, account, region, namespace, start, end):
+        self.refresh()
+        last = datetime.datetime.fromtimestamp(min(end.timestamp(), time.time()) - coverage_tolerance,
+                                               datetime.timezone.utc).date()
+        with self.lock:
+            covered = self.coverage.get((account, region, namespace)) or self.coverage.get((None, None, namespace))
+            if not covered:
+                return False
+            day = start.astimezone(datetime.timezone.utc).date()
+            while True:
+                if day not in covered:
+                    return False
+                day += datetime.timedelta(days=1)
+                if day > last:
+                    return True
+
+    # Days of a series that overlap [start, end), in ascending order. Without an account or region
+    # the series of the stream files that have none match.
+    def days(self, account, region, namespace, metricName, dimensions, start, end):
+        self.refresh()
+        key = frozenset(dimensions.items())
+        with self.lock:
+            days = self.series.get((account, region, namespace, metricName, key)) or \
+                self.series.get((None, None, namespace, metricName, key), {})
+            return sorted((day, stats) for day, stats in days.items()
+                          if start.date() <= day and datetime.datetime.combine(day, datetime.time(), datetime.timezone.utc) < end)
+
+class MetricStreamClient:
+    """Stand-in for the CloudWatch client of one account and region, answering the daily metric
+    queries of the checks from a MetricStreamIndex without any API call"""
+
+    def __init__(self, index, account, region):
+        self.index = index
+        self.account = account
+        self.region = region
+
+    # an uncovered window fails the query, so the resource is reported as an error instead of as unused
+    def check_coverage(self, namespace, start, end):
+        if not self.index.covers(self.account, self.region, namespace, start, end):
+            raise ValueError(f"the metric streams do not cover {namespace} of {self.account} in {self.region} "
+                             f"from {start.isoformat()} to {end.isoformat()}")
+
+    def get_metric_data(self, MetricDataQueries, StartTime, EndTime, ScanBy="TimestampDescending", **kwargs):
+        results = []
+        for query in MetricDataQueries:
+            if "MetricStat" not in query:
+                raise ValueError("metric math is not available from metric streams")
+            metricStat, metric = query["MetricStat"], query["MetricStat"]["Metric"]
+            if metricStat["Period"] != 86400:
+                raise ValueError(f"metric streams are indexed per day, not per {metricStat['Period']} seconds")
+            self.check_coverage(metric["Namespace"], StartTime, EndTime)
+            dimensions = {d["Name"]: d["Value"] for d in metric.get("Dimensions", [])}
+            points = [(datetime.datetime.combine(day, datetime.time(), datetime.timezone.utc), stats.stat(metricStat["Stat"]))
+                      for day, stats in self.index.days(self.account, self.region, metric["Namespace"], metric["MetricName"],
+                                                        dimensions, StartTime, EndTime)]
+            points = [(timestamp, value) for timestamp, value in points if value is not None]
+            if ScanBy == "TimestampDescending":
+                points.reverse()
+            results.append({"Id": query["Id"], "Label": metric["MetricName"], "StatusCode": "Complete",
+                            "Timestamps": [timestamp for timestamp, _ in points], "Values": [value for _, value in points]})
+        return {"MetricDataResults": results}
+
+    # Daily sketches of the per-minute statistic of a sketched metric between start and end, by ISO day
+    def day_sketches(self, namespace, metricName, dimensions, period, stat, start, end):
+        if period != 60 or sketched_metrics.get((namespace, metricName)) != stat:
+            raise ValueError(f"metric streams keep no per-minute {stat} of {namespace}/{metricName}")
+        self.check_coverage(namespace, start, end)
+        return {day.isoformat(): KLLSketch.from_dict(stats.sketch.to_dict())
+                for day, stats in self.index.days(self.account, self.region, namespace, metricName, dimensions, start, end)
+                if stats.sketch is not None}
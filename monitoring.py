@@ -0,0 +1,104 @@
+import copy
+import threading
+import time
+
+# get_metric_data accepts at most 500 queries per request
+max_queries_per_call = 500
+
+class MetricBatcher:
+    """Merges the get_metric_data requests of several accounts, made at about the same time in one
+    region, into as few calls of the monitoring account as possible. The first request waits `linger`
+    seconds for others over exactly the same time range, then sends all of them in chunks of 500 queries.
+    When a merged call fails, every request is sent again on its own, so only the failing account fails."""
+
+    def __init__(self, cw, linger=0.05):
+        self.cw = cw
+        self.linger = linger
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def get_metric_data(self, **kwargs):
+        # only requests of the same time range and order share a call, see metric_batch.query_end
+        key = (kwargs["StartTime"], kwargs["EndTime"], kwargs.get("ScanBy", "TimestampDescending"))
+        request = {"queries": kwargs["MetricDataQueries"], "done": threading.Event(), "response": None, "error": None}
+        with self.lock:
+            group = self.pending.setdefault(key, [])
+            group.append(request)
+            leader = len(group) == 1
+        if leader:
+            time.sleep(self.linger)
+            with self.lock:
+                group = self.pending.pop(key)
+            self.send(group, kwargs)
+        request["done"].wait()
+        if request["error"] is not None:
+            raise request["error"]
+        return request["response"]
+
+    # Send the queries of all requests of a group under unique Ids, follow every NextToken and
+    # hand each request its complete results under its own Ids, with their status and messages
+    def send(self, group, kwargs):
+        try:
+            self.call(group, kwargs)
+        except Exception as error:
+            if len(group) > 1:
+                for request in group:
+                    self.send([request], kwargs)
+                return
+            group[0]["error"] = error
+        for request in group:
+            request["done"].set()
+
+    def call(self, group, kwargs):
+        queries, owners = [], []
+        for request in group:
+            request["results"] = {}
+            request["messages"] = []
+            for query in request["queries"]:
+                owners.append((request, query["Id"]))
+                request["results"][query["Id"]] = {"Id": query["Id"], "Timestamps": [], "Values": [],
+                                                   "StatusCode": "Complete", "Messages": []}
+                queries.append(dict(query, Id=f"q{len(queries)}"))
+        for i in range(0, len(queries), max_queries_per_call):
+            call = {"MetricDataQueries": queries[i:i + max_queries_per_call], "StartTime": kwargs["StartTime"],
+                    "EndTime": kwargs["EndTime"], "ScanBy": kwargs.get("ScanBy", "TimestampDescending")}
+            # the messages of a call are about every request that has queries in it
+            requests = {id(request): request for request, _ in owners[i:i + max_queries_per_call]}
+            while True:
+                response = self.cw.get_metric_data(**call)
+                for result in response["MetricDataResults"]:
+                    request, queryId = owners[int(result["Id"][1:])]
+                    merged = request["results"][queryId]
+                    merged["Timestamps"].extend(result["Timestamps"])
+                    merged["Values"].extend(result["Values"])
+                    # the status of the last page is the status of the query
+                    merged["StatusCode"] = result.get("StatusCode", merged["StatusCode"])
+                    merged["Messages"].extend(result.get("Messages", []))
+                for request in requests.values():
+                    request["messages"].extend(response.get("Messages", []))
+                if "NextToken" not in response:
+                    break
+                call["NextToken"] = response["NextToken"]
+        for request in group:
+            request["response"] = {"MetricDataResults": list(request["results"].values()),
+                                   "Messages": request["messages"]}
+
+class MonitoringClient:
+    """CloudWatch client of a member account backed by the monitoring account: every metric query
+    carries the member's AccountId and goes through the region's batcher. Other calls are sent
+    to the monitoring account unchanged."""
+
+    def __init__(self, batcher, account):
+        self.batcher = batcher
+        self.account = account
+
+    def get_metric_data(self, **kwargs):
+        kwargs = dict(kwargs, MetricDataQueries=[dict(copy.deepcopy(query), AccountId=self.account)
+                                                 for query in kwargs["MetricDataQueries"]])
+        # math expressions refer to other queries by Id and cannot be merged with other requests
+        if "NextToken" in kwargs or any("Expression" in query for query in kwargs["MetricDataQueries"]):
+            return self.batcher.cw.get_metric_data(**kwargs)
+        return self.batcher.get_metric_data(**kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.batcher.cw, name)
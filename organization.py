@@ -0,0 +1,153 @@
+import datetime
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from logs import log
+
+# the org tree and assumed role credentials are kept between runs in this directory, readable by the owner only,
+# in one file per caller, see cache_path
+cacheDir = os.path.join(os.path.expanduser("~"), ".cache", "aws-unused-resources")
+orgCacheFile = "org_tree"
+credentialCacheFile = "credentials"
+
+role_name = "OrganizationAccountAccessRole"
+# cached credentials are only reused while they are valid for at least this long
+credential_margin = 15 * 60
+
+def write_private(path, data):
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    tmp = path + ".tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+# Cache file of the identity running the scan, so another profile or organization never reuses its
+# org tree or credentials. The session name of an assumed role changes between logins and is left out.
+def cache_path(name, caller=None):
+    if not caller:
+        return os.path.join(cacheDir, name + ".json")
+    if ":assumed-role/" in caller:
+        caller = caller.rsplit("/", 1)[0]
+    return os.path.join(cacheDir, f"{name}-{hashlib.sha256(caller.encode()).hexdigest()[:16]}.json")
+
+def read_cache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+# Walk the organization from its root: every account with its status and the path of OUs above it
+def list_org_tree(org):
+    accounts = []
+
+    def walk(parentId, path):
+        for page in org.get_paginator('list_accounts_for_parent').paginate(ParentId=parentId):
+            for account in page['Accounts']:
+                accounts.append({"id": account['Id'], "name": account['Name'],
+                                 "status": account['Status'], "ous": path})
+        for page in org.get_paginator('list_organizational_units_for_parent').paginate(ParentId=parentId):
+            for ou in page['OrganizationalUnits']:
+                walk(ou['Id'], path + [{"id": ou['Id'], "name": ou['Name']}])
+
+    for root in org.list_roots()['Roots']:
+        walk(root['Id'], [])
+    return accounts
+
+# The org tree, from the cache of the caller while it is younger than ttl seconds
+def get_org_tree(ttl=24 * 3600, caller=None):
+    path = cache_path(orgCacheFile, caller)
+    cached = read_cache(path)
+    if cached and time.time() - cached["fetched"] < ttl:
+        return cached["accounts"]
+    accounts = list_org_tree(boto3.client('organizations'))
+    write_private(path, {"fetched": time.time(), "accounts": accounts})
+    return accounts
+
+# IDs of the active accounts of the organization, optionally only those below one of the given OUs
+# (by ID or name, at any depth) or among the given account IDs
+def get_account_ids(ous=None, accounts=None, ttl=24 * 3600, caller=None):
+    selected = []
+    for account in get_org_tree(ttl, caller):
+        if account["status"] != "ACTIVE":
+            continue
+        if ous and not any(ou["id"] in ous or ou["name"] in ous for ou in account["ous"]):
+            continue
+        if accounts and account["id"] not in accounts:
+            continue
+        selected.append(account["id"])
+    return selected
+
+class CredentialCache:
+    def __init__(self, caller=None):
+        self.path = cache_path(credentialCacheFile, caller)
+        self.credentials = read_cache(self.path) or {}
+
+    def get(self, account):
+        creds = self.credentials.get(account)
+        if creds is None:
+            return None
+        expiration = datetime.datetime.fromisoformat(creds["Expiration"])
+        if (expiration - datetime.datetime.now(datetime.timezone.utc)).total_seconds() < credential_margin:
+            return None
+        return creds
+
+    def put(self, account, creds):
+        self.credentials[account] = {
+            "AccessKeyId": creds["AccessKeyId"],
+            "SecretAccessKey": creds["SecretAccessKey"],
+            "SessionToken": creds["SessionToken"],
+            "Expiration": creds["Expiration"].isoformat(),
+        }
+
+    # expired credentials are dropped when the cache is written
+    def save(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        write_private(self.path, {account: creds for account, creds in self.credentials.items()
+                                  if datetime.datetime.fromisoformat(creds["Expiration"]) > now})
+
+def assume_role(account, sts_client):
+    return sts_client.assume_role(
+        RoleArn=f'arn:aws:iam::{account}:role/{role_name}',
+        RoleSessionName='unusedResources'
+    )['Credentials']
+
+def session_from(creds):
+    return boto3.Session(
+        aws_access_key_id=creds['AccessKeyId'],
+        aws_secret_access_key=creds['SecretAccessKey'],
+        aws_session_token=creds['SessionToken']
+    )
+
+# Sessions for every account: the own account keeps the session set up by --profile, the others
+# reuse cached credentials or assume the role in parallel. Returns (sessions, errors) keyed by account.
+def get_sessions(accounts, sts_client, own_account, workers=16, cache=None, caller=None):
+    cache = cache or CredentialCache(caller)
+    sessions, errors = {}, {}
+
+    def assume(account):
+        creds = cache.get(account)
+        if creds is None:
+            creds = assume_role(account, sts_client)
+            cache.put(account, creds)
+        return session_from(creds)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {account: pool.submit(assume, account) for account in accounts if account != own_account}
+        for account in accounts:
+            if account == own_account:
+                sessions[account] = boto3.DEFAULT_SESSION or boto3.Session()
+                continue
+            try:
+                sessions[account] = futures[account].result()
+            except Exception as error:
+                errors[account] = error
+    try:
+        cache.save()
+    except OSError as error:
+        log.error("Error saving the credential cache: %s", error)
+    return sessions, errors
@@ -0,0 +1,43 @@
+import contextvars
+import queue
+import threading
+from logs import log
+
+# resources of one check that are evaluated at the same time, and listed ahead of the evaluation
+workers = 8
+queue_size = 64
+
+_done = object()
+
+# Evaluate the items of a discovery generator on a pool of worker threads while the producer keeps
+# listing: the queue is bounded, so listing waits when the workers fall behind. The workers inherit
+# the calling thread, so a check that is cancelled after its time limit also stops its workers.
+def run_pipeline(items, evaluate, workerCount=None):
+    tasks = queue.Queue(maxsize=queue_size)
+    parent = threading.current_thread()
+
+    def work():
+        while True:
+            item = tasks.get()
+            if item is _done:
+                return
+            try:
+                evaluate(item)
+            except Exception as error:
+                log.error("Error evaluating %s: %s", item, error)
+
+    threads = []
+    for _ in range(workerCount or workers):
+        # every worker logs and writes its findings in a copy of the check's context, see writeToCSV.collecting
+        thread = threading.Thread(target=contextvars.copy_context().run, args=(work,), daemon=True)
+        thread.parent = getattr(parent, "parent", parent)
+        thread.start()
+        threads.append(thread)
+    try:
+        for item in items:
+            tasks.put(item)
+    finally:
+        for _ in threads:
+            tasks.put(_done)
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,18 @@
+import importlib
+import json
+from logs import log
+
+# Thresholds of the resource classes can be overridden by a policy file, e.g.
+# {"ec2_instance": {"cpu_idle_threshold": 10}, "dynamodb": {"usage_idle_threshold": 5},
+#  "rds": {"snapshot_retention_days": 90}, "ebs_snapshot": {"snapshot_retention_days": 180}}
+def apply_policy(path):
+    with open(path) as f:
+        policy = json.load(f)
+    for moduleName, settings in policy.items():
+        module = importlib.import_module(f"resourceTypes.{moduleName}")
+        for name, value in settings.items():
+            current = getattr(module, name, None)
+            if not isinstance(current, (int, float)) or not isinstance(value, (int, float)):
+                raise ValueError(f"{moduleName}.{name} is not a numeric setting")
+            setattr(module, name, value)
+            log.info("Policy: %s.%s = %s", moduleName, name, value)
@@ -0,0 +1,124 @@
+import collections
+import json
+import sys
+import threading
+import time
+from logs import log
+
+# rates and the ETA are computed over this many seconds of recent samples
+rolling_window = 60
+
+class Progress:
+    """Completed and total work units, resources evaluated per check, API calls and an ETA from the
+    rolling throughput. Shown as a status line on stderr and written as newline-delimited JSON events."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.total = 0
+        self.done = 0
+        self.started = None
+        self.resources = collections.Counter()
+        self.calls = 0
+        self.samples = collections.deque()
+        self.running = {}
+        self.log = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self, total, log_path=None, interval=1.0):
+        self.total = total
+        self.started = time.time()
+        self.samples.append((self.started, 0, 0, {}))
+        self.log = open(log_path, "a") if log_path else None
+        self.event("start", total=total)
+        self.thread = threading.Thread(target=self.report, args=(interval,), daemon=True)
+        self.thread.start()
+
+    def event(self, name, **fields):
+        if self.log is None:
+            return
+        with self.lock:
+            self.log.write(json.dumps(dict(fields, event=name, time=time.time()), default=str) + "\n")
+            self.log.flush()
+
+    # a resource was evaluated by a check
+    def tick(self, check):
+        with self.lock:
+            self.resources[check] += 1
+
+    # botocore after-call hook
+    def count_call(self, **kwargs):
+        with self.lock:
+            self.calls += 1
+
+    def unit_started(self, unit):
+        with self.lock:
+            self.running[(unit.account, unit.region, unit.check)] = time.time()
+        self.event("unit_start", account=unit.account, region=unit.region, check=unit.check)
+
+    def unit_finished(self, unit, status, seconds, reason=None):
+        with self.lock:
+            self.done += 1
+            self.running.pop((unit.account, unit.region, unit.check), None)
+        self.event("unit_end", account=unit.account, region=unit.region, check=unit.check,
+                   status=status, seconds=round(seconds, 1), reason=reason)
+
+    # Rates over the rolling window: units, API calls and resources per check per second, and the ETA
+    def status(self):
+        now = time.time()
+        with self.lock:
+            self.samples.append((now, self.done, self.calls, dict(self.resources)))
+            while len(self.samples) > 1 and now - self.samples[0][0] > rolling_window:
+                self.samples.popleft()
+            first, done, calls = self.samples[0], self.done, self.calls
+            oldest = min(self.running.values(), default=None)
+            resources = dict(self.resources)
+        elapsed = max(now - first[0], 1e-9)
+        unitRate = (done - first[1]) / elapsed
+        if unitRate == 0 and done:
+            unitRate = done / max(now - self.started, 1e-9)
+        return {
+            "done": done,
+            "total": self.total,
+            "elapsed": round(now - self.started, 1),
+            "unitsPerSecond": round(unitRate, 3),
+            "apiCallsPerSecond": round((calls - first[2]) / elapsed, 1),
+            "resourcesPerSecond": {check: round((count - first[3].get(check, 0)) / elapsed, 1)
+                                   for check, count in resources.items()},
+            "eta": round((self.total - done) / unitRate) if unitRate > 0 else None,
+            # a unit running for long without any API calls is likely stuck
+            "longestRunning": round(now - oldest, 1) if oldest else 0,
+        }
+
+    def status_line(self, status):
+        eta = time.strftime("%H:%M:%S", time.gmtime(status["eta"])) if status["eta"] is not None else "--:--:--"
+        rates = " ".join(f"{check} {rate}/s" for check, rate in sorted(status["resourcesPerSecond"].items()) if rate)
+        return (f"[{status['done']}/{status['total']}] ETA {eta} | {status['apiCallsPerSecond']} calls/s"
+                + (f" | {rates}" if rates else "") + f" | longest check {status['longestRunning']:.0f}s")
+
+    def report(self, interval):
+        lastEvent = 0
+        while not self.stopped.wait(interval):
+            status = self.status()
+            if sys.stderr.isatty():
+                sys.stderr.write("\r\x1b[K" + self.status_line(status))
+                sys.stderr.flush()
+            if time.time() - lastEvent >= 10:
+                lastEvent = time.time()
+                self.event("status", **status)
+                if not sys.stderr.isatty():
+                    log.info("Progress: %s", self.status_line(status))
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        status = self.status() if self.started else {}
+        self.event("end", **status)
+        if sys.stderr.isatty():
+            sys.stderr.write("\r\x1b[K")
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+progress = Progress()
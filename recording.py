@@ -0,0 +1,140 @@
+import datetime
+import gzip
+import json
+import os
+import threading
+import time
+import boto3
+
+# parameters that depend on when a call is made, they are not part of the key of a recorded call
+timeParams = ("StartTime", "EndTime")
+
+class NotRecordedError(Exception):
+    pass
+
+def encode(value):
+    if isinstance(value, datetime.datetime):
+        return {"$dt": value.isoformat()}
+    return str(value)
+
+def decode(document):
+    if len(document) == 1 and "$dt" in document:
+        return datetime.datetime.fromisoformat(document["$dt"])
+    return document
+
+def call_key(service, operation, params):
+    params = {name: value for name, value in params.items() if name not in timeParams}
+    return f"{service}.{operation}:" + json.dumps(params, sort_keys=True, default=encode)
+
+def chunk_path(directory, account, region):
+    return os.path.join(directory, account, f"{region or 'global'}.jsonl.gz")
+
+def attach_key(client, service):
+    def before_parameter_build(params, model, context, **kwargs):
+        context["recordingKey"] = call_key(service, model.name, params)
+    client.meta.events.register("before-parameter-build", before_parameter_build)
+
+class Recorder:
+    """Writes every API response of the collect phase to a raw snapshot: one gzipped JSON lines
+    chunk per account and region, holding the response of each (service, operation, parameters)"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def record(self, account, region, key, status, response):
+        line = json.dumps({"key": key, "status": status, "response": response}, default=encode) + "\n"
+        with self.lock:
+            if (account, region) not in self.files:
+                path = chunk_path(self.directory, account, region)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                self.files[(account, region)] = gzip.open(path, "wt")
+            self.files[(account, region)].write(line)
+
+    def attach(self, client, service, account, region):
+        attach_key(client, service)
+
+        def after_call(http_response, parsed, context, **kwargs):
+            response = {name: value for name, value in parsed.items() if name != "ResponseMetadata"}
+            self.record(account, region, context["recordingKey"], http_response.status_code, response)
+        client.meta.events.register("after-call", after_call)
+
+    def close(self):
+        with self.lock:
+            for f in self.files.values():
+                f.close()
+            chunks = sorted(self.files)
+            self.files = {}
+        with open(os.path.join(self.directory, "manifest.json"), "w") as f:
+            json.dump({"collected": time.time(), "chunks": chunks}, f)
+
+class RecordingSession:
+    """Session of one account whose clients record their responses, used like a boto3 Session by get_client"""
+
+    def __init__(self, session, recorder, account):
+        self.session = session
+        self.recorder = recorder
+        self.account = account
+
+    def client(self, service, region_name=None, config=None):
+        client = self.session.client(service, region_name=region_name, config=config)
+        self.recorder.attach(client, service, self.account, region_name)
+        return client
+
+class ReplayResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.headers = {}
+
+class RawSnapshot:
+    """The chunks written by a Recorder, loaded one (account, region) at a time when first replayed"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "manifest.json")) as f:
+            self.manifest = json.load(f)
+        self.chunks = {}
+        self.lock = threading.Lock()
+
+    def accounts(self):
+        return sorted({account for account, region in self.manifest["chunks"]})
+
+    def regions(self):
+        return sorted({region for account, region in self.manifest["chunks"] if region is not None})
+
+    # the last recorded response of each call wins
+    def chunk(self, account, region):
+        with self.lock:
+            if (account, region) not in self.chunks:
+                responses = {}
+                path = chunk_path(self.directory, account, region)
+                if os.path.exists(path):
+                    with gzip.open(path, "rt") as f:
+                        for line in f:
+                            entry = json.loads(line, object_hook=decode)
+                            responses[entry["key"]] = (entry["status"], entry["response"])
+                self.chunks[(account, region)] = responses
+            return self.chunks[(account, region)]
+
+class ReplaySession:
+    """Session of one account whose clients answer every call from a raw snapshot and never reach AWS"""
+
+    def __init__(self, snapshot, account):
+        self.snapshot = snapshot
+        self.account = account
+
+    def client(self, service, region_name=None, config=None):
+        client = boto3.client(service, region_name=region_name or "us-east-1", config=config,
+                              aws_access_key_id="replay", aws_secret_access_key="replay")
+        attach_key(client, service)
+        responses = self.snapshot.chunk(self.account, region_name)
+
+        def before_call(context, **kwargs):
+            key = context["recordingKey"]
+            if key not in responses:
+                raise NotRecordedError(f"{key} was not collected for account {self.account} in {region_name}")
+            status, response = responses[key]
+            return ReplayResponse(status), dict(response, ResponseMetadata={"HTTPStatusCode": status})
+        client.meta.events.register("before-call", before_call)
+        return client
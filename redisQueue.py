@@ -0,0 +1,78 @@
+import time
+import uuid
+from urllib.parse import urlparse
+
+# Move the messages whose lease ran out back to the queue, then lease up to ARGV[3] messages until ARGV[2].
+# Runs atomically on the server, so a message is only ever leased by one consumer.
+_receive = """
+for _, id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', ARGV[1])) do
+    redis.call('ZREM', KEYS[3], id)
+    redis.call('RPUSH', KEYS[1], id)
+end
+local messages = {}
+for _ = 1, tonumber(ARGV[3]) do
+    local id = redis.call('RPOP', KEYS[1])
+    if not id then
+        break
+    end
+    -- a message deleted after its lease ran out has no body left
+    local body = redis.call('HGET', KEYS[2], id)
+    if body then
+        redis.call('ZADD', KEYS[3], ARGV[2], id)
+        table.insert(messages, id)
+        table.insert(messages, body)
+        table.insert(messages, redis.call('HINCRBY', KEYS[4], id, 1))
+    end
+end
+return messages
+"""
+
+class RedisQueue:
+    """SQS-compatible queue in Redis, addressed as redis://host:port/db/name: a list of message IDs,
+    a hash of their bodies, and a sorted set of the leased messages by lease expiry. A message that
+    is not deleted before its lease runs out is received again. The QueueUrl arguments are ignored."""
+
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError:
+            raise ValueError("Redis queues need the redis package: pip install redis")
+        parsed = urlparse(url)
+        db, _, name = parsed.path.lstrip("/").partition("/")
+        if not name:
+            raise ValueError(f"Redis queue URL without a queue name: {url}, e.g. redis://localhost:6379/0/units")
+        self.redis = redis.Redis.from_url(f"{parsed.scheme}://{parsed.netloc}/{db or 0}", decode_responses=True)
+        self.keys = [name, name + ":bodies", name + ":inflight", name + ":receives"]
+        self.receive = self.redis.register_script(_receive)
+
+    def send_message(self, QueueUrl=None, MessageBody=""):
+        messageId = uuid.uuid4().hex
+        pipe = self.redis.pipeline()
+        pipe.hset(self.keys[1], messageId, MessageBody)
+        pipe.lpush(self.keys[0], messageId)
+        pipe.execute()
+        return {"MessageId": messageId}
+
+    def receive_message(self, QueueUrl=None, MaxNumberOfMessages=1, WaitTimeSeconds=0, VisibilityTimeout=30,
+                        AttributeNames=None):
+        deadline = time.time() + WaitTimeSeconds
+        while True:
+            now = time.time()
+            leased = self.receive(keys=self.keys, args=[now, now + VisibilityTimeout, MaxNumberOfMessages])
+            messages = [{"MessageId": messageId, "ReceiptHandle": messageId, "Body": body,
+                         "Attributes": {"ApproximateReceiveCount": str(count)}}
+                        for messageId, body, count in zip(leased[0::3], leased[1::3], leased[2::3])]
+            if messages or time.time() >= deadline:
+                return {"Messages": messages} if messages else {}
+            time.sleep(min(1, max(deadline - time.time(), 0)))
+
+    # Extend the lease of a received message, unless it already ran out and the message is back in the queue
+    def change_message_visibility(self, QueueUrl=None, ReceiptHandle=None, VisibilityTimeout=30):
+        self.redis.zadd(self.keys[2], {ReceiptHandle: time.time() + VisibilityTimeout}, xx=True)
+
+    def delete_message(self, QueueUrl=None, ReceiptHandle=None):
+        pipe = self.redis.pipeline()
+        pipe.zrem(self.keys[2], ReceiptHandle)
+        pipe.hdel(self.keys[1], ReceiptHandle)
+        pipe.hdel(self.keys[3], ReceiptHandle)
+        pipe.execute()
@@ -0,0 +1,83 @@
+from clients import get_client
+
+# tag key -> allowed values, an empty set allows any value of the key
+include_tags = {}
+exclude_tags = {}
+# GiB, smaller volumes, snapshots, file systems and databases are skipped
+min_size = None
+
+# resource types of the Resource Groups Tagging API, for checks whose describe calls return no tags
+taggingTypes = {
+    "elb": "elasticloadbalancing:loadbalancer",
+    "dynamodb": "dynamodb:table",
+}
+
+# "env=prod,env=staging,keep" -> {"env": {"prod", "staging"}, "keep": set()}
+def parse_tags(value):
+    tags = {}
+    for item in value.split(","):
+        key, _, tagValue = item.partition("=")
+        values = tags.setdefault(key.strip(), set())
+        if tagValue:
+            values.add(tagValue.strip())
+    return tags
+
+def set_filters(include=None, exclude=None, minSize=None):
+    global include_tags, exclude_tags, min_size
+    include_tags = parse_tags(include) if include else {}
+    exclude_tags = parse_tags(exclude) if exclude else {}
+    min_size = minSize
+
+def active():
+    return bool(include_tags or exclude_tags or min_size)
+
+def tag_dict(tags):
+    if isinstance(tags, dict):
+        return tags
+    return {tag["Key"]: tag.get("Value", "") for tag in tags or []}
+
+def has_tag(tags, key, values):
+    return key in tags and (not values or tags[key] in values)
+
+# Whether a resource with these tags (a list of Key/Value records or a dict) and size in GiB is scanned:
+# every include key must match and no exclude key may match
+def matches(tags, size=None):
+    tags = tag_dict(tags)
+    if any(not has_tag(tags, key, values) for key, values in include_tags.items()):
+        return False
+    if any(has_tag(tags, key, values) for key, values in exclude_tags.items()):
+        return False
+    return min_size is None or size is None or size >= min_size
+
+# Filters of the EC2 describe calls selecting the included tags on the server, exclusions
+# cannot be expressed there and are applied to the returned tags by matches()
+def ec2_filters():
+    filters = []
+    for key, values in include_tags.items():
+        if values:
+            filters.append({'Name': f"tag:{key}", 'Values': sorted(values)})
+        else:
+            filters.append({'Name': 'tag-key', 'Values': [key]})
+    return filters
+
+# ARNs of the resources of a check that pass the tag filters, from one paginated Resource Groups
+# Tagging API listing of the region. None when no tag filter is set.
+def tagged_arns(check, region, session=None):
+    if not (include_tags or exclude_tags):
+        return None
+    tagging = get_client('resourcegroupstaggingapi', region, session)
+    tagged = {}
+    for page in tagging.get_paginator('get_resources').paginate(ResourceTypeFilters=[taggingTypes[check]]):
+        for resource in page['ResourceTagMappingList']:
+            tagged[resource['ResourceARN']] = resource.get('Tags', [])
+    return TaggedArns(tagged)
+
+class TaggedArns:
+    """Tags of the resources of one type in a region; untagged resources are not listed by the
+    tagging API and only pass the filters when nothing has to be included"""
+
+    def __init__(self, tagged):
+        self.tagged = tagged
+
+    def __contains__(self, arn):
+        return matches(self.tagged.get(arn, []))
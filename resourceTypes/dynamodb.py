@@ -1,5 +1,15 @@
-import datetime
 import boto3
+from logs import log
+from .pricing import get_rate
+from .usage_windows import fetch_daily, lookback, window_rows
+
+storage_rate = 0.25  # $ per GB-month
+provisioned_read_rate = 0.0065  # $ per RCU-hour
+provisioned_write_rate = 0.0065  # $ per WCU-hour
+on_demand_read_rate = 0.00000025  # $ per read request unit
+on_demand_write_rate = 0.00000125  # $ per write request unit
+usage_idle_threshold = 1  # consumed read or write capacity units per hour
+usage_window = 14  # days the idle decision is based on
 
 class DynamoDBTable:
     def __init__(self, table_name, region, cwClient, dynamoClient):
@@ -7,7 +17,12 @@ class DynamoDBTable:
         self.region = region
         self.cloudwatch = cwClient
         self.dynamodb = dynamoClient
-        print(f"Found DynamoDB table: {table_name} in region {region}")
+        self.storage_rate = get_rate("AmazonDynamoDB", region, "TimedStorage-ByteHrs", default=storage_rate)
+        self.provisioned_read_rate = get_rate("AmazonDynamoDB", region, "ReadCapacityUnit-Hrs", default=provisioned_read_rate)
+        self.provisioned_write_rate = get_rate("AmazonDynamoDB", region, "WriteCapacityUnit-Hrs", default=provisioned_write_rate)
+        self.on_demand_read_rate = get_rate("AmazonDynamoDB", region, "ReadRequestUnits", default=on_demand_read_rate)
+        self.on_demand_write_rate = get_rate("AmazonDynamoDB", region, "WriteRequestUnits", default=on_demand_write_rate)
+        log.debug("Found DynamoDB table: %s in region %s", table_name, region)
         self.get_table_details()
         self.get_usage_metrics()
 
@@ -19,55 +34,47 @@ class DynamoDBTable:
         self.size_bytes = table.get('TableSizeBytes', 0)
         self.item_count = table.get('ItemCount', 0)
 
+    # Daily sums of consumed capacity and throttles over the longest window, in one request
     def get_usage_metrics(self):
-        end_time = datetime.datetime.now()
-        start_time = end_time - datetime.timedelta(days=14)
+        dimensions = {'TableName': self.table_name}
+        self.series = fetch_daily(self.cloudwatch, {
+            metric_name: ('AWS/DynamoDB', metric_name, dimensions, 'Sum')
+            for metric_name in ('ConsumedReadCapacityUnits', 'ConsumedWriteCapacityUnits',
+                                'ReadThrottleEvents', 'WriteThrottleEvents')
+        }, lookback(usage_window))
+        self.metrics = self.usage(usage_window)
 
-        # Get read and write consumed capacity
-        metrics = [
-            ('ConsumedReadCapacityUnits', 'Sum'),
-            ('ConsumedWriteCapacityUnits', 'Sum'),
-            ('ReadThrottleEvents', 'Sum'),
-            ('WriteThrottleEvents', 'Sum')
-        ]
+    # Average usage per hour over the last `days` days
+    def usage(self, days):
+        metrics = {}
+        for metric_name, series in self.series.items():
+            total = series.aggregate(days, 'sum')
+            metrics[metric_name] = total / (series.count(days) * 24) if total is not None else 0
+        return metrics
 
-        self.metrics = {}
-        for metric_name, stat in metrics:
-            response = self.cloudwatch.get_metric_statistics(
-                Namespace='AWS/DynamoDB',
-                MetricName=metric_name,
-                Dimensions=[{'Name': 'TableName', 'Value': self.table_name}],
-                StartTime=start_time,
-                EndTime=end_time,
-                Period=3600,  # 1 hour periods
-                Statistics=[stat]
-            )
-            
-            # Store the average usage over the period
-            datapoints = response['Datapoints']
-            if datapoints:
-                self.metrics[metric_name] = sum(d[stat] for d in datapoints) / len(datapoints)
-            else:
-                self.metrics[metric_name] = 0
+    def is_idle(self, metrics):
+        # If the table has less than 1 read/write per hour on average
+        return (metrics.get('ConsumedReadCapacityUnits', 0) < usage_idle_threshold
+                and metrics.get('ConsumedWriteCapacityUnits', 0) < usage_idle_threshold)
 
     def is_unused(self):
-        # Consider a table unused if it has very low usage over the past 14 days
-        read_usage = self.metrics.get('ConsumedReadCapacityUnits', 0)
-        write_usage = self.metrics.get('ConsumedWriteCapacityUnits', 0)
-        
-        # If the table has less than 1 read/write per hour on average
-        is_unused = read_usage < 1 and write_usage < 1
+        # Consider a table unused if it has very low usage over the usage window
+        is_unused = self.is_idle(self.metrics)
         if is_unused:
-            print(f"DynamoDB table {self.table_name} is identified as unused")
+            log.debug("DynamoDB table %s is identified as unused", self.table_name)
         return is_unused
 
+    def window_usage(self):
+        return window_rows('ConsumedReadCapacityUnits', lambda days: self.usage(days)['ConsumedReadCapacityUnits'],
+                           lambda days: self.is_idle(self.usage(days)))
+
     def get_savings(self):
-        monthly_storage_cost = (self.size_bytes / (1024 * 1024 * 1024)) * 0.25  # $0.25 per GB-month
+        monthly_storage_cost = (self.size_bytes / (1024 * 1024 * 1024)) * self.storage_rate
         
         if self.billing_mode == 'PROVISIONED':
             # Calculate monthly cost for provisioned capacity
-            monthly_read_cost = self.provisioned_read * 0.0065 * 730  # $0.0065 per RCU-hour
-            monthly_write_cost = self.provisioned_write * 0.0065 * 730  # $0.0065 per WCU-hour
+            monthly_read_cost = self.provisioned_read * self.provisioned_read_rate * 730
+            monthly_write_cost = self.provisioned_write * self.provisioned_write_rate * 730
             
             current_monthly_cost = monthly_storage_cost + monthly_read_cost + monthly_write_cost
             
@@ -75,8 +82,8 @@ class DynamoDBTable:
             avg_read_units = self.metrics.get('ConsumedReadCapacityUnits', 0)
             avg_write_units = self.metrics.get('ConsumedWriteCapacityUnits', 0)
             new_monthly_cost = monthly_storage_cost + \
-                             (avg_read_units * 0.00000025 * 730 * 3600) + \
-                             (avg_write_units * 0.00000125 * 730 * 3600)
+                             (avg_read_units * self.on_demand_read_rate * 730 * 3600) + \
+                             (avg_write_units * self.on_demand_write_rate * 730 * 3600)
             
             return {
                 "currentType": "Provisioned Capacity",
@@ -89,8 +96,8 @@ class DynamoDBTable:
             avg_read_units = self.metrics.get('ConsumedReadCapacityUnits', 0)
             avg_write_units = self.metrics.get('ConsumedWriteCapacityUnits', 0)
             current_monthly_cost = monthly_storage_cost + \
-                                 (avg_read_units * 0.00000025 * 730 * 3600) + \
-                                 (avg_write_units * 0.00000125 * 730 * 3600)
+                                 (avg_read_units * self.on_demand_read_rate * 730 * 3600) + \
+                                 (avg_write_units * self.on_demand_write_rate * 730 * 3600)
             
             return {
                 "currentType": "On-Demand",
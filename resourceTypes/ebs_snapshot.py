@@ -0,0 +1,75 @@
+import datetime
+from .pricing import get_rate
+
+ebs_snapshot_rate = 0.05  # $ per GB-month of standard snapshot storage
+ebs_snapshot_archive_rate = 0.0125  # $ per GB-month of archived snapshot storage
+snapshot_retention_days = 365
+
+# describe_snapshots returns at most 1000 snapshots per page
+snapshots_per_page = 1000
+
+# Snapshot IDs referenced by the block device mappings of the region's own AMIs, from one paged pass
+def image_snapshot_ids(ec2Client):
+    snapshotIds = set()
+    for page in ec2Client.get_paginator('describe_images').paginate(Owners=['self'], IncludeDeprecated=True):
+        for image in page['Images']:
+            for mapping in image.get('BlockDeviceMappings', []):
+                if 'SnapshotId' in mapping.get('Ebs', {}):
+                    snapshotIds.add(mapping['Ebs']['SnapshotId'])
+    return snapshotIds
+
+def volume_ids(ec2Client):
+    volumeIds = set()
+    for page in ec2Client.get_paginator('describe_volumes').paginate():
+        volumeIds.update(volume['VolumeId'] for volume in page['Volumes'])
+    return volumeIds
+
+# Stream the account's own snapshots page by page, only one page is held in memory at a time
+def iter_snapshots(ec2Client, ids=None, tagFilters=None):
+    filters = ([{'Name': 'snapshot-id', 'Values': ids}] if ids else []) + (tagFilters or [])
+    paginator = ec2Client.get_paginator('describe_snapshots')
+    for page in paginator.paginate(OwnerIds=['self'], Filters=filters, PaginationConfig={'PageSize': snapshots_per_page}):
+        yield from page['Snapshots']
+
+class EBSSnapshot:
+    # snapshot is the record returned by describe_snapshots, volumeIds and imageSnapshotIds are the
+    # sets of the region's volumes and of the snapshots its AMIs are built from
+    def __init__(self, snapshot, volumeIds, imageSnapshotIds, rates):
+        self.snapshotId = snapshot['SnapshotId']
+        self.volumeId = snapshot.get('VolumeId')
+        self.size = snapshot['VolumeSize']
+        self.startTime = snapshot['StartTime']
+        self.tier = snapshot.get('StorageTier', 'standard')
+        self.volumeIds = volumeIds
+        self.imageSnapshotIds = imageSnapshotIds
+        self.rate = rates.get(self.tier, rates['standard'])
+
+    def usedByImage(self):
+        return self.snapshotId in self.imageSnapshotIds
+
+    def isOrphaned(self):
+        return self.volumeId not in self.volumeIds and not self.usedByImage()
+
+    # Snapshots backing an AMI can't be deleted, they are never reported as expired
+    def isExpired(self, retention_days=None):
+        retention_days = snapshot_retention_days if retention_days is None else retention_days
+        age = datetime.datetime.now(datetime.timezone.utc) - self.startTime
+        return age.days > retention_days and not self.usedByImage()
+
+    def isUnused(self):
+        return self.isOrphaned() or self.isExpired()
+
+    # Snapshots are incremental, the full volume size is the most a snapshot can cost
+    def getSavings(self):
+        return {
+            "currentType": f"Snapshot-{self.tier}",
+            "currentPrice": self.size * self.rate,
+            "newType": "None",
+            "newPrice": 0
+        }
+
+def get_snapshot_rates(region):
+    return {
+        "standard": get_rate("AmazonEC2", region, "EBS:SnapshotUsage", default=ebs_snapshot_rate),
+        "archive": get_rate("AmazonEC2", region, "EBS:SnapshotArchiveStorage", default=ebs_snapshot_archive_rate),
+    }
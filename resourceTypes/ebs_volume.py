@@ -1,91 +1,64 @@
-import datetime
 import boto3
-import numpy as np
+from .quantile_sketch import window_sketches
 from .storage_volume import StorageVolume
+from .triage import IDLE, triage_rule
+from .usage_windows import window_rows, windows
+
+usage_window = 14  # days the idle decision is based on
 
 class EBSVolume:
-    def __init__(self, volumeId, ec2Client, cw):
+    # volume is the record returned by describe_volumes, currentPrice can be passed in when
+    # the volume was already priced in a fleet-wide what-if pass
+    def __init__(self, volume, ec2Client, cw, currentPrice=None):
         self.ec2 = ec2Client
-        self.volumeId = volumeId
+        self.volumeId = volume["VolumeId"]
         self.cw = cw
-        self.getVolumeInfo()
-        self.volume = StorageVolume(self.type, self.size, self.iops, self.throughput)
+        self.currentPrice = currentPrice
+        self.getVolumeInfo(volume)
+        self.volume = StorageVolume(self.type, self.size, self.iops, self.throughput, ec2Client.meta.region_name)
 
-    def getVolumeInfo(self):
-        volume = self.ec2.describe_volumes(VolumeIds=[self.volumeId])["Volumes"][0]
+    def getVolumeInfo(self, volume):
         self.type = volume["VolumeType"]
         self.size = volume["Size"]
         self.iops = volume.get("Iops")
         self.throughput = volume.get("Throughput")
 
+    # p99.9 of the per-minute maximum read and write bytes per window (the usage window and the
+    # reported windows), in bytes per second. The series are streamed page by page into quantile
+    # sketches that are kept per day between runs, each window merges the days it covers.
     def getThroughput(self):
-        # Max ReadOps
-        readIO = self.cw.get_metric_data(
-            MetricDataQueries=[
-                {
-                    "Id": "dbi",
-                    "MetricStat": {
-                        "Metric": {
-                            "Namespace": "AWS/EBS",
-                            "MetricName": "VolumeReadBytes",
-                            "Dimensions": [
-                                {"Name": "VolumeId", "Value": self.volumeId}
-                            ],
-                        },
-                        "Period": 60,
-                        "Stat": "Maximum",
-                    },
-                },
-            ],
-            StartTime=datetime.datetime.now(datetime.timezone.utc)
-            - datetime.timedelta(days=14),
-            EndTime=datetime.datetime.now(datetime.timezone.utc),
-            ScanBy='TimestampAscending'
-        )['MetricDataResults'][0]['Values']
-        if len(readIO[14:]) == 0:
-            readThroughput = 0.0
-        else:
-            readThroughput = np.percentile(np.array(readIO[14:]), 99.9)/60
-        # Max WriteOps
-        writeIO = self.cw.get_metric_data(
-            MetricDataQueries=[
-                {
-                    "Id": "dbi",
-                    "MetricStat": {
-                        "Metric": {
-                            "Namespace": "AWS/EBS",
-                            "MetricName": "VolumeWriteBytes",
-                            "Dimensions": [
-                                {"Name": "VolumeId", "Value": self.volumeId}
-                            ],
-                        },
-                        "Period": 60,
-                        "Stat": "Maximum",
-                    },
-                },
-            ],
-            StartTime=datetime.datetime.now(datetime.timezone.utc)
-            - datetime.timedelta(days=14),
-            EndTime=datetime.datetime.now(datetime.timezone.utc),
-            ScanBy='TimestampAscending'
-        )['MetricDataResults'][0]['Values']
-        if len(writeIO[14:]) == 0:
-            writeThroughput = 0.0
-        else:
-            writeThroughput = np.percentile(np.array(writeIO[14:]), 99.9)/60
-        return readThroughput + writeThroughput
+        days = sorted(set(windows + [usage_window]))
+        read = self.percentileThroughput("VolumeReadBytes", days)
+        write = self.percentileThroughput("VolumeWriteBytes", days)
+        self.windowThroughput = {d: read[d] + write[d] for d in days}
+        return self.windowThroughput[usage_window]
+
+    def percentileThroughput(self, metricName, days):
+        sketches = window_sketches(self.cw, "AWS/EBS", metricName, {"VolumeId": self.volumeId}, 60, "Maximum", days)
+        return {d: sketch.quantile(0.999) / 60 if sketch.count else 0.0 for d, sketch in sketches.items()}
 
     def inUse(self):
-        self.throughput = self.getThroughput()
-        if self.throughput > 0:
+        self.measuredThroughput = self.getThroughput()
+        if self.measuredThroughput > 0:
             return True
         else:
             return False
 
+    def windowUsage(self):
+        return window_rows("Throughput", lambda days: self.windowThroughput[days],
+                           lambda days: self.windowThroughput[days] == 0)
+
     def getSavings(self):
+        if self.currentPrice is None:
+            self.currentPrice = self.volume.calculateStorageCost(self.type, self.size, self.iops, self.throughput)
         return {
             "currentType": self.type,
-            "currentPrice": self.volume.calculateStorageCost(self.type, self.size, self.iops, self.throughput),
+            "currentPrice": self.currentPrice,
             "newType": "None",
             "newPrice": 0
-        }
\ No newline at end of file
+        }
+
+# a volume that is not attached to any instance cannot be read or written
+@triage_rule(EBSVolume)
+def unattached(volume):
+    return IDLE if volume["State"] == "available" else None
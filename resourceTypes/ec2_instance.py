@@ -1,53 +1,114 @@
-import boto3
-from datetime import datetime, timedelta
+import json
+from pathlib import Path
+from logs import log
+from .metric_batch import build_query, get_metric_series_batched
+from .usage_windows import DailySeries, lookback, window_rows, windows
+from .pricing import get_rate
+
+cpu_idle_threshold = 5  # average CPU utilization in percent
+network_idle_threshold = 5 * 1024 * 1024  # bytes in + out per day
+disk_idle_threshold = 100  # instance store read + write operations per day
+usage_window = 14  # days the idle decision is based on
+
+# each instance needs 5 queries, 100 instances fill one get_metric_data call
+instances_per_batch = 100
+
+_catalog = None
+
+# Index the EC2 on-demand rates once per process as {(region, instanceType): hourly price}
+def load_catalog():
+    global _catalog
+    if _catalog is None:
+        path = Path(__file__).parent / "../aws-data/ec2Pricing.json"
+        with path.open() as f:
+            rates = json.load(f)
+        _catalog = {}
+        for region, instanceTypes in rates.items():
+            for instanceType, spec in instanceTypes.items():
+                _catalog[(region, instanceType)] = spec["instancePrice"]
+    return _catalog
+
+def get_instance_rate(region, instanceType):
+    catalog = load_catalog()
+    # prefer the Linux on-demand rate of the offer files, then the catalog,
+    # then the us-east-1 rate for regions that are not in the catalog
+    default = catalog.get((region, instanceType), catalog.get(("us-east-1", instanceType)))
+    return get_rate("AmazonEC2", region, f"BoxUsage:{instanceType}", "RunInstances", default=default)
+
+def _average(series, days):
+    value = series.aggregate(days, "average")
+    return 0 if value is None else value
+
+# Usage of an instance over the last `days` days from its daily series
+def _usage(series, days):
+    return {
+        "cpu": series["cpu"].aggregate(days, "average"),
+        "network": _average(series["netin"], days) + _average(series["netout"], days),
+        "disk": _average(series["diskread"], days) + _average(series["diskwrite"], days)
+    }
+
+def _idle(usage):
+    if usage["cpu"] is None:
+        return False  # No data points means we can't determine if it's idle
+    return (
+        usage["cpu"] < cpu_idle_threshold
+        and usage["network"] < network_idle_threshold
+        and usage["disk"] < disk_idle_threshold
+    )
 
 class EC2Instance:
-    def __init__(self, instance_id, ec2_client, cw_client):
-        self.instance_id = instance_id
-        self.ec2_client = ec2_client
-        self.cw_client = cw_client
-        print(f"Found EC2 instance: {instance_id}")
-        self.instance_details = self._get_instance_details()
+    # metrics is the usage of the instance per window, as returned by fetch_fleet_metrics
+    def __init__(self, instance, region, metrics):
+        self.instance_id = instance['InstanceId']
+        self.instance_type = instance['InstanceType']
+        self.region = region
+        self.windowMetrics = metrics
+        self.metrics = metrics[usage_window]
+        log.debug("Found EC2 instance: %s", self.instance_id)
 
-    def _get_instance_details(self):
-        response = self.ec2_client.describe_instances(InstanceIds=[self.instance_id])
-        return response['Reservations'][0]['Instances'][0]
+    # Fetch CPU, network and disk usage of a fleet of instances with batched get_metric_data calls
+    # over the longest window and reduce the series to the usage per window right away,
+    # so memory stays bounded by a single batch
+    @staticmethod
+    def fetch_fleet_metrics(cw_client, instance_ids):
+        days = set(windows + [usage_window])
+        metrics = {"cpu": ("CPUUtilization", "Average"), "netin": ("NetworkIn", "Sum"), "netout": ("NetworkOut", "Sum"),
+                   "diskread": ("DiskReadOps", "Sum"), "diskwrite": ("DiskWriteOps", "Sum")}
+        fleetMetrics = {}
+        for i in range(0, len(instance_ids), instances_per_batch):
+            batch = instance_ids[i:i + instances_per_batch]
+            queries = []
+            for n, instanceId in enumerate(batch):
+                dimensions = {"InstanceId": instanceId}
+                for name, (metricName, stat) in metrics.items():
+                    queries.append(build_query(f"{name}{n}", "AWS/EC2", metricName, dimensions, 86400, stat))
+            results = get_metric_series_batched(cw_client, queries, lookback(usage_window))
+            for n, instanceId in enumerate(batch):
+                series = {name: DailySeries(*results[f"{name}{n}"]) for name in metrics}
+                fleetMetrics[instanceId] = {d: _usage(series, d) for d in days}
+        return fleetMetrics
 
     def isIdle(self):
-        # Get CPU utilization for the last 14 days
-        end_time = datetime.utcnow()
-        start_time = end_time - timedelta(days=14)
-
-        response = self.cw_client.get_metric_statistics(
-            Namespace='AWS/EC2',
-            MetricName='CPUUtilization',
-            Dimensions=[{'Name': 'InstanceId', 'Value': self.instance_id}],
-            StartTime=start_time,
-            EndTime=end_time,
-            Period=3600,  # 1 hour periods
-            Statistics=['Average']
-        )
-
-        if not response['Datapoints']:
-            return False  # No data points means we can't determine if it's idle
-
-        # Calculate average CPU utilization
-        total_cpu = sum(dp['Average'] for dp in response['Datapoints'])
-        avg_cpu = total_cpu / len(response['Datapoints'])
-
-        is_idle = avg_cpu < 5  # Consider idle if average CPU < 5%
+        is_idle = _idle(self.metrics)
         if is_idle:
-            print(f"EC2 instance {self.instance_id} is identified as idle")
+            log.debug("EC2 instance %s is identified as idle", self.instance_id)
         return is_idle
 
+    def windowUsage(self):
+        return window_rows("CPUUtilization", lambda days: self.windowMetrics[days]["cpu"],
+                           lambda days: _idle(self.windowMetrics[days]))
+
+    # None when the instance type has no rate, the finding is not reported without a cost
     def getSavings(self):
-        current_type = self.instance_details['InstanceType']
-        
-        # For this example, we'll suggest stopping/terminating idle instances
-        # You could expand this to suggest downsizing based on usage patterns
+        rate = get_instance_rate(self.region, self.instance_type)
+        if rate is None:
+            log.warning("No rate for instance type %s in %s, idle instance %s is not reported",
+                        self.instance_type, self.region, self.instance_id)
+            return None
+        # Suggest stopping/terminating idle instances
         return {
-            'currentType': current_type,
-            'currentPrice': 'running',  # You could add actual pricing data here
+            'currentType': self.instance_type,
+            'currentPrice': rate * 24 * 30,
             'newType': 'stopped',
-            'newPrice': '0'
-        } 
\ No newline at end of file
+            'newPrice': 0
+        }
@@ -1,16 +1,25 @@
-import datetime
 import boto3
 import numpy as np
+from .pricing import get_rate
+from .triage import IDLE, IN_USE, triage_rule
+from .usage_windows import fetch_daily, lookback, window_rows
 
 EFSStandardRate = 0.33
 EFSIARate = 0.025
+usage_window = 14  # days the idle decision is based on
 
 class EFSFileSystem:
-    def __init__(self, fsId, efsClient, cw):
+    # verdict is the outcome of the triage, when set no metrics are fetched for the idle decision
+    def __init__(self, fsId, efsClient, cw, verdict=None):
+        self.verdict = verdict
         self.efs = efsClient
         self.fsId = fsId
         self.efs = efsClient
         self.cw = cw
+        region = efsClient.meta.region_name
+        self.standardRate = get_rate("AmazonEFS", region, "TimedStorage-ByteHrs", default=EFSStandardRate)
+        self.IARate = get_rate("AmazonEFS", region, "IATimedStorage-ByteHrs", default=EFSIARate)
+        self.connections = None
     
     def getSize(self):
         fs = self.efs.describe_file_systems(
@@ -22,35 +31,25 @@ class EFSFileSystem:
 
     def calculateEFSCost(self):
         self.getSize()
-        return (self.standardSize * EFSStandardRate / 1024 / 1024 / 1024) + (self.IASize * EFSIARate / 1024 / 1024 / 1024)
+        return (self.standardSize * self.standardRate / 1024 / 1024 / 1024) + (self.IASize * self.IARate / 1024 / 1024 / 1024)
 
-    def isUsed(self):
-        # Max ReadOps
-        conn = self.cw.get_metric_data(
-            MetricDataQueries=[
-                {
-                    "Id": "dbi",
-                    "MetricStat": {
-                        "Metric": {
-                            "Namespace": "AWS/EFS",
-                            "MetricName": "ClientConnections",
-                            "Dimensions": [
-                                {"Name": "FileSystemId", "Value": self.fsId}
-                            ],
-                        },
-                        "Period": 60,
-                        "Stat": "Maximum",
-                    },
-                },
-            ],
-            StartTime=datetime.datetime.now(datetime.timezone.utc)
-            - datetime.timedelta(days=14),
-            EndTime=datetime.datetime.now(datetime.timezone.utc),
-            ScanBy='TimestampAscending'
-        )['MetricDataResults'][0]['Values']
-        if len(conn) == 0:
-            return False
-        return True
+    # daily maximum of client connections over the longest window, fetched once
+    def getConnections(self):
+        if self.connections is None:
+            self.connections = fetch_daily(self.cw, {
+                "connections": ("AWS/EFS", "ClientConnections", {"FileSystemId": self.fsId}, "Maximum")
+            }, lookback(usage_window))["connections"]
+        return self.connections
+
+    # connections are only reported while clients are connected
+    def isUsed(self, days=None):
+        if self.verdict is not None and days is None:
+            return self.verdict == IN_USE
+        return self.getConnections().count(days or usage_window) > 0
+
+    def windowUsage(self):
+        return window_rows("ClientConnections", lambda days: self.getConnections().aggregate(days, "max"),
+                           lambda days: not self.isUsed(days))
 
     def getSavings(self):
         currentPrice = self.calculateEFSCost()
@@ -67,4 +66,9 @@ class EFSFileSystem:
             "currentPrice": currentPrice,
             "newType": "None",
             "newPrice": 0
-        }
\ No newline at end of file
+        }
+
+# clients can only mount a file system through a mount target
+@triage_rule(EFSFileSystem)
+def no_mount_targets(fs):
+    return IDLE if fs.get("NumberOfMountTargets") == 0 else None
@@ -1,12 +1,23 @@
 import boto3
-eip_rate = 0.005 * 24 * 30
+from .pricing import get_rate
+from .triage import IDLE, IN_USE, triage_rule
+eip_hourly_rate = 0.005
 
 class ElasticIP:
-    def __init__(self, allocationId, ec2Client):
+    # address is the record returned by describe_addresses, it is described again when not passed
+    def __init__(self, allocationId, ec2Client, address=None):
         self.ec2 = ec2Client
         self.allocationID = allocationId
+        self.address = address
+        region = ec2Client.meta.region_name
+        # idle public IPv4 addresses moved from the AmazonEC2 to the AmazonVPC offer
+        hourlyRate = get_rate("AmazonVPC", region, "PublicIPv4:IdleAddress",
+                              default=get_rate("AmazonEC2", region, "ElasticIP:IdleAddress", default=eip_hourly_rate))
+        self.rate = hourlyRate * 24 * 30
 
     def inUse(self):
+        if self.address is not None:
+            return self.address.get("AssociationId") is not None
         eips = self.ec2.describe_addresses(AllocationIds=[self.allocationID])
         for eip in eips["Addresses"]:
             if eip.get("AssociationId") == None:
@@ -18,14 +29,18 @@ class ElasticIP:
         if self.inUse():
             return {
                 'currentType': 'EIP',
-                'currentPrice': eip_rate,
+                'currentPrice': self.rate,
                 'newType': 'EIP',
-                'newPrice': eip_rate
+                'newPrice': self.rate
             }
         else:
             return {
                 'currentType': 'EIP',
-                'currentPrice': eip_rate,
+                'currentPrice': self.rate,
                 'newType': 'None',
                 'newPrice': 0
-            }
\ No newline at end of file
+            }
+
+@triage_rule(ElasticIP)
+def associated(address):
+    return IDLE if address.get("AssociationId") is None else IN_USE
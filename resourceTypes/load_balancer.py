@@ -1,82 +1,100 @@
-import datetime
+import threading
 import boto3
-elb_rate = 0.0252 * 24 * 30
+from logs import log
+from pipeline import run_pipeline
+from .pricing import get_rate
+from .triage import IDLE, IN_USE, triage_rule
+from .usage_windows import fetch_daily, lookback, window_rows
+elb_hourly_rate = 0.0252
+usage_window = 14  # days the idle decision is based on
+
+# namespace of the metrics of each type of load balancer, by the prefix of its ID
+namespaces = {"net/": "AWS/NetworkELB", "gwy/": "AWS/GatewayELB", "app/": "AWS/ApplicationELB"}
+operations = {"net/": "LoadBalancing:Network", "gwy/": "LoadBalancing:Gateway", "app/": "LoadBalancing:Application"}
+
+# Number of registered targets of the network and gateway load balancers of a region, added to their
+# describe records as "RegisteredTargets" for the triage. The target health of the target groups is
+# described on the pipeline workers, groups whose load balancers all have targets already are skipped.
+# A load balancer with a target group that could not be described gets no count, its metrics decide.
+def add_registered_targets(elbClient, loadBalancers):
+    counts = {lb["LoadBalancerArn"]: 0 for lb in loadBalancers if lb.get("Type") in ("network", "gateway")}
+    if not counts:
+        return
+    lock = threading.Lock()
+    unknown = set()
+
+    def count(group):
+        arns = [arn for arn in group.get("LoadBalancerArns", []) if arn in counts]
+        with lock:
+            if all(counts[arn] for arn in arns):
+                return
+        try:
+            targets = len(elbClient.describe_target_health(TargetGroupArn=group["TargetGroupArn"])["TargetHealthDescriptions"])
+        except Exception as error:
+            log.warning("Error describing the targets of %s: %s", group["TargetGroupArn"], error)
+            with lock:
+                unknown.update(arns)
+            return
+        with lock:
+            for arn in arns:
+                counts[arn] += targets
+
+    run_pipeline((group for page in elbClient.get_paginator('describe_target_groups').paginate()
+                  for group in page["TargetGroups"] if any(arn in counts for arn in group.get("LoadBalancerArns", []))),
+                 count)
+    for lb in loadBalancers:
+        if lb["LoadBalancerArn"] in counts and lb["LoadBalancerArn"] not in unknown:
+            lb["RegisteredTargets"] = counts[lb["LoadBalancerArn"]]
 
 class ElasticLoadBalancer:
-    def __init__(self, arn, elbClient, cwClient):
+    # verdict is the outcome of the triage, when set no metrics are fetched for the idle decision
+    def __init__(self, arn, elbClient, cwClient, verdict=None):
+        self.verdict = verdict
         self.elbv2 = elbClient
         self.cw = cwClient
         self.arn = arn
+        operation = operations.get(arn.split('/', 1)[1][:4], "LoadBalancing:Application")
+        self.rate = get_rate("AWSELB", elbClient.meta.region_name, "LoadBalancerUsage", operation, default=elb_hourly_rate) * 24 * 30
+        self.processedBytes = None
 
-    def inUse(self):
-        elbs = self.elbv2.describe_load_balancers(LoadBalancerArns=[self.arn])
-        for elb in elbs["LoadBalancers"]:
-            if elb["State"]["Code"] == "active":
-                lbId = elb["LoadBalancerArn"].split('/',1)[1]
-                if "net" in lbId:
-                    LCUConsumed = self.cw.get_metric_data(
-                        MetricDataQueries=[
-                            {
-                                "Id": "nlb",
-                                "MetricStat": {
-                                    "Metric": {
-                                        "Namespace": "AWS/NetworkELB",
-                                        "MetricName": "ProcessedBytes",
-                                        "Dimensions": [
-                                            {"Name": "LoadBalancer", "Value": lbId}
-                                        ],
-                                    },
-                                    "Period": 86400,
-                                    "Stat": "Sum",
-                                },
-                            },
-                        ],
-                        StartTime=datetime.datetime.now(datetime.timezone.utc)
-                        - datetime.timedelta(days=14),
-                        EndTime=datetime.datetime.now(datetime.timezone.utc),
-                    )['MetricDataResults'][0]['Values']
-                else:
-                    LCUConsumed = self.cw.get_metric_data(
-                        MetricDataQueries=[
-                            {
-                                "Id": "alb",
-                                "MetricStat": {
-                                    "Metric": {
-                                        "Namespace": "AWS/ApplicationELB",
-                                        "MetricName": "ProcessedBytes",
-                                        "Dimensions": [
-                                            {"Name": "LoadBalancer", "Value": lbId}
-                                        ],
-                                    },
-                                    "Period": 86400,
-                                    "Stat": "Sum",
-                                },
-                            },
-                        ],
-                        StartTime=datetime.datetime.now(datetime.timezone.utc)
-                        - datetime.timedelta(days=14),
-                        EndTime=datetime.datetime.now(datetime.timezone.utc),
-                    )['MetricDataResults'][0]['Values']
-                for lcu in LCUConsumed:
-                    if lcu > 0:
-                        return True
-                    else:
-                        return False
-            else:
-                return True
+    # daily processed bytes over the longest window, fetched once
+    def getProcessedBytes(self):
+        if self.processedBytes is None:
+            lbId = self.arn.split('/', 1)[1]
+            namespace = namespaces.get(lbId[:4], "AWS/ApplicationELB")
+            self.processedBytes = fetch_daily(self.cw, {
+                "bytes": (namespace, "ProcessedBytes", {"LoadBalancer": lbId}, "Sum")
+            }, lookback(usage_window))["bytes"]
+        return self.processedBytes
+
+    def inUse(self, days=None):
+        if self.verdict is not None and days is None:
+            return self.verdict == IN_USE
+        processed = self.getProcessedBytes().aggregate(days or usage_window, "max")
+        return processed is not None and processed > 0
+
+    def windowUsage(self):
+        return window_rows("ProcessedBytes", lambda days: self.getProcessedBytes().aggregate(days, "sum"),
+                           lambda days: not self.inUse(days))
                 
     def getSavings(self):
         if self.inUse():
             return {
                 'currentType': 'ELB',
-                'currentPrice': elb_rate,
+                'currentPrice': self.rate,
                 'newType': 'ELB',
-                'newPrice': elb_rate
+                'newPrice': self.rate
             }
         else:
             return {
                 'currentType': 'ELB',
-                'currentPrice': elb_rate,
+                'currentPrice': self.rate,
                 'newType': 'None',
                 'newPrice': 0
-            }
\ No newline at end of file
+            }
+
+# a network or gateway load balancer only forwards to registered targets; application load balancers
+# can answer with redirects and fixed responses without targets, their traffic decides
+@triage_rule(ElasticLoadBalancer)
+def no_targets(lb):
+    return IDLE if lb.get("RegisteredTargets") == 0 else None
@@ -0,0 +1,70 @@
+import datetime
+
+# get_metric_data accepts at most 500 queries per request
+max_queries_per_call = 500
+
+def build_query(queryId, namespace, metricName, dimensions, period, stat):
+    return {
+        "Id": queryId,
+        "MetricStat": {
+            "Metric": {
+                "Namespace": namespace,
+                "MetricName": metricName,
+                "Dimensions": [{"Name": name, "Value": value} for name, value in dimensions.items()],
+            },
+            "Period": period,
+            "Stat": stat,
+        },
+        "ReturnData": True,
+    }
+
+# End of the time range of a metric query: now, to the minute, so that the queries that checks of
+# different accounts make at about the same time cover the same range and can share a call
+def query_end():
+    return datetime.datetime.now(datetime.timezone.utc).replace(second=0, microsecond=0)
+
+# Run any number of metric queries in as few get_metric_data calls as possible.
+# Queries are sent in chunks of 500 and every chunk is followed through NextToken,
+# the timestamps and values of each query are returned in a dict keyed by the query Id.
+def get_metric_series_batched(cw, queries, days=14):
+    endTime = query_end()
+    startTime = endTime - datetime.timedelta(days=days)
+    results = {query["Id"]: ([], []) for query in queries}
+    for i in range(0, len(queries), max_queries_per_call):
+        chunk = queries[i:i + max_queries_per_call]
+        kwargs = {
+            "MetricDataQueries": chunk,
+            "StartTime": startTime,
+            "EndTime": endTime,
+            "ScanBy": "TimestampAscending",
+        }
+        while True:
+            response = cw.get_metric_data(**kwargs)
+            for result in response["MetricDataResults"]:
+                results[result["Id"]][0].extend(result["Timestamps"])
+                results[result["Id"]][1].extend(result["Values"])
+            if "NextToken" not in response:
+                break
+            kwargs["NextToken"] = response["NextToken"]
+    return results
+
+# Like get_metric_series_batched, with only the values of each query
+def get_metric_data_batched(cw, queries, days=14):
+    return {queryId: values for queryId, (timestamps, values) in get_metric_series_batched(cw, queries, days).items()}
+
+# Yield the (timestamps, values) of one query page by page, so a long high-resolution series
+# never has to be held in memory at once
+def iter_metric_pages(cw, query, startTime, endTime):
+    kwargs = {
+        "MetricDataQueries": [query],
+        "StartTime": startTime,
+        "EndTime": endTime,
+        "ScanBy": "TimestampAscending",
+    }
+    while True:
+        response = cw.get_metric_data(**kwargs)
+        for result in response["MetricDataResults"]:
+            yield result["Timestamps"], result["Values"]
+        if "NextToken" not in response:
+            break
+        kwargs["NextToken"] = response["NextToken"]
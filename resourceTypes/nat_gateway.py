@@ -1,57 +1,45 @@
-import datetime
 import boto3
-natgw_rate = 0.048 * 24 * 30
+from .pricing import get_rate
+from .usage_windows import fetch_daily, lookback, window_rows
+natgw_hourly_rate = 0.048
+usage_window = 14  # days the idle decision is based on
 
 class NATGateway:
     def __init__(self, id, ec2Client, cwClient):
         self.ec2 = ec2Client
         self.cw = cwClient
         self.id = id
+        self.rate = get_rate("AmazonEC2", ec2Client.meta.region_name, "NatGateway-Hours", default=natgw_hourly_rate) * 24 * 30
+        self.connections = None
 
-    def inUse(self):
-        elbs = self.ec2.describe_nat_gateways(NatGatewayIds=[self.id])
-        for natgw in self.ec2.describe_nat_gateways()['NatGateways']:
-            if natgw['State'] == 'available':
-                activeConnPerDay = self.cw.get_metric_data(
-                    MetricDataQueries=[
-                        {
-                            "Id": "natgw",
-                            "MetricStat": {
-                                "Metric": {
-                                    "Namespace": "AWS/NATGateway",
-                                    "MetricName": "ActiveConnectionCount",
-                                    "Dimensions": [
-                                        {"Name": "NatGatewayId", "Value": natgw['NatGatewayId']}
-                                    ],
-                                },
-                                "Period": 86400,
-                                "Stat": "Sum",
-                            },
-                        },
-                    ],
-                    StartTime=datetime.datetime.now(datetime.timezone.utc)
-                    - datetime.timedelta(days=14),
-                    EndTime=datetime.datetime.now(datetime.timezone.utc),
-                )['MetricDataResults'][0]['Values']
-                activeConn = False
-                for connDay in activeConnPerDay:
-                    if connDay > 0:
-                        return True
-                    else:
-                        return False
+    # daily active connections over the longest window, fetched once
+    def getConnections(self):
+        if self.connections is None:
+            self.connections = fetch_daily(self.cw, {
+                "connections": ("AWS/NATGateway", "ActiveConnectionCount", {"NatGatewayId": self.id}, "Sum")
+            }, lookback(usage_window))["connections"]
+        return self.connections
+
+    def inUse(self, days=None):
+        activeConn = self.getConnections().aggregate(days or usage_window, "max")
+        return activeConn is not None and activeConn > 0
+
+    def windowUsage(self):
+        return window_rows("ActiveConnectionCount", lambda days: self.getConnections().aggregate(days, "sum"),
+                           lambda days: not self.inUse(days))
                 
     def getSavings(self):
         if self.inUse():
             return {
                 'currentType': 'NATGW',
-                'currentPrice': natgw_rate,
+                'currentPrice': self.rate,
                 'newType': 'NATGW',
-                'newPrice': natgw_rate
+                'newPrice': self.rate
             }
         else:
             return {
                 'currentType': 'NATGW',
-                'currentPrice': natgw_rate,
+                'currentPrice': self.rate,
                 'newType': 'None',
                 'newPrice': 0
             }
\ No newline at end of file
@@ -0,0 +1,177 @@
+import csv
+import json
+import re
+import sqlite3
+import threading
+from pathlib import Path
+from logs import log
+
+# AWS bulk price list files (index.json / index.csv of an offer) are read from this directory
+offersDir = Path(__file__).parent / "../aws-data/offers"
+# and compiled once into this SQLite table, keyed by (service, region, usage type, operation)
+indexPath = Path(__file__).parent / "../aws-data/pricing.sqlite"
+
+# usage types outside us-east-1 carry a region prefix, e.g. EUW1-EBS:VolumeUsage.gp3
+regionPrefix = re.compile(r"^(?:[A-Z]{3,4}\d|EU)-")
+
+# products that would shadow the default on-demand rate of a usage type
+skippedCapacityStatus = {"AllocatedCapacityReservation", "UnusedCapacityReservation", "AllocatedHost"}
+
+def normalize_usage_type(usageType):
+    return regionPrefix.sub("", usageType, count=1)
+
+def normalize_price(unit, price):
+    # gp3 throughput is listed per GiBps-month, the storage calculations work per MiBps-month
+    if unit == "GiBps-mo":
+        return "MiBps-mo", price / 1024
+    return unit, price
+
+def is_default_product(attributes):
+    if attributes.get("capacitystatus", "Used") in skippedCapacityStatus:
+        return False
+    if attributes.get("preInstalledSw", "NA") != "NA":
+        return False
+    return True
+
+# Pick the rate of a tiered price: the lowest tier that is not free
+def pick_tier(dimensions):
+    dimensions = sorted(dimensions, key=lambda d: float(d[0] or 0))
+    for beginRange, unit, price in dimensions:
+        if price > 0:
+            return unit, price
+    return dimensions[0][1], dimensions[0][2]
+
+def read_json_offer(path):
+    with open(path) as f:
+        offer = json.load(f)
+    service = offer.get("offerCode")
+    onDemand = offer.get("terms", {}).get("OnDemand", {})
+    for sku, product in offer.get("products", {}).items():
+        attributes = product.get("attributes", {})
+        if "regionCode" not in attributes or "usagetype" not in attributes or sku not in onDemand:
+            continue
+        if not is_default_product(attributes):
+            continue
+        dimensions = []
+        for term in onDemand[sku].values():
+            for dimension in term["priceDimensions"].values():
+                if "USD" in dimension["pricePerUnit"]:
+                    dimensions.append((dimension.get("beginRange"), dimension["unit"], float(dimension["pricePerUnit"]["USD"])))
+        if dimensions:
+            unit, price = pick_tier(dimensions)
+            yield (attributes.get("servicecode", service), attributes["regionCode"],
+                   normalize_usage_type(attributes["usagetype"]), attributes.get("operation", ""), unit, price)
+
+# The CSV flavour of an offer file is streamed row by row, so even the EC2 offer stays cheap to ingest
+def read_csv_offer(path):
+    with open(path, newline="") as f:
+        reader = csv.reader(f)
+        service = None
+        for row in reader:
+            if row and row[0] == "OfferCode":
+                service = row[1]
+            if row and row[0] == "SKU":
+                header = {name: i for i, name in enumerate(row)}
+                break
+        else:
+            return
+
+        def column(row, name):
+            return row[header[name]] if name in header else ""
+
+        tiers = {}
+        for row in reader:
+            if column(row, "TermType") != "OnDemand" or column(row, "Currency") != "USD":
+                continue
+            attributes = {
+                "capacitystatus": column(row, "Capacity Status") or "Used",
+                "preInstalledSw": column(row, "Pre Installed S/W") or "NA",
+            }
+            if not is_default_product(attributes):
+                continue
+            region = column(row, "Region Code")
+            usageType = column(row, "usageType")
+            if not region or not usageType:
+                continue
+            key = (column(row, "serviceCode") or service, region,
+                   normalize_usage_type(usageType), column(row, "operation"))
+            tiers.setdefault(key, []).append((column(row, "StartingRange"), column(row, "Unit"), float(column(row, "PricePerUnit"))))
+        for key, dimensions in tiers.items():
+            unit, price = pick_tier(dimensions)
+            yield key + (unit, price)
+
+def offer_files(directory=offersDir):
+    directory = Path(directory)
+    if not directory.is_dir():
+        return []
+    return sorted(p for p in directory.rglob("*") if p.suffix in (".json", ".csv"))
+
+class PriceIndex:
+    def __init__(self, path=indexPath, offers=offersDir):
+        self.path = Path(path)
+        self.offers = Path(offers)
+        self.lock = threading.Lock()
+        self.cache = {}
+        self.db = None
+
+    def connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(str(self.path), check_same_thread=False)
+            self.db.execute("""CREATE TABLE IF NOT EXISTS prices (
+                service TEXT, region TEXT, usage_type TEXT, operation TEXT, unit TEXT, price REAL,
+                PRIMARY KEY (service, region, usage_type, operation)) WITHOUT ROWID""")
+            self.db.execute("CREATE TABLE IF NOT EXISTS sources (path TEXT PRIMARY KEY, mtime REAL)")
+            if self.is_stale():
+                self.build()
+        return self.db
+
+    def is_stale(self):
+        compiled = dict(self.db.execute("SELECT path, mtime FROM sources"))
+        current = {str(p): p.stat().st_mtime for p in offer_files(self.offers)}
+        return compiled != current
+
+    # (Re)compile every offer file in the offers directory into the prices table
+    def build(self):
+        files = offer_files(self.offers)
+        log.info("Compiling pricing index from %s offer file(s)", len(files))
+        with self.db:
+            self.db.execute("DELETE FROM prices")
+            self.db.execute("DELETE FROM sources")
+            for path in files:
+                reader = read_csv_offer if path.suffix == ".csv" else read_json_offer
+                rows = (row[:4] + normalize_price(row[4], row[5]) for row in reader(path))
+                self.db.executemany("INSERT OR IGNORE INTO prices VALUES (?, ?, ?, ?, ?, ?)", rows)
+                self.db.execute("INSERT INTO sources VALUES (?, ?)", (str(path), path.stat().st_mtime))
+        self.cache = {}
+
+    # Look up a rate by (service, region, usage type). Without an operation the base operation
+    # wins, e.g. RunInstances (Linux) sorts before RunInstances:0002 (Windows).
+    def rate(self, service, region, usageType, operation=None, default=None):
+        key = (service, region, usageType, operation)
+        if key not in self.cache:
+            with self.lock:
+                db = self.connect()
+                if operation is None:
+                    row = db.execute(
+                        "SELECT price FROM prices WHERE service = ? AND region = ? AND usage_type = ? ORDER BY operation LIMIT 1",
+                        (service, region, usageType)).fetchone()
+                else:
+                    row = db.execute(
+                        "SELECT price FROM prices WHERE service = ? AND region = ? AND usage_type = ? AND operation = ?",
+                        (service, region, usageType, operation)).fetchone()
+            self.cache[key] = row[0] if row else None
+        price = self.cache[key]
+        return default if price is None else price
+
+_index = None
+
+def get_index():
+    global _index
+    if _index is None:
+        _index = PriceIndex()
+    return _index
+
+def get_rate(service, region, usageType, operation=None, default=None):
+    if region is None:
+        return default
+    return get_index().rate(service, region, usageType, operation, default)
@@ -0,0 +1,227 @@
+import datetime
+import math
+import random
+import sqlite3
+import threading
+from array import array
+from .metric_batch import build_query, iter_metric_pages, query_end
+
+# sketches of metric series are kept per UTC day in this SQLite database, next to the reports
+sketchFile = "metric_sketches.db"
+# k of the day sketches: about 100 values per day and a rank error of 3%, windows merge them into a larger k
+day_sketch_k = 64
+
+class KLLSketch:
+    """Mergeable streaming quantile sketch (Karnin, Lang, Liberty). Memory is bounded by
+    roughly 3k items whatever the number of values, the rank error is about 1.7/k."""
+
+    def __init__(self, k=256, compactors=None):
+        self.k = k
+        self.compactors = compactors or [[]]
+        self.size = sum(len(c) for c in self.compactors)
+        self.count = sum(len(c) << h for h, c in enumerate(self.compactors))
+        self.random = random.Random()
+
+    def capacity(self, height):
+        depth = len(self.compactors) - height - 1
+        return int(math.ceil((2 / 3) ** depth * self.k)) + 1
+
+    def maxSize(self):
+        return sum(self.capacity(h) for h in range(len(self.compactors)))
+
+    def update(self, value):
+        self.compactors[0].append(value)
+        self.size += 1
+        self.count += 1
+        if self.size >= self.maxSize():
+            self.compress()
+
+    def update_many(self, values):
+        for value in values:
+            self.update(value)
+
+    # Halve every full compactor into the next level, keeping every other item of the sorted compactor
+    def compress(self):
+        for height in range(len(self.compactors)):
+            if len(self.compactors[height]) >= self.capacity(height):
+                if height + 1 >= len(self.compactors):
+                    self.compactors.append([])
+                items = sorted(self.compactors[height])
+                leftover = [items.pop()] if len(items) % 2 else []
+                offset = self.random.randint(0, 1)
+                self.compactors[height + 1].extend(items[offset::2])
+                self.compactors[height] = leftover
+                self.size = sum(len(c) for c in self.compactors)
+                if self.size < self.maxSize():
+                    break
+
+    def merge(self, other):
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append([])
+        for height, items in enumerate(other.compactors):
+            self.compactors[height].extend(items)
+        self.size = sum(len(c) for c in self.compactors)
+        self.count += other.count
+        while self.size >= self.maxSize():
+            before = self.size
+            self.compress()
+            if self.size >= before:
+                break
+        return self
+
+    def quantile(self, q):
+        weighted = sorted((value, 1 << height) for height, c in enumerate(self.compactors) for value in c)
+        if not weighted:
+            return None
+        total = sum(weight for _, weight in weighted)
+        cumulative = 0
+        for value, weight in weighted:
+            cumulative += weight
+            if cumulative >= q * total:
+                return value
+        return weighted[-1][0]
+
+    def to_dict(self):
+        return {"k": self.k, "compactors": self.compactors}
+
+    # k, then the length and the items of every compactor, as doubles
+    def to_bytes(self):
+        packed = array("d", [self.k])
+        for c in self.compactors:
+            packed.append(len(c))
+            packed.extend(c)
+        return packed.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        packed = array("d")
+        packed.frombytes(data)
+        compactors, n = [], 1
+        while n < len(packed):
+            size = int(packed[n])
+            compactors.append(packed[n + 1:n + 1 + size].tolist())
+            n += 1 + size
+        return cls(int(packed[0]), compactors or None)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["k"], [list(c) for c in data["compactors"]])
+
+class SketchStore:
+    """Daily sketches per metric series in SQLite, so later runs only fetch the days they don't have
+    yet. A series is read when it is needed, memory holds the sketches of the series being evaluated."""
+
+    # without a path nothing is read or kept, every series is fetched in full
+    def __init__(self, path=sketchFile):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = None
+        # first day of the longest window this run, see save()
+        self.oldest = None
+
+    def connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            with self.db:
+                self.db.execute("""CREATE TABLE IF NOT EXISTS sketches (
+                    series TEXT, day TEXT, sketch BLOB, PRIMARY KEY (series, day))""")
+        return self.db
+
+    def get_days(self, key):
+        if not self.path:
+            return {}
+        with self.lock:
+            rows = self.connect().execute("SELECT day, sketch FROM sketches WHERE series = ?", (key,)).fetchall()
+        return {day: KLLSketch.from_bytes(data) for day, data in rows}
+
+    # Replace the stored days of a series, days that fell out of every window are dropped
+    def put_days(self, key, days, oldest):
+        if not self.path:
+            return
+        with self.lock:
+            self.oldest = oldest if self.oldest is None else min(self.oldest, oldest)
+            db = self.connect()
+            with db:
+                db.executemany("INSERT OR REPLACE INTO sketches VALUES (?, ?, ?)",
+                               [(key, day, sketch.to_bytes()) for day, sketch in days.items()])
+                db.execute("DELETE FROM sketches WHERE series = ? AND day < ?", (key, oldest))
+
+    # Series whose newest day fell out of the longest window, e.g. of deleted volumes, are dropped.
+    # The log is checkpointed, so the database file alone can be uploaded with the reports.
+    def save(self):
+        if not self.path or self.db is None:
+            return
+        with self.lock:
+            if self.oldest is not None:
+                with self.db:
+                    self.db.execute("""DELETE FROM sketches WHERE series IN (
+                        SELECT series FROM sketches GROUP BY series HAVING MAX(day) < ?)""", (self.oldest,))
+            self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+_store = None
+
+def get_sketch_store():
+    global _store
+    if _store is None:
+        _store = SketchStore()
+    return _store
+
+# Fetch every series in full instead of reusing stored days, e.g. while collecting a raw snapshot
+def disable_sketch_store():
+    global _store
+    _store = SketchStore(None)
+
+def save_sketches():
+    if _store is not None:
+        _store.save()
+
+def series_key(namespace, metricName, dimensions, period, stat):
+    dims = ",".join(f"{name}={value}" for name, value in sorted(dimensions.items()))
+    return f"{namespace}/{metricName}/{dims}/{period}/{stat}"
+
+# Sketches of a metric series over the last `days` days, for every window in `windows`. Complete UTC days
+# come from the sketch store, only the days it doesn't hold yet are fetched, page by page, straight into
+# sketches, once for the longest window. Every window merges the day sketches it covers.
+def window_sketches(cw, namespace, metricName, dimensions, period, stat, windows):
+    store = get_sketch_store()
+    key = series_key(namespace, metricName, dimensions, period, stat)
+    endTime = query_end()
+    startTime = endTime - datetime.timedelta(days=max(windows))
+    windowDays = [(startTime.date() + datetime.timedelta(days=n)).isoformat()
+                  for n in range((endTime.date() - startTime.date()).days + 1)]
+    today = endTime.date().isoformat()
+
+    stored = store.get_days(key)
+    missing = [day for day in windowDays if day not in stored or day == today]
+    fetched = {}
+    if missing:
+        # whole days are fetched, also the first day of the window, so every stored day is complete
+        fetchStart = datetime.datetime.fromisoformat(missing[0]).replace(tzinfo=datetime.timezone.utc)
+        if hasattr(cw, "day_sketches"):
+            # a metric stream index keeps the day sketches itself
+            fetched = cw.day_sketches(namespace, metricName, dimensions, period, stat, fetchStart, endTime)
+        else:
+            query = build_query("m", namespace, metricName, dimensions, period, stat)
+            for timestamps, values in iter_metric_pages(cw, query, fetchStart, endTime):
+                for timestamp, value in zip(timestamps, values):
+                    fetched.setdefault(timestamp.date().isoformat(), KLLSketch(day_sketch_k)).update(value)
+        # remember complete days even when they had no datapoints, today is fetched again next time
+        store.put_days(key, {day: fetched.get(day, KLLSketch(day_sketch_k)) for day in missing if day != today},
+                       windowDays[0])
+
+    sketches = {}
+    for days in windows:
+        firstDay = (endTime - datetime.timedelta(days=days)).date().isoformat()
+        sketch = KLLSketch()
+        for day in windowDays:
+            daySketch = fetched.get(day) if day in missing else stored.get(day)
+            if day >= firstDay and daySketch is not None:
+                sketch.merge(daySketch)
+        sketches[days] = sketch
+    return sketches
+
+# Sketch of a metric series over the last `days` days
+def window_sketch(cw, namespace, metricName, dimensions, period, stat, days=14):
+    return window_sketches(cw, namespace, metricName, dimensions, period, stat, [days])[days]
@@ -1,46 +1,54 @@
 import datetime
-import json
 import math
-from pathlib import Path
 import boto3
 import numpy as np
+from logs import log
+from . import rds_rightsizing
+from .pricing import get_rate
 from .storage_volume import StorageVolume
+from .triage import IDLE, triage_rule
+from .usage_windows import fetch_daily, lookback, window_rows
+
+snapshot_rate = 0.095  # $ per GB-month of backup storage
+serverless_acu_rate = 0.14  # $ per ACU-hour
+snapshot_retention_days = 30
+connection_window = 3  # days of connections the idle decision is based on
+serverless_window = 30  # days of serverless capacity the serverless cost is based on
 
 class RDSSnapshot:
-    def __init__(self, snapshot_id, rds_client):
-        self.snapshot_id = snapshot_id
-        self.rds = rds_client
-        self.get_snapshot_details()
-    
-    def get_snapshot_details(self):
-        snapshot = self.rds.describe_db_snapshots(DBSnapshotIdentifier=self.snapshot_id)['DBSnapshots'][0]
+    # snapshot is the record returned by describe_db_snapshots or describe_db_cluster_snapshots
+    def __init__(self, snapshot, region):
+        self.cluster = 'DBClusterSnapshotIdentifier' in snapshot
+        if self.cluster:
+            self.snapshot_id = snapshot['DBClusterSnapshotIdentifier']
+            self.source_id = snapshot['DBClusterIdentifier']
+        else:
+            self.snapshot_id = snapshot['DBSnapshotIdentifier']
+            self.source_id = snapshot['DBInstanceIdentifier']
         self.storage_size = snapshot['AllocatedStorage']
         self.engine = snapshot['Engine']
-        self.creation_time = snapshot['SnapshotCreateTime']
+        # snapshots that are still being created have no creation time yet
+        self.creation_time = snapshot.get('SnapshotCreateTime') or datetime.datetime.now(datetime.timezone.utc)
         self.status = snapshot['Status']
         self.type = snapshot['SnapshotType']
-        self.db_instance_id = snapshot['DBInstanceIdentifier']
+        self.tags = snapshot.get('TagList', [])
+        self.region = region
 
-    def is_unused(self, retention_days=30):
+    def is_unused(self, index, retention_days=None):
         # Check if snapshot is older than retention period
+        retention_days = snapshot_retention_days if retention_days is None else retention_days
         age = datetime.datetime.now(datetime.timezone.utc) - self.creation_time
         if age.days > retention_days:
-            # Check if this is the most recent snapshot for a deleted instance
-            try:
-                self.rds.describe_db_instances(DBInstanceIdentifier=self.db_instance_id)
+            if index.source_exists(self):
                 # Instance exists, so this is just an old snapshot
                 return True
-            except self.rds.exceptions.DBInstanceNotFoundFault:
-                # Instance doesn't exist, check if this is the newest snapshot
-                snapshots = self.rds.describe_db_snapshots(DBInstanceIdentifier=self.db_instance_id)['DBSnapshots']
-                newest_snapshot = max(snapshots, key=lambda x: x['SnapshotCreateTime'])
-                return self.snapshot_id != newest_snapshot['DBSnapshotIdentifier']
+            # Instance doesn't exist, keep its newest snapshot
+            return not index.is_newest(self)
         return False
 
     def get_savings(self):
-        # RDS snapshot pricing is typically $0.095 per GB-month for most regions
-        # This is a simplified calculation and should be adjusted based on region and storage type
-        snapshot_price = self.storage_size * 0.095
+        rate = get_rate("AmazonRDS", self.region, "RDS:ChargedBackupUsage", default=snapshot_rate)
+        snapshot_price = self.storage_size * rate
         return {
             "currentType": f"Snapshot-{self.type}",
             "currentPrice": snapshot_price,
@@ -48,19 +56,71 @@ class RDSSnapshot:
             "newPrice": 0
         }
 
+class SnapshotIndex:
+    """The DB instances, DB clusters and snapshots (manual, automated and cluster) of a region,
+    each listed once, with the snapshots indexed by the instance or cluster they were taken from.
+    ids restricts the index to these DB instances, e.g. for event driven rescans."""
+
+    def __init__(self, rdsClient, region, ids=None):
+        self.instances = {}
+        self.clusters = set()
+        self.snapshots = {}
+        filters = [{'Name': 'db-instance-id', 'Values': ids}] if ids else []
+        for page in rdsClient.get_paginator('describe_db_instances').paginate(Filters=filters):
+            for db in page['DBInstances']:
+                self.instances[db['DBInstanceIdentifier']] = db
+
+        if ids:
+            pages = (page for id in ids for page in
+                     rdsClient.get_paginator('describe_db_snapshots').paginate(DBInstanceIdentifier=id))
+            self.add_snapshots(pages, 'DBSnapshots', region)
+        else:
+            for page in rdsClient.get_paginator('describe_db_clusters').paginate():
+                self.clusters.update(cluster['DBClusterIdentifier'] for cluster in page['DBClusters'])
+            self.add_snapshots(rdsClient.get_paginator('describe_db_snapshots').paginate(), 'DBSnapshots', region)
+            self.add_snapshots(rdsClient.get_paginator('describe_db_cluster_snapshots').paginate(),
+                               'DBClusterSnapshots', region)
+
+        self.newest = {source: max(snapshots, key=lambda x: x.creation_time).snapshot_id
+                       for source, snapshots in self.snapshots.items()}
+
+    def add_snapshots(self, pages, key, region):
+        for page in pages:
+            for record in page[key]:
+                snapshot = RDSSnapshot(record, region)
+                self.snapshots.setdefault((snapshot.cluster, snapshot.source_id), []).append(snapshot)
+
+    def __iter__(self):
+        for snapshots in self.snapshots.values():
+            yield from snapshots
+
+    def snapshots_of(self, identifier):
+        return self.snapshots.get((False, identifier), [])
+
+    def source_exists(self, snapshot):
+        if snapshot.cluster:
+            return snapshot.source_id in self.clusters
+        return snapshot.source_id in self.instances
+
+    def is_newest(self, snapshot):
+        return self.newest.get((snapshot.cluster, snapshot.source_id)) == snapshot.snapshot_id
+
 class DatabaseInstance:
-    def __init__(self, identifier, region, cwClient, rdsClient):
-        self.identifier = identifier
-        self.region = region["RegionName"]
+    # specs is the record of the instance returned by describe_db_instances, verdict the outcome of
+    # the triage: an instance triaged as idle is priced without fetching its metrics
+    def __init__(self, specs, region, cwClient, rdsClient, verdict=None):
+        self.identifier = specs['DBInstanceIdentifier']
+        self.region = region
         self.cw = cwClient
         self.rds = rdsClient
-        self.getInstanceSpecs()
-        self.getPerformanceMetrics()
-        self.check_snapshots()
+        self.getInstanceSpecs(specs)
+        if verdict == IDLE:
+            self.maxConn = 0
+        else:
+            self.getPerformanceMetrics()
     
-    # Fetch and set specifications of running datbabase instance
-    def getInstanceSpecs(self):
-        specs = self.rds.describe_db_instances(DBInstanceIdentifier=self.identifier)['DBInstances'][0]
+    # Set specifications of running datbabase instance
+    def getInstanceSpecs(self, specs):
         if "aurora" not in specs['Engine']:
             if "Iops" in specs:
                 self.iops = specs['Iops']
@@ -78,63 +138,43 @@ class DatabaseInstance:
         self.storageType = specs['StorageType']
         self.multiAZ = specs['MultiAZ']
         self.engine = specs['Engine']
+        self.licenseModel = specs.get('LicenseModel')
         self.status = specs['DBInstanceStatus']
 
-    # Fetch and set maxConn --> max number of connections per day over past 3 days
-    # Fetch and set cpu p99.9 --> p999 of maximum cpu usage in 1 min intervals over a max period of 14 days
-    # Fetch and set memory p99.5 --> p995 of minimum available memory in 1 min intervals over a max period of 14 days
+    # Fetch and set maxConn --> max number of connections per day over the connection window
+    # The daily series of connections (and of capacity for serverless instances) are fetched once,
+    # over the longest window, and sliced locally
     def getPerformanceMetrics(self):
-        # fetch and set connection count
-        activeConnPerDay = self.cw.get_metric_data(
-            MetricDataQueries=[
-                {
-                    "Id": "dbi",
-                    "MetricStat": {
-                        "Metric": {
-                            "Namespace": "AWS/RDS",
-                            "MetricName": "DatabaseConnections",
-                            "Dimensions": [
-                                {"Name": "DBInstanceIdentifier", "Value": self.identifier}
-                            ],
-                        },
-                        "Period": 86400,
-                        "Stat": "Sum",
-                    },
-                },
-            ],
-            StartTime=datetime.datetime.now(datetime.timezone.utc)
-            - datetime.timedelta(days=3),
-            EndTime=datetime.datetime.now(datetime.timezone.utc),
-        )['MetricDataResults'][0]['Values']
-        self.maxConn = -1
-        for connDay in activeConnPerDay:
-            if connDay > self.maxConn:
-                self.maxConn = connDay
+        dimensions = {"DBInstanceIdentifier": self.identifier}
+        # p99 CPU and the lowest freeable memory size the class of a busy instance, see rds_rightsizing
+        metrics = {"connections": ("AWS/RDS", "DatabaseConnections", dimensions, "Sum"),
+                   "cpu": ("AWS/RDS", "CPUUtilization", dimensions, "p99"),
+                   "freeable": ("AWS/RDS", "FreeableMemory", dimensions, "Minimum")}
+        days = max(connection_window, rds_rightsizing.rightsizing_window)
+        if self.instanceType == "db.serverless":
+            metrics["acus"] = ("AWS/RDS", "ServerlessDatabaseCapacity", dimensions, "Average")
+            days = max(days, serverless_window)
+        self.series = fetch_daily(self.cw, metrics, lookback(days))
+        self.maxConn = self.maxConnections(connection_window)
+
+    def maxConnections(self, days):
+        maxConn = self.series["connections"].aggregate(days, "max")
+        return -1 if maxConn is None else maxConn
+
+    # (p99 CPU percent, lowest freeable memory in GiB) over the rightsizing window
+    def rightsizingUsage(self):
+        days = rds_rightsizing.rightsizing_window
+        cpu = self.series["cpu"].aggregate(days, "max")
+        freeable = self.series["freeable"].aggregate(days, "min")
+        return cpu, None if freeable is None else freeable / 2**30
+
+    def windowUsage(self):
+        return window_rows("DatabaseConnections", self.maxConnections, lambda days: self.maxConnections(days) == 0)
 
-        
     def calculateServerlessCost(self):
-        avgACUs = self.cw.get_metric_data(
-            MetricDataQueries=[
-                {
-                    "Id": "dbi",
-                    "MetricStat": {
-                        "Metric": {
-                            "Namespace": "AWS/RDS",
-                            "MetricName": "ServerlessDatabaseCapacity",
-                            "Dimensions": [
-                                {"Name": "DBInstanceIdentifier", "Value": self.identifier}
-                            ],
-                        },
-                        "Period": 86400,
-                        "Stat": "Average",
-                    },
-                },
-            ],
-            StartTime=datetime.datetime.now(datetime.timezone.utc)
-            - datetime.timedelta(days=30),
-            EndTime=datetime.datetime.now(datetime.timezone.utc),
-        )['MetricDataResults'][0]['Values']
-        return np.mean(avgACUs) * 0.14 * 24 * 30
+        avgACUs = self.series["acus"].window(serverless_window)
+        rate = get_rate("AmazonRDS", self.region, "Aurora:ServerlessV2Usage", default=serverless_acu_rate)
+        return np.mean(avgACUs) * rate * 24 * 30
     # if old gen CPU, first, move up to current gen
     # if graviton == True, pick rightsized CPU and mem with graviton in it
     # if d (instance store), keep instance store same size --> just convert to graviton
@@ -157,35 +197,37 @@ class DatabaseInstance:
                 "newInstanceType": self.instanceType,
                 "newInstancePrice": serverlessCost
             }
-        path = Path(__file__).parent / "../aws-data/dbiPricing.json"
-        with path.open() as f:
-            dbi_rate = json.load(f)
-        
-        path = Path(__file__).parent / "../aws-data/dbiPricing.json"
-        with path.open() as f:
-            aurora_rate = json.load(f)
+        # a stopped instance bills no instance hours, only its storage, until AWS starts it again
+        if self.status == "stopped":
+            return {
+                "currentInstanceType": self.instanceType,
+                "currentInstancePrice": 0,
+                "newInstanceType": "None (stopped, auto-starts after 7 days)",
+                "newInstancePrice": 0
+            }
 
-        # check if DB is idle
+        # check if DB is idle, an engine without a price is not reported
         if self.maxConn == 0:
-            if self.aurora:
-                return {
-                    "currentInstanceType": self.instanceType,
-                    "currentInstancePrice": aurora_rate[self.region][self.instanceType]["instancePrice"]*24*30,
-                    "newInstanceType": "None",
-                    "newInstancePrice": 0
-                }
+            price = rds_rightsizing.monthly_price(self.region, self.instanceType, self.aurora, self.multiAZ,
+                                                  rds_rightsizing.pricing_engine(self.engine, self.licenseModel))
+            if price is None:
+                log.warning("No price of %s for %s (%s) in %s, idle instance %s is not reported", self.instanceType,
+                            self.engine, self.licenseModel, self.region, self.identifier)
+                return None
             return {
                 "currentInstanceType": self.instanceType,
-                "currentInstancePrice": dbi_rate[self.region][self.instanceType]["instancePrice"]*24*30,
+                "currentInstancePrice": price,
                 "newInstanceType": "None",
                 "newInstancePrice": 0
             }
-        
+        # busy instances move to the cheapest class that fits their p99 CPU and used memory,
+        # check_rds_instances sizes the instances of a region together with rds_rightsizing directly
+        return rds_rightsizing.rightsize_classes([self], [self.rightsizingUsage()])[0]
 
     def rightsizeStorage(self):
         if not self.aurora:
             # check if DB is not idle
-            volume = StorageVolume(self.storageType, self.storageSize, self.iops, self.throughput)
+            volume = StorageVolume(self.storageType, self.storageSize, self.iops, self.throughput, self.region)
             if self.maxConn == 0:
                 return {
                     "currentType": self.storageType,
@@ -207,14 +249,9 @@ class DatabaseInstance:
             return True
         return False
 
-    def check_snapshots(self):
-        try:
-            snapshots = self.rds.describe_db_snapshots(DBInstanceIdentifier=self.identifier)['DBSnapshots']
-            self.unused_snapshots = []
-            for snapshot in snapshots:
-                snapshot_obj = RDSSnapshot(snapshot['DBSnapshotIdentifier'], self.rds)
-                if snapshot_obj.is_unused():
-                    self.unused_snapshots.append(snapshot_obj)
-        except Exception as error:
-            print(f"Error checking snapshots for {self.identifier}: {error}")
-            self.unused_snapshots = []
\ No newline at end of file
+# a stopped instance serves no connections, it is started again automatically after seven days
+@triage_rule(DatabaseInstance)
+def stopped(db):
+    if db['DBInstanceStatus'] == 'stopped' and db['DBInstanceClass'] != 'db.serverless':
+        return IDLE
+    return None
@@ -0,0 +1,192 @@
+import json
+import re
+from pathlib import Path
+import numpy as np
+from logs import log
+from .pricing import get_rate
+
+cpu_target_utilization = 70  # percent of the new class's vCPUs the p99 CPU may use
+memory_headroom = 0.2  # share of the used memory kept free on the new class
+rightsizing_window = 14  # days of CPU and freeable memory the recommendation is based on
+
+# previous generation families are never recommended, instances on them move to a current generation
+previous_generations = {"m1", "m2", "m3", "m4", "r3", "r4", "t1", "t2", "cr1"}
+
+# operation of the on-demand instance rates of each engine and license model in the RDS price list
+engine_operations = {
+    ("mysql", None): "CreateDBInstance:0002",
+    ("postgres", None): "CreateDBInstance:0014",
+    ("mariadb", None): "CreateDBInstance:0018",
+    ("aurora", None): "CreateDBInstance:0016",
+    ("aurora-mysql", None): "CreateDBInstance:0016",
+    ("aurora-postgresql", None): "CreateDBInstance:0021",
+    ("oracle-ee", "bring-your-own-license"): "CreateDBInstance:0005",
+    ("oracle-se2", "bring-your-own-license"): "CreateDBInstance:0019",
+    ("oracle-se2", "license-included"): "CreateDBInstance:0020",
+    ("sqlserver-ex", "license-included"): "CreateDBInstance:0010",
+    ("sqlserver-web", "license-included"): "CreateDBInstance:0011",
+    ("sqlserver-se", "license-included"): "CreateDBInstance:0012",
+    ("sqlserver-ee", "license-included"): "CreateDBInstance:0015",
+}
+# engines without a license fee, they cost the rates of dbiPricing.json and auroraPricing.json
+# when the pricing index has no offer file of AmazonRDS
+open_engines = {"mysql", "postgres", "mariadb", "aurora", "aurora-mysql", "aurora-postgresql"}
+
+_indexes = {}
+_pricing = {}
+
+def _load(name):
+    if name not in _pricing:
+        with (Path(__file__).parent / f"../aws-data/{name}").open() as f:
+            _pricing[name] = json.load(f)
+    return _pricing[name]
+
+# "160 GiB" -> 160.0
+def _number(value):
+    return float(str(value).split()[0].replace(",", ""))
+
+def family(instanceClass):
+    return instanceClass.split(".")[1]
+
+# burstable classes only rightsize within the burstable families, the others never into them
+def is_burstable(instanceClass):
+    return family(instanceClass).startswith("t")
+
+def is_graviton(instanceClass):
+    match = re.match(r"[a-z]+\d+([a-z]*)", family(instanceClass))
+    return match is not None and "g" in match.group(1)
+
+# instance store (d) and memory optimized x and z classes are not rightsized
+def is_supported(instanceClass):
+    name = family(instanceClass)
+    return not (name.startswith(("x", "z")) or re.match(r"[a-z]+\d+[a-z]*d$", name))
+
+# a Multi-AZ instance runs a standby of the same class, Aurora replicas are instances of their own
+def price_multiplier(multiAZ, aurora):
+    return 2 if multiAZ and not aurora else 1
+
+# (engine, license model) an instance is priced by, the license model only matters for licensed engines
+def pricing_engine(engine, licenseModel=None):
+    engine = engine[:-4] if engine.endswith("-cdb") else engine
+    return (engine, None) if engine in open_engines else (engine, licenseModel)
+
+# Hourly on-demand rate of a class for an engine, from the pricing index. The rate of the JSON
+# pricing files (listed) is only used for open engines, None when the engine has no price.
+def class_rate(region, instanceClass, engine, listed=None):
+    operation = engine_operations.get(engine)
+    rate = get_rate("AmazonRDS", region, f"InstanceUsage:{instanceClass}", operation) if operation else None
+    if rate is None and engine[0] in open_engines:
+        return listed
+    return rate
+
+# Monthly on-demand price of an instance, with the standby of a Multi-AZ instance, None when its
+# engine has no price
+def monthly_price(region, instanceClass, aurora, multiAZ, engine=("mysql", None)):
+    listed = _load("auroraPricing.json" if aurora else "dbiPricing.json").get(region, {}).get(instanceClass, {})
+    rate = class_rate(region, instanceClass, engine, listed.get("instancePrice"))
+    return None if rate is None else rate * price_multiplier(multiAZ, aurora) * 24 * 30
+
+class ClassIndex:
+    """Instance classes of one region, engine and license model as arrays sorted by (vCPU, memory, price),
+    the first class with enough vCPUs for a requirement is found by binary search"""
+
+    def __init__(self, classes):
+        order = sorted(classes, key=lambda name: classes[name])
+        self.names = np.array(order)
+        self.vcpu = np.array([classes[name][0] for name in order], dtype=np.float64)
+        self.memory = np.array([classes[name][1] for name in order], dtype=np.float64)
+        self.price = np.array([classes[name][2] for name in order], dtype=np.float64)
+        self.burstable = np.array([is_burstable(name) for name in order], dtype=bool)
+        self.graviton = np.array([is_graviton(name) for name in order], dtype=bool)
+        self.candidate = np.array([is_supported(name) and family(name) not in previous_generations
+                                   for name in order], dtype=bool)
+        self.position = {name: n for n, name in enumerate(order)}
+
+    def spec(self, instanceClass):
+        n = self.position.get(instanceClass)
+        if n is None:
+            return None
+        return float(self.vcpu[n]), float(self.memory[n]), float(self.price[n])
+
+    # Position of the cheapest class with at least needCpu vCPUs and needMemory GiB for every row,
+    # -1 when there is none. burstable and noGraviton restrict the families per row.
+    def cheapest(self, needCpu, needMemory, burstable, noGraviton):
+        if len(self.names) == 0:
+            return np.full(len(needCpu), -1)
+        start = np.searchsorted(self.vcpu, needCpu, side="left")
+        columns = np.arange(len(self.names))
+        fits = (columns[None, :] >= start[:, None]) & (self.memory[None, :] >= needMemory[:, None])
+        fits &= burstable[:, None] == self.burstable[None, :]
+        fits &= ~(noGraviton[:, None] & self.graviton[None, :])
+        fits &= self.candidate[None, :]
+        prices = np.where(fits, self.price[None, :], np.inf)
+        best = prices.argmin(axis=1)
+        return np.where(np.isfinite(prices[np.arange(len(best)), best]), best, -1)
+
+# Index of the classes of a region and engine, built once per process: Aurora classes from the Aurora
+# pricing with the vCPU and memory of aurora_instance_specs.json where it knows the class. Classes the
+# engine has no price for are left out, so a licensed engine without its offer file has none.
+def class_index(region, aurora, engine=("mysql", None)):
+    key = (region, aurora, engine)
+    if key not in _indexes:
+        classes = {}
+        if aurora:
+            specs = _load("aurora_instance_specs.json")
+            for name, rate in _load("auroraPricing.json").get(region, {}).items():
+                spec = specs.get(name, {})
+                vcpu, memory = spec.get("vcpu", rate.get("vcpu")), spec.get("mem", rate.get("memory"))
+                price = class_rate(region, name, engine, rate.get("instancePrice"))
+                if vcpu and memory and price:
+                    classes[name] = (_number(vcpu), _number(memory), price)
+        else:
+            for name, rate in _load("dbiPricing.json").get(region, {}).items():
+                price = class_rate(region, name, engine, rate.get("instancePrice"))
+                if rate.get("vcpu") and rate.get("memory") and price:
+                    classes[name] = (_number(rate["vcpu"]), _number(rate["memory"]), price)
+        if not classes:
+            log.warning("No instance prices of %s (%s) in %s, its instances are not rightsized", engine[0],
+                        engine[1] or "no license", region)
+        _indexes[key] = ClassIndex(classes)
+    return _indexes[key]
+
+# Recommend the cheapest class for every instance in one vectorized pass per region, engine and
+# license model. usages are (p99 CPU percent, minimum freeable memory in GiB), None without datapoints.
+# Returns a rightsizeCompute result per instance, keeping the class when nothing cheaper fits.
+def rightsize_classes(instances, usages):
+    results = [None] * len(instances)
+    groups = {}
+    for n, instance in enumerate(instances):
+        engine = pricing_engine(instance.engine, instance.licenseModel)
+        groups.setdefault((instance.region, instance.aurora, engine), []).append(n)
+    for (region, aurora, engine), members in groups.items():
+        index = class_index(region, aurora, engine)
+        rows, needCpu, needMemory, burstable, noGraviton = [], [], [], [], []
+        for n in members:
+            instance, (cpu, freeable) = instances[n], usages[n]
+            spec = index.spec(instance.instanceType)
+            if spec is None:
+                continue
+            multiplier = price_multiplier(instance.multiAZ, aurora)
+            results[n] = {
+                "currentInstanceType": instance.instanceType,
+                "currentInstancePrice": spec[2] * multiplier * 24 * 30,
+                "newInstanceType": instance.instanceType,
+                "newInstancePrice": spec[2] * multiplier * 24 * 30
+            }
+            if cpu is None or freeable is None or not is_supported(instance.instanceType):
+                continue
+            rows.append(n)
+            needCpu.append(spec[0] * cpu / cpu_target_utilization)
+            needMemory.append(max(spec[1] - freeable, 0) * (1 + memory_headroom))
+            burstable.append(is_burstable(instance.instanceType))
+            noGraviton.append(instance.engine.startswith(("sqlserver", "oracle")))
+        if not rows:
+            continue
+        best = index.cheapest(np.array(needCpu), np.array(needMemory), np.array(burstable), np.array(noGraviton))
+        for n, position in zip(rows, best):
+            multiplier = price_multiplier(instances[n].multiAZ, aurora)
+            newPrice = float(index.price[position]) * multiplier * 24 * 30
+            if position >= 0 and newPrice < results[n]["currentInstancePrice"]:
+                results[n]["newInstanceType"] = str(index.names[position])
+                results[n]["newInstancePrice"] = newPrice
+    return results
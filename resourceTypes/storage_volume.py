@@ -1,3 +1,7 @@
+import numpy as np
+from logs import log
+from .pricing import get_rate
+
 IopsThroughput = {
     "gp3": {
         "iops": 16000,
@@ -38,70 +42,135 @@ volumes_io2_iops_rate_3 = (
     0.035  # $0.035/provisioned IOPS-month for greater than 64,000 IOPS
 )
 
+# usage types of the EBS rates in the AmazonEC2 offer, the constants above are used for
+# regions that are not covered by an offer file in aws-data/offers
+ebsUsageTypes = {
+    "gp2": ("EBS:VolumeUsage.gp2", volumes_gp2_rate),
+    "gp3": ("EBS:VolumeUsage.gp3", volumes_gp3_rate),
+    "gp3_iops": ("EBS:VolumeP-IOPS.gp3", volumes_gp3_iops_rate),
+    "gp3_throughput": ("EBS:VolumeP-Throughput.gp3", volumes_gp3_througput_rate),
+    "st1": ("EBS:VolumeUsage.st1", volumes_st1_rate),
+    "sc1": ("EBS:VolumeUsage.sc1", volumes_sc1_rate),
+    "io1": ("EBS:VolumeUsage.piops", volumes_io1_storage_rate),
+    "io1_iops": ("EBS:VolumeP-IOPS.piops", volumes_io1_iops_rate),
+    "io2": ("EBS:VolumeUsage.io2", volumes_io2_storage_rate),
+    "io2_iops_1": ("EBS:VolumeP-IOPS.io2", volumes_io2_iops_rate_1),
+    "io2_iops_2": ("EBS:VolumeP-IOPS.io2.tier2", volumes_io2_iops_rate_2),
+    "io2_iops_3": ("EBS:VolumeP-IOPS.io2.tier3", volumes_io2_iops_rate_3),
+}
+
+def get_ebs_rates(region=None):
+    return {
+        name: get_rate("AmazonEC2", region, usageType, default=default)
+        for name, (usageType, default) in ebsUsageTypes.items()
+    }
+
+# row order of the fleet cost matrix and the target types of the what-if analysis
+fleetTypes = ["gp2", "gp3", "st1", "sc1", "io1", "io2"]
+candidateTypes = ["gp3", "st1", "sc1", "io2"]
+
 class StorageVolume:
-    def __init__(self, type, size, iops=3000, throughput=125):
+    def __init__(self, type, size, iops=3000, throughput=125, region=None):
         self.type = type
         self.size = size
         self.iops = iops
         self.throughput = throughput
+        self.rates = get_ebs_rates(region)
 
     def calculateStorageCost(self, type, size, iops, throughput):
+        rates = self.rates
         storageCost = 0
         if type == "gp2":
-            storageCost = size * volumes_gp2_rate
+            storageCost = size * rates["gp2"]
         elif type == "gp3":
-            storageCost = size * volumes_gp3_rate
+            storageCost = size * rates["gp3"]
             if iops > 3000:
-                storageCost = storageCost + (iops - 3000) * volumes_gp3_iops_rate
+                storageCost = storageCost + (iops - 3000) * rates["gp3_iops"]
             if throughput is not None:
                 if throughput > 125:
                     storageCost = (
-                        storageCost + (throughput - 125) * volumes_gp3_througput_rate
+                        storageCost + (throughput - 125) * rates["gp3_throughput"]
                     )
         elif type == "st1":
-            storageCost = size * volumes_st1_rate
+            storageCost = size * rates["st1"]
         elif type == "sc1":
-            storageCost = size * volumes_sc1_rate
+            storageCost = size * rates["sc1"]
         elif type == "io1":
-            storageCost = (size * volumes_io1_storage_rate)
-            storageCost = storageCost + iops * volumes_io1_iops_rate
+            storageCost = (size * rates["io1"])
+            storageCost = storageCost + iops * rates["io1_iops"]
         elif type == "io2":
-            storageCost = (size * volumes_io1_storage_rate)
+            storageCost = (size * rates["io2"])
             if iops < 32000:
-                storageCost = storageCost + iops * volumes_io2_iops_rate_1
+                storageCost = storageCost + iops * rates["io2_iops_1"]
             elif iops > 64000:
-                storageCost = storageCost + iops * volumes_io2_iops_rate_3
+                storageCost = storageCost + iops * rates["io2_iops_3"]
             else:
-                storageCost = storageCost + iops * volumes_io2_iops_rate_2
+                storageCost = storageCost + iops * rates["io2_iops_2"]
 
         return storageCost
     
     def getSavings(self):
-        print(self.iops, self.throughput)
-        if self.iops < IopsThroughput["sc1"]["iops"] and self.throughput < IopsThroughput["sc1"]["throughput"] and self.size > 125:
-            return {
-                "currentType": self.type,
-                "currentPrice": self.calculateStorageCost(self.type, self.size, self.iops, self.throughput),
-                "newType": "sc1",
-                "newPrice": self.calculateStorageCost("sc1", self.size, self.iops, self.throughput)
-            }
-        if self.iops < IopsThroughput["st1"]["iops"] and self.throughput < IopsThroughput["st1"]["throughput"] and self.size > 125:
-            return {
-                "currentType": self.type,
-                "currentPrice": self.calculateStorageCost(self.type, self.size, self.iops, self.throughput),
-                "newType": "st1",
-                "newPrice": self.calculateStorageCost("st1", self.size, self.iops, self.throughput)
-            }
-        if self.iops < IopsThroughput["gp3"]["iops"]:
-            return {
-                "currentType": self.type,
-                "currentPrice": self.calculateStorageCost(self.type, self.size, self.iops, self.throughput),
-                "newType": "gp3",
-                "newPrice": self.calculateStorageCost("gp3", self.size, self.iops, self.throughput)
-            }
+        log.debug("Pricing %s volume of %s GiB with %s IOPS and %s MiB/s", self.type, self.size, self.iops, self.throughput)
+        whatIf = fleetWhatIf([self.type], [self.size], [self.iops], [self.throughput], rates=self.rates)
         return {
             "currentType": self.type,
-            "currentPrice": self.calculateStorageCost(self.type, self.size, self.iops, self.throughput),
-            "newType": "io2",
-            "newPrice": self.calculateStorageCost("io2", self.size, self.iops, self.throughput)
-        }
\ No newline at end of file
+            "currentPrice": float(whatIf["currentPrice"][0]),
+            "newType": str(whatIf["newType"][0]),
+            "newPrice": float(whatIf["newPrice"][0])
+        }
+
+def _as_array(values):
+    return np.array([0 if v is None else v for v in values], dtype=float)
+
+# Vectorized calculateStorageCost: the monthly cost of every volume under every type in fleetTypes,
+# as a matrix with one row per type and one column per volume
+def calculateFleetStorageCost(sizes, iops, throughputs, rates):
+    io2IopsRate = np.where(iops < 32000, rates["io2_iops_1"],
+                           np.where(iops > 64000, rates["io2_iops_3"], rates["io2_iops_2"]))
+    return np.vstack([
+        sizes * rates["gp2"],
+        sizes * rates["gp3"]
+        + np.maximum(iops - 3000, 0) * rates["gp3_iops"]
+        + np.maximum(throughputs - 125, 0) * rates["gp3_throughput"],
+        sizes * rates["st1"],
+        sizes * rates["sc1"],
+        sizes * rates["io1"] + iops * rates["io1_iops"],
+        sizes * rates["io2"] + iops * io2IopsRate,
+    ])
+
+# What-if analysis for a fleet of EBS volumes or RDS storage volumes in one NumPy pass: the current
+# cost, the cost under every candidate type and the cheapest candidate that meets the IOPS,
+# throughput and size requirements of each volume
+def fleetWhatIf(types, sizes, iops, throughputs, region=None, rates=None):
+    if rates is None:
+        rates = get_ebs_rates(region)
+    sizes = _as_array(sizes)
+    iops = _as_array(iops)
+    throughputs = _as_array(throughputs)
+    costs = calculateFleetStorageCost(sizes, iops, throughputs, rates)
+    columns = np.arange(len(sizes))
+
+    # volume types the calculator does not know (e.g. magnetic) cost 0, as in calculateStorageCost
+    typeIndex = np.array([fleetTypes.index(t) if t in fleetTypes else -1 for t in types], dtype=int)
+    currentPrice = np.where(typeIndex >= 0, costs[np.maximum(typeIndex, 0), columns], 0.0)
+
+    eligible = []
+    for candidate in candidateTypes:
+        limits = IopsThroughput[candidate]
+        meets = (iops < limits["iops"]) & (throughputs <= limits["throughput"])
+        if candidate in ("st1", "sc1"):
+            meets &= (throughputs < limits["throughput"]) & (sizes > 125)
+        if candidate == "io2":
+            # io2 is the fallback for everything the other types can't serve
+            meets = np.ones(len(sizes), dtype=bool)
+        eligible.append(meets)
+    candidateCosts = costs[[fleetTypes.index(c) for c in candidateTypes]]
+    candidateCosts = np.where(np.vstack(eligible), candidateCosts, np.inf)
+    cheapest = np.argmin(candidateCosts, axis=0)
+
+    return {
+        "currentPrice": currentPrice,
+        "candidatePrices": {c: costs[fleetTypes.index(c)] for c in candidateTypes},
+        "newType": np.array(candidateTypes)[cheapest],
+        "newPrice": candidateCosts[cheapest, columns],
+    }
@@ -0,0 +1,20 @@
+# Triage classifies a resource from its describe record alone, before any metric is fetched.
+# Rules are registered per resource class with @triage_rule(ResourceClass), they return IDLE,
+# IN_USE or None when the record does not tell; resources no rule decides go to the metric stage.
+IDLE = "idle"
+IN_USE = "in use"
+
+def triage_rule(resourceClass):
+    def register(rule):
+        if "triage_rules" not in vars(resourceClass):
+            resourceClass.triage_rules = []
+        resourceClass.triage_rules.append(rule)
+        return rule
+    return register
+
+def triage(resourceClass, record):
+    for rule in vars(resourceClass).get("triage_rules", []):
+        verdict = rule(record)
+        if verdict is not None:
+            return verdict
+    return None
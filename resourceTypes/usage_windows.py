@@ -0,0 +1,55 @@
+import datetime
+import numpy as np
+from .metric_batch import build_query, get_metric_series_batched
+
+# lookback windows in days that usage is reported for, next to the window a check decides on
+windows = []
+# usage and idleness of every resource per window
+windowsFile = "usage_windows.csv"
+windowsHeader = ['Account', 'Region', 'ResourceType', 'ResourceId', 'Metric', 'WindowDays', 'Value', 'Idle']
+
+aggregations = {"sum": np.sum, "average": np.mean, "max": np.max, "min": np.min}
+
+def set_windows(days):
+    windows[:] = sorted(set(days))
+
+# Days to fetch so that every window, and the window a check decides on, can be sliced from one series
+def lookback(decisionWindow):
+    return max(windows + [decisionWindow])
+
+class DailySeries:
+    """Datapoints of one metric over the longest window, sliced and re-aggregated locally per window.
+    A datapoint belongs to a window when its period ends inside it, so the oldest bucket of a fetch
+    over `days` days still counts in a window of `days` days."""
+
+    def __init__(self, timestamps, values, end=None, period=86400):
+        end = end or datetime.datetime.now(datetime.timezone.utc)
+        # days between the end of each datapoint's period and now
+        self.age = np.array([((end - t).total_seconds() - period) / 86400 for t in timestamps], dtype=np.float64)
+        self.values = np.array(values, dtype=np.float64)
+
+    def window(self, days):
+        return self.values[self.age < days]
+
+    # Aggregate of the datapoints of the last `days` days, None when there are none
+    def aggregate(self, days, how):
+        values = self.window(days)
+        if len(values) == 0:
+            return None
+        return float(aggregations[how](values))
+
+    def count(self, days):
+        return int(np.count_nonzero(self.age < days))
+
+# Fetch daily datapoints of several metrics of one resource in a single get_metric_data call.
+# metrics maps a name to (namespace, metricName, dimensions, stat).
+def fetch_daily(cw, metrics, days, period=86400):
+    queries = [build_query(f"m{n}", namespace, metricName, dimensions, period, stat)
+               for n, (namespace, metricName, dimensions, stat) in enumerate(metrics.values())]
+    results = get_metric_series_batched(cw, queries, days)
+    return {name: DailySeries(*results[f"m{n}"], period=period) for n, name in enumerate(metrics)}
+
+# Rows of the usage windows report for one resource: the value of a metric in every window
+# and whether the resource counts as idle in that window, both are functions of the window days
+def window_rows(metric, value_for, idle_for):
+    return [(metric, days, value_for(days), idle_for(days)) for days in windows]
@@ -1,15 +1,16 @@
 import boto3
 from datetime import datetime, timezone
-import csv
+from writeToCSV import write_to_csv
+from logs import log
 
 class VPC:
     def __init__(self):
         self.unused_vpcs = []
 
-    def check_vpc_usage(self, region, account_id):
+    def check_vpc_usage(self, region, account_id, ec2_client=None):
         try:
-            session = boto3.Session(region_name=region)
-            ec2_client = session.client('ec2')
+            if ec2_client is None:
+                ec2_client = boto3.Session(region_name=region).client('ec2')
             
             # Get all VPCs in the region
             vpcs = ec2_client.describe_vpcs()['Vpcs']
@@ -22,12 +23,12 @@ class VPC:
                 if is_default:
                     continue
                 
-                print(f"Found VPC: {vpc_id} in region {region}")
+                log.debug("Found VPC: %s in region %s", vpc_id, region)
                 # Check for resources using this VPC
                 is_unused = self._check_vpc_resources(ec2_client, vpc_id)
                 
                 if is_unused:
-                    print(f"VPC {vpc_id} is identified as unused")
+                    log.debug("VPC %s is identified as unused", vpc_id)
                     vpc_info = {
                         'Account ID': account_id,
                         'Region': region,
@@ -42,7 +43,7 @@ class VPC:
             return self.unused_vpcs
         
         except Exception as e:
-            print(f"Error checking VPCs in region {region}: {str(e)}")
+            log.error("Error checking VPCs in region %s: %s", region, e)
             return []
 
     def _check_vpc_resources(self, ec2_client, vpc_id):
@@ -84,7 +85,7 @@ class VPC:
             return True
 
         except Exception as e:
-            print(f"Error checking VPC resources for {vpc_id}: {str(e)}")
+            log.error("Error checking VPC resources for %s: %s", vpc_id, e)
             return False
 
     def _get_vpc_name(self, vpc):
@@ -101,8 +102,7 @@ class VPC:
             return
             
         fieldnames = ['Account ID', 'Region', 'VPC ID', 'CIDR Block', 'Name', 'State', 'Creation Time']
-        
-        with open('vpc.csv', 'w', newline='') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(self.unused_vpcs) 
\ No newline at end of file
+
+        # append, so the VPCs of every region and account end up in the report
+        for vpc_info in self.unused_vpcs:
+            write_to_csv('vpc.csv', *[vpc_info[field] for field in fieldnames], header=fieldnames) 
\ No newline at end of file
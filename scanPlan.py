@@ -0,0 +1,198 @@
+import contextvars
+import csv
+import json
+import math
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+from pathlib import Path
+from clients import get_client
+from eventRescan import checkFindings
+from findings import read_findings, savings
+from resourceTypes.ebs_snapshot import get_snapshot_rates
+from resourceTypes.ec2_instance import get_instance_rate
+from resourceTypes.efs import EFSStandardRate
+from resourceTypes.elastic_ip import eip_hourly_rate
+from resourceTypes.load_balancer import elb_hourly_rate
+from resourceTypes.nat_gateway import natgw_hourly_rate
+from resourceTypes.storage_volume import get_ebs_rates
+from logs import log
+
+summary_files = ["unscanned.csv", "run_summary.csv"]
+
+# one check of one region of one account, with the monthly cost it is expected to uncover
+WorkUnit = namedtuple("WorkUnit", ["account", "region", "check", "estimate"])
+
+checkForType = {resourceType: check for check, (types, _) in checkFindings.items() for resourceType in types}
+checkForType["VPC"] = "vpc"
+
+# services every check calls, a check is skipped once the circuit of one of them is open
+checkServices = {
+    "ebs": ["ec2", "cloudwatch"],
+    "snapshots": ["ec2"],
+    "ec2": ["ec2", "cloudwatch"],
+    "eip": ["ec2"],
+    "elb": ["elbv2", "cloudwatch", "resourcegroupstaggingapi"],
+    "natgw": ["ec2", "cloudwatch"],
+    "efs": ["efs", "cloudwatch"],
+    "rds": ["rds", "cloudwatch"],
+    "dynamodb": ["dynamodb", "cloudwatch", "resourcegroupstaggingapi"],
+    "vpc": ["ec2"],
+}
+
+# share of --deadline the inventory of every region may take before the scan starts
+inventory_share = 0.1
+
+# hourly rate used for database instances that are not in the pricing file
+default_db_hourly_rate = 0.2
+
+class Deadline:
+    def __init__(self, seconds=None):
+        self.end = time.time() + seconds if seconds else None
+
+    def remaining(self):
+        return None if self.end is None else max(self.end - time.time(), 0)
+
+    def expired(self):
+        return self.end is not None and time.time() >= self.end
+
+# Savings per (account, region, check) found by a previous run
+def estimates_from_report(path):
+    estimates = {}
+    for finding in read_findings(path):
+        key = (finding.account, finding.region, checkForType.get(finding.resourceType))
+        estimates[key] = estimates.get(key, 0.0) + max(savings(finding), 0.0)
+    return estimates
+
+_dbRates = None
+
+def _db_hourly_rate(region, instanceClass):
+    global _dbRates
+    if _dbRates is None:
+        with (Path(__file__).parent / "aws-data/dbiPricing.json").open() as f:
+            _dbRates = json.load(f)
+    return _dbRates.get(region, {}).get(instanceClass, {}).get("instancePrice", default_db_hourly_rate)
+
+# Every item of a paginated describe call
+def paginate(client, operation, key, **kwargs):
+    for page in client.get_paginator(operation).paginate(**kwargs):
+        yield from page[key]
+
+# Monthly cost of what each check looks at in a region, from one paginated describe call per check.
+# This is an upper bound of the savings it can find, good enough to order the scan.
+def inventory_estimates(region, session=None):
+    month = 24 * 30
+    ec2 = lambda: get_client('ec2', region, session)
+    estimators = {
+        "ebs": lambda: sum(v["Size"] for v in paginate(ec2(), 'describe_volumes', "Volumes",
+            Filters=[{'Name': 'status', 'Values': ['available']}])) * get_ebs_rates(region)["gp2"],
+        "snapshots": lambda: sum(s["VolumeSize"] for s in paginate(ec2(), 'describe_snapshots', "Snapshots",
+            OwnerIds=['self'])) * get_snapshot_rates(region)["standard"],
+        "ec2": lambda: sum((get_instance_rate(region, i["InstanceType"]) or 0) * month
+                           for r in paginate(ec2(), 'describe_instances', "Reservations",
+                               Filters=[{'Name': 'instance-state-name', 'Values': ['running']}])
+                           for i in r["Instances"]),
+        "eip": lambda: sum(1 for a in ec2().describe_addresses()["Addresses"]
+                           if a.get("AssociationId") is None) * eip_hourly_rate * month,
+        "elb": lambda: sum(1 for _ in paginate(get_client('elbv2', region, session), 'describe_load_balancers',
+                                               "LoadBalancers")) * elb_hourly_rate * month,
+        "natgw": lambda: sum(1 for n in paginate(ec2(), 'describe_nat_gateways', "NatGateways")
+                             if n["State"] == "available") * natgw_hourly_rate * month,
+        "efs": lambda: sum(fs["SizeInBytes"]["Value"] for fs in paginate(get_client('efs', region, session),
+                                                                         'describe_file_systems', "FileSystems"))
+                       / 1024 ** 3 * EFSStandardRate,
+        "rds": lambda: sum(_db_hourly_rate(region, db["DBInstanceClass"]) * month
+                           for db in paginate(get_client('rds', region, session), 'describe_db_instances', "DBInstances")),
+        "dynamodb": lambda: float(sum(1 for _ in paginate(get_client('dynamodb', region, session), 'list_tables', "TableNames"))),
+        "vpc": lambda: 0.0,
+    }
+    estimates = {}
+    for check, estimate in estimators.items():
+        try:
+            estimates[check] = estimate()
+        except Exception as error:
+            log.error("Error estimating %s in %s: %s", check, region, error)
+            estimates[check] = 0.0
+    return estimates
+
+# Inventory every region of every account on `workers` threads for at most `budget` seconds. Regions
+# whose inventory did not finish in time have no estimate and are scanned in the default order.
+def inventory_all(sessions, regions, workers, budget):
+    pool = ThreadPoolExecutor(max_workers=workers)
+    futures = {pool.submit(contextvars.copy_context().run, inventory_estimates, region, session): (account, region)
+               for account, session in sessions.items() for region in regions}
+    done, pending = wait(futures, timeout=budget)
+    # inventories that did not start are dropped, the running ones end with their region
+    pool.shutdown(wait=False, cancel_futures=True)
+    if pending:
+        log.warning("Inventory of %s of %s region(s) did not finish within %.0fs, they are scanned in the default order",
+                    len(pending), len(futures), budget)
+    estimates = {}
+    for future in done:
+        account, region = futures[future]
+        for check, estimate in future.result().items():
+            estimates[(account, region, check)] = estimate
+    return estimates
+
+# Estimates within a factor of ten of each other are in the same band, see plan()
+def estimate_band(estimate):
+    return math.floor(math.log10(estimate)) if estimate > 1 else 0
+
+# Order every (account, region, check) by the cost it is expected to uncover, most expensive first.
+# Units with the same estimate keep the fixed scan order.
+# group_regions puts the same check of one region of all accounts next to each other within each
+# estimate band, so that parallel checks of different accounts can share the metric calls of a
+# monitoring account
+def plan(accounts, regions, checks, estimates, group_regions=False):
+    units = []
+    for account in accounts:
+        for region in regions:
+            for check in checks:
+                units.append(WorkUnit(account, region, check, estimates.get((account, region, check), 0.0)))
+    order = {check: n for n, check in enumerate(checks)}
+    if group_regions:
+        return sorted(units, key=lambda u: (-estimate_band(u.estimate), u.region, order[u.check], -u.estimate))
+    return sorted(units, key=lambda u: (-u.estimate, order[u.check]))
+
+def write_unscanned(units, reason, path="unscanned.csv"):
+    with open(path, 'a', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        if csvfile.tell() == 0:
+            writer.writerow(['Account', 'Region', 'Check', 'EstimatedCost', 'Reason'])
+        for unit in units:
+            writer.writerow([unit.account, unit.region, unit.check, unit.estimate, reason])
+
+def write_run_summary(rows, path="run_summary.csv"):
+    with open(path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['Account', 'Region', 'Check', 'Status', 'Seconds', 'Reason'])
+        for unit, status, seconds, reason in rows:
+            writer.writerow([unit.account, unit.region, unit.check, status, round(seconds, 1), reason or ""])
+    counts = {}
+    for _, status, _, _ in rows:
+        counts[status] = counts.get(status, 0) + 1
+    log.info("Run summary: %s", ", ".join(f"{count} {status}" for status, count in counts.items()))
+
+# Run a check on a thread of its own for at most `timeout` seconds (None waits for it).
+# A check that runs longer is left behind and its next API call fails, see Breakers.cancel.
+# Returns None when the check completed, otherwise why it did not.
+def run_with_limit(check, args, timeout, breakers):
+    errors = []
+
+    def target():
+        try:
+            check(*args)
+        except Exception as error:
+            errors.append(error)
+
+    # the check's thread logs with the account, region and check of the caller
+    thread = threading.Thread(target=contextvars.copy_context().run, args=(target,), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        breakers.cancel(thread)
+        return "timeout"
+    if errors:
+        return f"error: {errors[0]}"
+    return None
@@ -0,0 +1,221 @@
+import heapq
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import writeToCSV
+from writeToCSV import collecting
+from clients import forget_session
+from findingStore import FindingStore
+from findings import normalize, report_files, savings
+from eventRescan import checkFindings, start_consumer
+from scanPlan import checkForType
+from resourceTypes.quantile_sketch import save_sketches
+from logs import log, log_context, recording_errors
+
+# assumed role credentials last an hour, renew the session before they run out
+session_ttl = 50 * 60
+
+durationUnits = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+# Parse durations such as 90, 30m, 6h or 1d into seconds
+def parse_duration(value):
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([smhd]?)", value.strip())
+    if not match:
+        raise ValueError(f"invalid duration: {value}")
+    return float(match.group(1)) * durationUnits[match.group(2) or "s"]
+
+# Parse per-region schedules such as "eu-west-1=1h,us-east-1=30m"
+def parse_schedules(value):
+    schedules = {}
+    for item in value.split(",") if value else []:
+        region, duration = item.split("=", 1)
+        schedules[region.strip()] = parse_duration(duration)
+    return schedules
+
+# Normalized findings of the rows a scan wrote to the reports
+def report_findings(rows):
+    return [normalize(os.path.basename(file_path), [str(v) for v in row])
+            for file_path, row, _ in rows if os.path.basename(file_path) in report_files]
+
+class Daemon:
+    def __init__(self, get_session, accounts, regions, interval, schedules=None, workers=4, checks=None):
+        self.checks = checks or {}
+        self.get_session = get_session
+        self.accounts = accounts
+        self.regions = regions
+        self.interval = interval
+        self.schedules = schedules or {}
+        self.store = FindingStore()
+        self.status = {}
+        self.sessions = {}
+        self.sessionLock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.running = set()
+        self.scopeLocks = {}
+
+    # Keep one warm session per account, renewed before its credentials expire
+    def session_for(self, account):
+        with self.sessionLock:
+            session, created = self.sessions.get(account, (None, 0))
+            if session is None or time.time() - created > session_ttl:
+                if session is not None:
+                    forget_session(session)
+                session = self.get_session(account)
+                self.sessions[account] = (session, time.time())
+            return session
+
+    # A scheduled scan and event rescans of the same (account, region) run one after the other,
+    # so the findings stored last are always from the scan that started last
+    def scope_lock(self, account, region):
+        with self.sessionLock:
+            return self.scopeLocks.setdefault((account, region), threading.Lock())
+
+    # Run one check of a scope. The checks log the errors they recover from and return, any error
+    # logged or raised means the findings are incomplete: returns (findings, error or None).
+    def run_check(self, account, region, check, ids=None):
+        try:
+            with log_context(account=account, region=region, check=check), collecting() as rows, \
+                    recording_errors() as errors:
+                self.checks[check](region, account, self.session_for(account), **({} if ids is None else {"ids": ids}))
+        except Exception as e:
+            errors.append(str(e))
+        return report_findings(rows), errors[0] if errors else None
+
+    # Scan every check of a scope. The findings of a check that failed are kept from its previous scan.
+    def scan_scope(self, account, region):
+        started = time.time()
+        found = 0
+        failed = {}
+        log.info("Scanning region: %s in account: %s", region, account)
+        try:
+            with self.scope_lock(account, region):
+                for check in self.checks:
+                    findings, error = self.run_check(account, region, check)
+                    if error:
+                        failed[check] = error
+                        log.warning("%s check in region %s of account %s failed, keeping its previous findings: %s",
+                                    check, region, account, error)
+                        continue
+                    found += len(findings)
+                    self.store.replace_matching(lambda f: checkForType.get(f.resourceType) == check, findings,
+                                                (account, region))
+            save_sketches()
+        except Exception as e:
+            failed["scan"] = str(e)
+            log.error("Error scanning region %s in account %s: %s", region, account, e)
+        finally:
+            self.status[(account, region)] = {
+                "account": account,
+                "region": region,
+                "lastScan": started,
+                "duration": time.time() - started,
+                "findings": found,
+                "failedChecks": sorted(failed),
+                "error": "; ".join(f"{check}: {error}" for check, error in failed.items()) or None
+            }
+            self.running.discard((account, region))
+
+    # Rerun one check for a set of resources (or for the whole region when ids is None)
+    # and replace only the findings of those resources, unless the check failed
+    def rescan(self, account, region, check, ids=None):
+        resourceTypes, findingId = checkFindings[check]
+        targets = None if ids is None else {findingId(id) for id in ids}
+
+        def affected(finding):
+            if finding.account != account or finding.region != region or finding.resourceType not in resourceTypes:
+                return False
+            # RDS snapshot findings are reported as <instance>-<snapshot>, or deleted-<snapshot> once the
+            # instance is gone, and are matched by either ID
+            return targets is None or finding.resourceId in targets or \
+                any(finding.resourceId.startswith(t + "-") or finding.resourceId.endswith("-" + t)
+                    for t in targets if finding.resourceType == "RDSSnapshot")
+
+        with self.scope_lock(account, region):
+            findings, error = self.run_check(account, region, check, ids)
+            if error:
+                log.warning("Rescan of %s in region %s of account %s failed, keeping its previous findings: %s",
+                            check, region, account, error)
+                return
+            self.store.replace_matching(affected, findings, (account, region))
+
+    def interval_for(self, region):
+        return self.schedules.get(region, self.interval)
+
+    # Rescan every (account, region) on its own schedule, a scope is never scanned twice at once
+    def run_scheduler(self, stop):
+        due = [(0, account, region) for account in self.accounts for region in self.regions]
+        heapq.heapify(due)
+        while not stop.is_set():
+            nextRun, account, region = due[0]
+            wait = nextRun - time.time()
+            if wait > 0:
+                stop.wait(min(wait, 60))
+                continue
+            heapq.heappop(due)
+            heapq.heappush(due, (time.time() + self.interval_for(region), account, region))
+            if (account, region) not in self.running:
+                self.running.add((account, region))
+                self.pool.submit(self.scan_scope, account, region)
+
+def make_handler(daemon):
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, body, status=200):
+            payload = json.dumps(body, default=str).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            if url.path == "/health":
+                self.send_json({"status": "ok", "findings": len(daemon.store)})
+            elif url.path == "/scans":
+                self.send_json(list(daemon.status.values()))
+            elif url.path == "/findings":
+                try:
+                    minCost = float(params["min_cost"]) if "min_cost" in params else None
+                    limit = int(params["limit"]) if "limit" in params else None
+                except ValueError as error:
+                    self.send_json({"error": str(error)}, 400)
+                    return
+                findings = daemon.store.query(params.get("account"), params.get("region"),
+                                              params.get("type"), minCost, limit)
+                self.send_json([dict(f._asdict(), savings=savings(f)) for f in findings])
+            else:
+                self.send_json({"error": "not found"}, 404)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+def serve(get_session, accounts, regions, interval, schedules=None, workers=4, host="127.0.0.1", port=8080,
+          checks=None, events_queue=None, events_dir=None):
+    daemon = Daemon(get_session, accounts, regions, interval, schedules, workers, checks)
+    # findings are kept in memory only, no CSV files are written in serve mode
+    writeToCSV.write_files = False
+
+    stop = threading.Event()
+    scheduler = threading.Thread(target=daemon.run_scheduler, args=(stop,), daemon=True)
+    scheduler.start()
+    if events_queue or events_dir:
+        start_consumer(daemon, events_queue, events_dir, stop)
+
+    server = ThreadingHTTPServer((host, port), make_handler(daemon))
+    log.info("Serving findings on http://%s:%s", host, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+        daemon.pool.shutdown(wait=False)
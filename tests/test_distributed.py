@@ -0,0 +1,101 @@
+import json
+import threading
+import time
+import distributed
+import writeToCSV
+from distributed import Coordinator, Worker
+from localQueue import LocalQueue
+from scanPlan import Deadline, WorkUnit
+from writeToCSV import collecting
+
+def receive(queue, timeout=30):
+    return queue.receive_message(MaxNumberOfMessages=1, VisibilityTimeout=timeout,
+                                 AttributeNames=["ApproximateReceiveCount"]).get("Messages", [])
+
+def test_expired_lease_is_redelivered_with_its_receive_count(tmp_path):
+    queue = LocalQueue(str(tmp_path))
+    queue.send_message(MessageBody="unit")
+    first = receive(queue, timeout=0.1)
+    assert [m["Attributes"]["ApproximateReceiveCount"] for m in first] == ["1"]
+    assert receive(queue) == []
+    time.sleep(0.2)
+    second = receive(queue)
+    assert [(m["Body"], m["Attributes"]["ApproximateReceiveCount"]) for m in second] == [("unit", "2")]
+    queue.delete_message(ReceiptHandle=second[0]["ReceiptHandle"])
+    time.sleep(0.1)
+    assert receive(queue) == []
+
+def test_heartbeat_extends_the_lease(tmp_path, monkeypatch):
+    monkeypatch.setattr(distributed, "lease_seconds", 0.3)
+    queue = LocalQueue(str(tmp_path))
+    queue.send_message(MessageBody="unit")
+    message = receive(queue, timeout=0.3)[0]
+    worker = Worker(queue, None, None, None, {}, None)
+    stop = threading.Event()
+    beat = threading.Thread(target=worker.heartbeat, args=(message, stop))
+    beat.start()
+    try:
+        time.sleep(0.8)
+        assert receive(queue) == []
+    finally:
+        stop.set()
+        beat.join()
+    # the original receipt handle still deletes the message after the lease was extended
+    queue.delete_message(ReceiptHandle=message["ReceiptHandle"])
+    time.sleep(0.4)
+    assert receive(queue) == []
+
+def coordinator(tmp_path, units):
+    results = LocalQueue(str(tmp_path / "results"))
+    return Coordinator(units, LocalQueue(str(tmp_path / "work")), None, results, None, Deadline(5)), results
+
+def test_coordinator_reassembles_chunks_and_drops_duplicate_attempts(tmp_path, monkeypatch):
+    monkeypatch.setattr(distributed, "rows_per_message", 2)
+    monkeypatch.setattr(writeToCSV, "write_files", False)
+    unit = WorkUnit("111111111111", "eu-west-1", "ebs", 0.0)
+    coord, results = coordinator(tmp_path, [unit])
+    worker = Worker(None, None, results, None, {}, None)
+    rows = [("ebs.csv", ["111111111111", "eu-west-1", "EBSVolume", f"vol-{n}"], None) for n in range(5)]
+    # a worker thought dead and the worker that took the unit over both send their findings
+    worker.send_results(coord.run, unit, rows, "complete", 1.0, None)
+    worker.send_results(coord.run, unit, rows, "complete", 2.0, None)
+    with collecting() as written:
+        summary = coord.collect()
+    assert [row[3] for _, row, _ in written] == [f"vol-{n}" for n in range(5)]
+    assert [(u, status, reason) for u, status, _, reason in summary] == [(unit, "complete", None)]
+
+def test_coordinator_waits_for_every_chunk(tmp_path, monkeypatch):
+    monkeypatch.setattr(writeToCSV, "write_files", False)
+    unit = WorkUnit("111111111111", "eu-west-1", "ebs", 0.0)
+    coord, _ = coordinator(tmp_path, [unit])
+    chunk = {"run": coord.run, "unit": unit._asdict(), "attempt": "a", "chunks": 2, "status": "complete",
+             "seconds": 1.0, "reason": None}
+    with collecting() as written:
+        coord.receive(dict(chunk, chunk=1, rows=[["ebs.csv", ["b"], None]]))
+        assert written == [] and coord.units
+        # a chunk of another run is ignored
+        coord.receive(dict(chunk, run="other", chunk=0, rows=[["ebs.csv", ["x"], None]]))
+        coord.receive(dict(chunk, chunk=0, rows=[["ebs.csv", ["a"], None]]))
+    assert [row for _, row, _ in written] == [("a",), ("b",)]
+    assert not coord.units
+
+def test_unit_lost_too_often_is_reported_incomplete(tmp_path, monkeypatch):
+    monkeypatch.setattr(writeToCSV, "write_files", False)
+    work = LocalQueue(str(tmp_path / "work"))
+    results = LocalQueue(str(tmp_path / "results"))
+    unit = WorkUnit("111111111111", "eu-west-1", "ebs", 0.0)
+    work.send_message(MessageBody=json.dumps({"run": "r", "expires": None, "unit": unit._asdict()}))
+    for _ in range(distributed.max_attempts):
+        receive(work, timeout=0)
+    message = receive(work)[0]
+    assert int(message["Attributes"]["ApproximateReceiveCount"]) == distributed.max_attempts + 1
+
+    def check(*args):
+        raise AssertionError("a unit past max_attempts is not scanned again")
+
+    worker = Worker(work, None, results, None, {"ebs": check}, None)
+    worker.process(message)
+    result = json.loads(receive(results)[0]["Body"])
+    assert (result["status"], result["reason"], result["rows"]) == \
+        ("incomplete", f"worker lost {distributed.max_attempts} times", [])
+    assert receive(work, timeout=0) == []
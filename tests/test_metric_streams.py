@@ -0,0 +1,157 @@
+import datetime
+import gzip
+import json
+import pytest
+from metricStreams import DayStats, MetricStreamClient, MetricStreamIndex
+
+today = datetime.datetime.now(datetime.timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+
+def day(n):
+    return today - datetime.timedelta(days=n)
+
+def record(when, value, metric="VolumeReadOps", volume="vol-1", account="111111111111", region="eu-west-1",
+           namespace="AWS/EBS"):
+    return {"account_id": account, "region": region, "namespace": namespace, "metric_name": metric,
+            "dimensions": {"VolumeId": volume}, "timestamp": int(when.timestamp() * 1000), "unit": "Count",
+            "value": value}
+
+def lines(records):
+    return "".join(json.dumps(r) + "\n" for r in records)
+
+def value(v, **percentiles):
+    return dict({"max": v, "min": v, "sum": v, "count": 1.0}, **percentiles)
+
+# one datapoint per hour from `days` days ago until now
+def hourly(days, v=1.0, **fields):
+    hours = int((datetime.datetime.now(datetime.timezone.utc) - day(days)).total_seconds() // 3600)
+    return [record(day(days) + datetime.timedelta(hours=h), value(v), **fields) for h in range(hours + 1)]
+
+def query(stat, metric="VolumeReadOps", volume="vol-1", namespace="AWS/EBS", period=86400):
+    return {"Id": "m0", "MetricStat": {"Metric": {"Namespace": namespace, "MetricName": metric,
+                                                  "Dimensions": [{"Name": "VolumeId", "Value": volume}]},
+                                       "Period": period, "Stat": stat}}
+
+def fetch(client, stat, days=3, **fields):
+    result = client.get_metric_data(MetricDataQueries=[query(stat, **fields)], StartTime=day(days),
+                                    EndTime=datetime.datetime.now(datetime.timezone.utc), ScanBy="TimestampAscending")
+    return result["MetricDataResults"][0]
+
+def index(directory):
+    streams = MetricStreamIndex(str(directory))
+    streams.refresh(force=True)
+    return streams
+
+def test_indexes_json_and_gzip_files_into_daily_statistics(tmp_path):
+    (tmp_path / "a.json").write_text(lines(hourly(3)))
+    with gzip.open(tmp_path / "b.json.gz", "wt") as f:
+        f.write(lines([record(day(1) + datetime.timedelta(hours=1), value(9.0)),
+                       record(day(1) + datetime.timedelta(hours=2), {"max": 4.0, "min": 0.5, "sum": 6.0, "count": 3.0})]))
+    client = MetricStreamClient(index(tmp_path), "111111111111", "eu-west-1")
+    maximum = fetch(client, "Maximum")
+    assert maximum["Timestamps"] == [day(3), day(2), day(1), day(0)]
+    assert maximum["Values"][2] == 9.0
+    assert fetch(client, "Minimum")["Values"][2] == 0.5
+    assert fetch(client, "Sum")["Values"][:3] == [24.0, 24.0, 39.0]
+    assert fetch(client, "SampleCount")["Values"][2] == 28.0
+    assert fetch(client, "Average")["Values"][2] == pytest.approx(39.0 / 28.0)
+
+def test_appended_lines_are_indexed_once(tmp_path):
+    stream = tmp_path / "stream.json"
+    points = hourly(2)
+    partial = json.dumps(points[-1])
+    stream.write_text(lines(points[:-1]) + partial[:20])
+    streams = index(tmp_path)
+    client = MetricStreamClient(streams, "111111111111", "eu-west-1")
+    before = sum(fetch(client, "SampleCount", days=2)["Values"])
+    assert before == len(points) - 1
+    with open(stream, "a") as f:
+        f.write(partial[20:] + "\n" + lines([record(day(0), value(5.0), volume="vol-2")]))
+    streams.refresh(force=True)
+    assert sum(fetch(client, "SampleCount", days=2)["Values"]) == len(points)
+    assert fetch(client, "Maximum", days=2, volume="vol-2")["Values"] == [5.0]
+    # nothing new: a second refresh reads nothing again
+    streams.refresh(force=True)
+    assert sum(fetch(client, "SampleCount", days=2)["Values"]) == len(points)
+
+def otlp_request(when, quantiles, account="111111111111", region="eu-west-1"):
+    return {"resourceMetrics": [{
+        "resource": {"attributes": [{"key": "cloud.account.id", "value": {"stringValue": account}},
+                                    {"key": "cloud.region", "value": {"stringValue": region}}]},
+        "scopeMetrics": [{"metrics": [{"name": "amazonaws.com/AWS/RDS/CPUUtilization", "summary": {"dataPoints": [{
+            "attributes": [{"key": "Namespace", "value": {"stringValue": "AWS/RDS"}},
+                           {"key": "MetricName", "value": {"stringValue": "CPUUtilization"}},
+                           {"key": "Dimensions", "value": {"kvlistValue": {"values": [
+                               {"key": "DBInstanceIdentifier", "value": {"stringValue": "db-1"}}]}}}],
+            "timeUnixNano": str(int(when.timestamp() * 1e9)), "count": "4", "sum": 100.0,
+            "quantileValues": [{"quantile": q, "value": v} for q, v in quantiles]}]}}]}]}]}
+
+def test_otlp_summaries_map_quantiles_to_statistics(tmp_path):
+    requests = [otlp_request(day(n) + datetime.timedelta(hours=h), [(0, 5.0), (0.99, 80.0 + n), (1, 90.0)])
+                for n in range(3) for h in range(0, 24, 6)]
+    (tmp_path / "otlp.json").write_text(lines(requests))
+    client = MetricStreamClient(index(tmp_path), "111111111111", "eu-west-1")
+    rds = {"Id": "m0", "MetricStat": {"Metric": {"Namespace": "AWS/RDS", "MetricName": "CPUUtilization",
+                                                 "Dimensions": [{"Name": "DBInstanceIdentifier", "Value": "db-1"}]},
+                                      "Period": 86400, "Stat": "p99"}}
+    end = datetime.datetime.now(datetime.timezone.utc)
+    p99 = client.get_metric_data(MetricDataQueries=[rds], StartTime=day(2), EndTime=end)["MetricDataResults"][0]
+    # newest first by default
+    assert p99["Values"] == [80.0, 81.0, 82.0]
+    for stat, expected in (("Minimum", 5.0), ("Maximum", 90.0), ("p50", 90.0), ("Sum", 100.0 * 4)):
+        rds["MetricStat"]["Stat"] = stat
+        result = client.get_metric_data(MetricDataQueries=[rds], StartTime=day(2), EndTime=end)["MetricDataResults"][0]
+        assert result["Values"][0] == expected
+
+def test_day_statistics():
+    stats = DayStats()
+    assert stats.stat("Average") is None
+    stats.add({"max": 3.0, "min": 1.0, "sum": 4.0, "count": 2.0, "p90": 2.5})
+    assert (stats.stat("Maximum"), stats.stat("Minimum"), stats.stat("Average"), stats.stat("p90")) == (3.0, 1.0, 2.0, 2.5)
+    # a percentile the stream does not export is bounded by the maximum
+    assert stats.stat("p99") == 3.0
+    with pytest.raises(ValueError):
+        stats.stat("IQM")
+
+def test_unsupported_queries_fail(tmp_path):
+    (tmp_path / "a.json").write_text(lines(hourly(3)))
+    client = MetricStreamClient(index(tmp_path), "111111111111", "eu-west-1")
+    with pytest.raises(ValueError):
+        fetch(client, "Maximum", period=300)
+    with pytest.raises(ValueError):
+        client.get_metric_data(MetricDataQueries=[{"Id": "e", "Expression": "m0 * 2"}], StartTime=day(1), EndTime=today)
+
+def test_covered_window_without_datapoints_is_no_activity(tmp_path):
+    (tmp_path / "a.json").write_text(lines(hourly(3)))
+    client = MetricStreamClient(index(tmp_path), "111111111111", "eu-west-1")
+    assert fetch(client, "Maximum", volume="vol-idle")["Values"] == []
+
+def test_uncovered_windows_fail(tmp_path):
+    points = [p for p in hourly(6) if not day(3) <= datetime.datetime.fromtimestamp(
+        p["timestamp"] / 1000, datetime.timezone.utc) < day(2)]
+    (tmp_path / "a.json").write_text(lines(points))
+    streams = index(tmp_path)
+    client = MetricStreamClient(streams, "111111111111", "eu-west-1")
+    assert fetch(client, "Maximum", days=2)["Values"]
+    # a day without any datapoint of the namespace inside the window
+    with pytest.raises(ValueError, match="do not cover"):
+        fetch(client, "Maximum", days=5)
+    # a window that starts before the stream
+    with pytest.raises(ValueError, match="do not cover"):
+        fetch(client, "Maximum", days=10)
+    # an account, region or namespace the stream does not hold
+    for account, region in (("222222222222", "eu-west-1"), ("111111111111", "us-east-1")):
+        with pytest.raises(ValueError, match="do not cover"):
+            fetch(MetricStreamClient(streams, account, region), "Maximum", days=2)
+    with pytest.raises(ValueError, match="do not cover"):
+        fetch(client, "Maximum", days=2, namespace="AWS/EC2")
+
+def test_day_sketches_of_sketched_metrics(tmp_path):
+    (tmp_path / "a.json").write_text(lines(hourly(2, v=7.0, metric="VolumeReadBytes")))
+    client = MetricStreamClient(index(tmp_path), "111111111111", "eu-west-1")
+    end = datetime.datetime.now(datetime.timezone.utc)
+    sketches = client.day_sketches("AWS/EBS", "VolumeReadBytes", {"VolumeId": "vol-1"}, 60, "Maximum", day(2), end)
+    assert sorted(sketches) == [day(n).date().isoformat() for n in (2, 1, 0)]
+    assert sketches[day(1).date().isoformat()].count == 24
+    assert sketches[day(1).date().isoformat()].quantile(0.999) == 7.0
+    with pytest.raises(ValueError):
+        client.day_sketches("AWS/EBS", "VolumeReadOps", {"VolumeId": "vol-1"}, 60, "Maximum", day(2), end)
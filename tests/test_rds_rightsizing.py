@@ -0,0 +1,54 @@
+import numpy as np
+from resourceTypes import rds_rightsizing
+from resourceTypes.rds_rightsizing import ClassIndex, pricing_engine
+
+classes = {
+    "db.t3.medium": (2, 4, 0.068),
+    "db.t3.large": (2, 8, 0.136),
+    "db.m5.large": (2, 8, 0.171),
+    "db.m6g.large": (2, 8, 0.152),
+    "db.m5.xlarge": (4, 16, 0.342),
+    "db.m6g.xlarge": (4, 16, 0.304),
+    "db.r5.large": (2, 16, 0.24),
+    "db.m4.large": (2, 8, 0.1),
+    "db.m5d.large": (2, 8, 0.05),
+}
+
+def cheapest(index, rows):
+    needCpu, needMemory, burstable, noGraviton = (np.array(column) for column in zip(*rows))
+    return [None if n < 0 else str(index.names[n]) for n in index.cheapest(needCpu, needMemory, burstable, noGraviton)]
+
+def test_cheapest_class_that_fits():
+    index = ClassIndex(classes)
+    assert cheapest(index, [(1.5, 6, False, False)]) == ["db.m6g.large"]
+    assert cheapest(index, [(3, 6, False, False)]) == ["db.m6g.xlarge"]
+    assert cheapest(index, [(1, 12, False, False)]) == ["db.r5.large"]
+
+def test_cheapest_vectorized_rows():
+    index = ClassIndex(classes)
+    assert cheapest(index, [(1.5, 6, False, False), (3, 6, False, True), (1, 3, True, False)]) == \
+        ["db.m6g.large", "db.m5.xlarge", "db.t3.medium"]
+
+def test_cheapest_respects_families():
+    index = ClassIndex(classes)
+    # burstable instances stay burstable, the others never move into them
+    assert cheapest(index, [(1, 6, True, False)]) == ["db.t3.large"]
+    assert cheapest(index, [(1, 2, False, False)]) == ["db.m6g.large"]
+    # previous generation and instance store classes are never recommended, however cheap
+    assert "db.m4.large" not in cheapest(index, [(1, 1, False, True)])
+    assert "db.m5d.large" not in cheapest(index, [(1, 1, False, True)])
+
+def test_cheapest_without_fit():
+    index = ClassIndex(classes)
+    assert cheapest(index, [(64, 6, False, False), (1, 512, False, False)]) == [None, None]
+    assert list(ClassIndex({}).cheapest(np.array([1.0]), np.array([1.0]), np.array([False]), np.array([False]))) == [-1]
+
+def test_pricing_engine_keeps_license_of_licensed_engines():
+    assert pricing_engine("postgres", "postgresql-license") == ("postgres", None)
+    assert pricing_engine("sqlserver-se", "license-included") == ("sqlserver-se", "license-included")
+    assert pricing_engine("oracle-se2-cdb", "bring-your-own-license") == ("oracle-se2", "bring-your-own-license")
+
+def test_licensed_engine_without_price_is_not_priced(monkeypatch):
+    monkeypatch.setattr(rds_rightsizing, "get_rate", lambda *args, **kwargs: None)
+    assert rds_rightsizing.class_rate("us-east-1", "db.m5.large", ("mysql", None), 0.171) == 0.171
+    assert rds_rightsizing.class_rate("us-east-1", "db.m5.large", ("sqlserver-se", "license-included"), 0.171) is None
@@ -1,9 +1,45 @@
+import contextlib
+import contextvars
 import csv
 import os
-def write_to_csv(file_path, *args):
-    file_exists = os.path.isfile(file_path)
-    with open(file_path, 'a', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        if not file_exists:
-            writer.writerow(['Account', 'Region', 'ResourceId', 'currentType', 'currentCost', 'newType', 'newCost'])  # Replace with your desired header
-        writer.writerow(args)
+import threading
+
+# callables that receive every finding as (file_path, row), next to the CSV report
+sinks = []
+# set to False to only deliver findings to the sinks, e.g. in serve mode
+write_files = True
+_lock = threading.Lock()
+# rows written in the current context, see collecting()
+_collected = contextvars.ContextVar("collected", default=None)
+
+def add_sink(sink):
+    sinks.append(sink)
+
+def remove_sink(sink):
+    sinks.remove(sink)
+
+# Collect every row written inside the block as (file_path, row, header), also the rows of the
+# threads it starts with a copy of its context, such as check threads and pipeline workers
+@contextlib.contextmanager
+def collecting():
+    rows = []
+    token = _collected.set(rows)
+    try:
+        yield rows
+    finally:
+        _collected.reset(token)
+
+def write_to_csv(file_path, *args, header=None):
+    rows = _collected.get()
+    if rows is not None:
+        rows.append((file_path, args, header))
+    with _lock:
+        if write_files:
+            file_exists = os.path.isfile(file_path)
+            with open(file_path, 'a', newline='') as csvfile:
+                writer = csv.writer(csvfile)
+                if not file_exists:
+                    writer.writerow(header or ['Account', 'Region', 'ResourceId', 'currentType', 'currentCost', 'newType', 'newCost'])  # Replace with your desired header
+                writer.writerow(args)
+        for sink in sinks:
+            sink(file_path, args)